@@ -1,36 +1,64 @@
 # -*- coding: utf-8 -*-
 
+import os
 import re
 import json
+import math
+import arrow
+import atexit
 import logging
+import tempfile
 from datetime import timedelta
 from bson import ObjectId
+from pymongo.errors import ConnectionFailure
 
-from flask import Flask, request, redirect, jsonify, render_template
+from flask import Flask, Response, request, redirect, jsonify, render_template, stream_with_context
 from flask_jwt import JWT, jwt_required, current_identity
 
 from py import user
 from py import jwt_auth
 from py import subject
 from py import link
+from py import audit
+from py import auditstore
+from py import storage
 from py import mailer
+from py import etag
+from py import export
+from py import serializer
+from py import indexes
+from py import metrics
+from py import mongopool
+from py.auditsink import AuditSink
+from py.health import HealthMonitor
+from py.identitycache import IdentityCache
+from py.passwords import PasswordHasher
+from py.ratelimit import RateLimiter, client_ip
 from py.idmexception import IDMException
 from py.jsondocument import mongoserver
 
 # read settings
+import defaults
 try:
 	import settings
 except Exception:
 	logging.warn('No `settings.py` present, using `defaults.py`')
-	import defaults as settings
+	settings = defaults
+
+def _setting(name):
+	""" Returns the setting of the given name, falling back to `defaults.py`
+	for settings that an older `settings.py` does not yet define.
+	"""
+	return getattr(settings, name, getattr(defaults, name))
 
 
-# JSON encoder that handles BSON
+# JSON encoder that handles BSON, for `jsonify()`; document responses use
+# the faster `serializer` instead
 class BSONEncoder(json.JSONEncoder):
 	def default(self, o):
-		if isinstance(o, ObjectId):
-			return str(o)
-		return json.JSONEncoder.default(self, o)
+		return serializer.default(o)
+
+serializer.use(_setting('json_backend'))
 
 
 # app setup
@@ -39,24 +67,85 @@ app.config['SECRET_KEY'] = settings.jwt['secret']
 app.config['JWT_EXPIRATION_DELTA'] = timedelta(seconds=int(settings.jwt['expiration_seconds']))
 app.json_encoder = BSONEncoder
 jwt = JWT(app, jwt_auth.authenticate, jwt_auth.identity)
+metrics.instrument(app)
 
+# the Mongo server, and with it its connection pool, is created on first use
+# in every worker process
 mng_bkt = settings.mongo_server['bucket']
-mng_srv = mongoserver.MongoServer(
-	host=settings.mongo_server['host'],
+mng_pool = {name: settings.mongo_server.get(name) for name, uri_name in mongopool.POOL_OPTIONS}
+mng_srv = mongopool.MongoPool(lambda: mongoserver.MongoServer(
+	host=mongopool.mongo_uri(settings.mongo_server['host'], settings.mongo_server['port'], mng_pool),
 	port=settings.mongo_server['port'],
 	database=settings.mongo_server['db'],
 	bucket=mng_bkt,
 	user=settings.mongo_server['user'],
-	pw=settings.mongo_server['password'])
+	pw=settings.mongo_server['password']), options=mng_pool)
 
 user.server = mng_srv
 user.bucket = mng_bkt
+cache_settings = _setting('identity_cache')
+user.identity_cache = IdentityCache(
+	max_size=int(cache_settings.get('max_size', 1000)),
+	ttl=float(cache_settings.get('ttl_seconds', 60)))
+
+password_settings = _setting('passwords')
+user.hasher = PasswordHasher(
+	rounds=int(password_settings.get('rounds', 12)),
+	max_workers=int(password_settings.get('max_workers', 2)),
+	max_pending=int(password_settings.get('max_pending', 4)),
+	wait=float(password_settings.get('wait_seconds', 0.5)),
+	slot_dir=password_settings.get('slot_dir') or os.path.join(tempfile.gettempdir(), 'c3pro-idm-password-slots'))
+
+limit_settings = _setting('rate_limit')
+limiter = None
+if limit_settings.get('enabled', True):
+	limiter = RateLimiter(limit_settings.get('database') or os.path.join(tempfile.gettempdir(), 'c3pro-idm-ratelimit.sqlite'))
+
+def _ensure_indexes():
+	created = indexes.ensure_indexes(mng_srv, mng_bkt)
+	if len(created) > 0:
+		logging.info("created Mongo indexes: {}".format(', '.join(created)))
+	return created
+
+# indexes are ensured on the first request of every worker rather than on
+# import, which would connect to Mongo in gunicorn's master before it forks
+if settings.mongo_server.get('ensure_indexes', True):
+	@app.before_first_request
+	def _ensure_indexes_on_first_request():
+		try:
+			_ensure_indexes()
+		except Exception as e:
+			logging.error("failed to ensure Mongo indexes: {}".format(e))
+
+audit_settings = _setting('audit')
+if 'buffered' == audit_settings.get('mode'):
+	audit.sink = AuditSink(mng_srv,
+		batch_size=int(audit_settings.get('batch_size', 100)),
+		flush_interval=float(audit_settings.get('flush_seconds', 1.0)),
+		max_queue=int(audit_settings.get('max_queue', 10000)))
+	atexit.register(audit.sink.close)
 
 mail = mailer.Mailer(settings.mail.get('username'),
 	settings.mail.get('password'),
 	settings.mail.get('server'),
 	settings.mail.get('port'),
-	settings.admin_email)
+	settings.admin_email,
+	starttls=settings.mail.get('starttls', True))
+atexit.register(mail.close)
+
+def _probe_db():
+	coll = storage.collection(mng_srv, mng_bkt)
+	if coll is not None:
+		coll.database.command('ping')
+	else:
+		user.User.has_admins(mng_srv, mng_bkt)
+
+health_settings = _setting('health')
+health_timeout = float(health_settings.get('timeout_seconds', 5))
+health = HealthMonitor({
+	'mail': lambda: mail.check(timeout=health_timeout),
+	'db': _probe_db,
+}, interval=float(health_settings.get('interval_seconds', 30)), timeout=health_timeout)
 
 
 def _err(message, status=400, headers=None):
@@ -65,9 +154,17 @@ def _err(message, status=400, headers=None):
 
 def _exc(exception):
 	if isinstance(exception, IDMException):
-		return _err(str(exception), status=exception.status_code)
+		headers = {'Retry-After': '1'} if 503 == exception.status_code else None
+		return _err(str(exception), status=exception.status_code, headers=headers)
+	if isinstance(exception, ConnectionFailure):
+		logging.error("Mongo is unavailable: {}".format(exception))
+		return _err('the database is unavailable, please try again in a moment', status=503, headers={'Retry-After': '1'})
 	return _err(str(exception))
 
+@app.errorhandler(IDMException)
+def _idm_exception(exception):
+	return _exc(exception)
+
 @app.errorhandler(404)
 def _not_found(error):
 	return _err(error.name, status=error.code)
@@ -80,6 +177,76 @@ def _not_allowed(error):
 def _jwt_err(error):
 	return _err(error.error, status=error.status_code, headers=error.headers)
 
+# the endpoints to rate limit, by path, and where to find the username
+LIMITED = {
+	'/auth': 'json',
+	'/iforgot': 'form',
+	'/establish': None,
+}
+
+@app.before_request
+def _rate_limit():
+	""" Rejects POSTs to the endpoints in `LIMITED` with a 429 once the
+	client IP or the username has used up its requests.
+	"""
+	if limiter is None or 'POST' != request.method or request.path not in LIMITED:
+		return None
+	ip = client_ip(request.remote_addr, request.headers.get('X-Real-IP'), limit_settings.get('trusted_proxies', []))
+	buckets = [('{} ip {}'.format(request.path, ip),
+		float(limit_settings.get('ip_rate', 1.0)), float(limit_settings.get('ip_burst', 20)))]
+	source = LIMITED[request.path]
+	name = None
+	if 'json' == source:
+		name = (request.get_json(silent=True) or {}).get('username')
+	elif 'form' == source:
+		name = request.form.get('username')
+	if name and isinstance(name, str):
+		buckets.append(('{} user {}'.format(request.path, name.lower()),
+			float(limit_settings.get('username_rate', 0.1)), float(limit_settings.get('username_burst', 5))))
+	
+	wait = limiter.hit(buckets)
+	if wait > 0:
+		return _err('too many requests, please try again later', status=429, headers={'Retry-After': str(int(math.ceil(wait)))})
+	return None
+
+def _json(obj, status=200):
+	return Response(serializer.dumps(obj), status=status, mimetype='application/json')
+
+def _json_list(items, extra=None):
+	""" Streams `{"data": [...]}` with the API representation of the items,
+	plus the members in `extra`.
+	"""
+	if items is None:
+		return _json(dict({'data': None}, **(extra or {})))
+	return Response(serializer.stream_list(items, lambda item: item.for_api(), extra=extra), mimetype='application/json')
+
+def _not_modified(versions, extra=None):
+	""" Returns a 304 response if the request's `If-None-Match` matches the
+	validators of the given versions, else None.
+	"""
+	if not request.if_none_match or not versions:
+		return None
+	tag, modified = etag.validators(versions, extra)
+	if not request.if_none_match.contains_weak(tag):
+		return None
+	return _with_validators(Response(status=304), tag, modified)
+
+def _conditional(response, docs, extra=None):
+	""" Returns a 304 response if the request's `If-None-Match` matches the
+	given documents, else the response built by `response()`, with a weak
+	ETag and Last-Modified derived from the documents' versions.
+	"""
+	tag, modified = etag.validators(docs, extra)
+	if request.if_none_match.contains_weak(tag):
+		return _with_validators(Response(status=304), tag, modified)
+	return _with_validators(response(), tag, modified)
+
+def _with_validators(response, tag, modified):
+	response.set_etag(tag, weak=True)
+	if modified is not None:
+		response.last_modified = modified.datetime
+	return response
+
 def _subject_with_sssid(sssid):
 	rslt = subject.Subject.find_sssid_on(sssid, mng_srv, mng_bkt)
 	if len(rslt) > 0:
@@ -99,23 +266,34 @@ def index():
 
 @app.route('/status')
 def status():
-	msg_mail = 'ok'
-	try:
-		mail.connect()
-	except Exception as e:
-		msg_mail = str(e)
-	
-	msg_db = 'ok'
-	try:
-		user.User.has_admins(mng_srv, mng_bkt)
-	except Exception as e:
-		msg_db = str(e)
-		
+	""" Reports the latest results of the background health probes.
+	"""
+	health.ensure_started()
+	probes = health.report()
 	return jsonify({'data': {
-		'mail': msg_mail,
-		'db': msg_db,
+		'mail': probes['mail']['status'],
+		'db': probes['db']['status'],
+		'probes': probes,
+		'mongo': mng_srv.stats(),
+		'identity_cache': user.identity_cache.stats(),
+		'passwords': user.hasher.stats(),
+		'audit': audit.sink.stats() if audit.sink is not None else {'mode': 'sync'},
+		'link_dates': {'failed_updates': link.link_date_failures},
 	}})
 
+@app.route('/status/live')
+def status_live():
+	""" Liveness check that does not touch any external service.
+	"""
+	return jsonify({'status': 'alive'})
+
+@app.route('/metrics')
+def metrics_ep():
+	""" Request and database metrics of all workers, in Prometheus format.
+	"""
+	body, content_type = metrics.render()
+	return Response(body, content_type=content_type)
+
 
 # MARK: - Subjects
 
@@ -130,31 +308,53 @@ def subject_ep():
 			if not js or not 'sssid' in js:
 				return _err('must at least provide `sssid`')
 			
-			subj = _subject_with_sssid(js['sssid'])
-			if subj is not None:
-				return _err('this SSSID is already taken', 409)
-			
-			subj = subject.Subject(js['sssid'], js)
-			del subj._id   # auto-creates UUID; we rely on Mongo
-			subj.store_to(mng_srv, mng_bkt)
+			subj = subject.Subject.create(js, mng_srv, mng_bkt)
 			return jsonify({'data': subj.for_api()}), 201
 		
-		# list subjects
+		# list subjects; paginates with `offset` if given, else with the
+		# cursor returned as `next`
 		search = request.args.get('search')
 		offset = request.args.get('offset')
-		limit = request.args.get('perpage')
+		limit = int(request.args.get('perpage') or 50)
 		sort = request.args.get('ordercol')
 		order = request.args.get('orderdir')
 		desc = True if order and 'desc' == order.lower() else False
-		rslt = subject.Subject.search(search, mng_srv, bucket=mng_bkt, skip=int(offset), limit=int(limit), sort=sort, descending=desc)
-		return jsonify({'data': [p.for_api() for p in rslt]})
+		if offset is not None:
+			rslt = subject.Subject.search(search, mng_srv, bucket=mng_bkt, skip=int(offset), limit=limit, sort=sort, descending=desc)
+			return _conditional(lambda: _json_list(rslt), rslt, request.query_string)
+		
+		rslt, nxt = subject.Subject.search_page(search, mng_srv, bucket=mng_bkt, limit=limit, sort=sort, descending=desc, after=request.args.get('next'))
+		return _conditional(lambda: _json_list(rslt, {'next': nxt}), rslt, request.query_string)
 	except Exception as e:
 		return _exc(e)
 
+@app.route('/subject/bulk', methods=['POST'])
+@jwt_required()
+def subject_bulk():
+	""" Creates subjects from newline-delimited JSON, streaming back one JSON
+	result per line. Should the import fail midway, e.g. because the
+	database became unavailable, a last line without `line` number tells
+	the status and error; lines without a result were not imported.
+	"""
+	def results():
+		try:
+			for result in subject.Subject.import_ndjson(request.stream, mng_srv, mng_bkt):
+				yield serializer.dumps(result) + '\n'
+		except Exception as e:
+			logging.error("bulk import of subjects aborted: {}".format(e))
+			status = 503 if isinstance(e, ConnectionFailure) else getattr(e, 'status_code', 500)
+			yield serializer.dumps({'status': status, 'error': str(e)}) + '\n'
+	return Response(stream_with_context(results()), mimetype='application/x-ndjson')
+
 @app.route('/subject/<sssid>', methods=['GET', 'PUT'])
 @jwt_required()
 def subject_sssid(sssid):
 	try:
+		if 'GET' == request.method:
+			not_modified = _not_modified(etag.versions_on(mng_srv, mng_bkt, {'type': 'subject', 'sssid': sssid}))
+			if not_modified is not None:
+				return not_modified
+		
 		subj = _subject_with_sssid(sssid)
 		if subj is None:
 			raise IDMException('Not Found', 404)
@@ -165,13 +365,26 @@ def subject_sssid(sssid):
 			return '', 204
 		
 		# get subject
-		return jsonify({'data': subj.for_api()})
+		return _conditional(lambda: _json({'data': subj.for_api()}), [subj])
 	except Exception as e:
 		return _exc(e)
 
 
 # MARK: - Links
 
+@app.route('/link/bulk', methods=['POST'])
+@jwt_required()
+def link_bulk():
+	""" Creates one link for each subject in `sssids`, optionally issuing
+	their JWTs right away if `jwt` is true.
+	"""
+	try:
+		js = request.json or {}
+		results = link.Link.create_for_sssids(js.get('sssids'), settings, mng_srv, mng_bkt, with_jwt=bool(js.get('jwt')))
+		return jsonify({'data': results})
+	except Exception as e:
+		return _exc(e)
+
 @app.route('/link/<jti>/jwt', methods=['GET'])
 def link_jti_jwt(jti):
 	try:
@@ -202,6 +415,11 @@ def establish_ep():
 @jwt_required()
 def link_jti(jti):
 	try:
+		if 'GET' == request.method:
+			not_modified = _not_modified(etag.versions_on(mng_srv, mng_bkt, {'_id': ObjectId(jti) if ObjectId.is_valid(jti) else jti, 'type': 'link'}))
+			if not_modified is not None:
+				return not_modified
+		
 		lnk = link.Link.find_jti_on(jti, mng_srv, mng_bkt)
 		if lnk is None:
 			return _err('Not Found', status=404)
@@ -212,7 +430,7 @@ def link_jti(jti):
 			return 'Not implemented', 500
 		
 		# get
-		return jsonify({'data': lnk.for_api()})
+		return _conditional(lambda: _json({'data': lnk.for_api()}), [lnk])
 	except Exception as e:
 		return _exc(e)
 
@@ -223,15 +441,18 @@ def subject_sssid_link(sssid):
 		subj = _subject_with_sssid(sssid)
 		if subj is None:
 			return _err('Not Found', status=404)
-
+		
 		# create a new link
 		if 'POST' == request.method:
 			lnk = subj.create_new_link(settings, mng_srv, mng_bkt)
 			return jsonify({'data': lnk.for_api()}), 201
 		
 		# return all links for this SSSID
+		not_modified = _not_modified(etag.versions_on(mng_srv, mng_bkt, {'type': 'link', 'sub': sssid}))
+		if not_modified is not None:
+			return not_modified
 		rslt = link.Link.find_for_sssid_on(sssid, mng_srv, mng_bkt)
-		return jsonify({'data': [l.for_api() for l in rslt] if rslt is not None else None})
+		return _conditional(lambda: _json_list(rslt), rslt or [])
 	except Exception as e:
 		return _exc(e)
 
@@ -246,9 +467,46 @@ def subject_sssid_audits(sssid):
 		if subj is None:
 			return _err('Not Found', status=404)
 		
-		# return all audits for this subject
-		rslt = subj.all_audits(mng_srv, mng_bkt)
-		return jsonify({'data': [a.for_api() for a in rslt] if rslt is not None else None})
+		# return the audits for this subject, all of them unless `limit` is
+		# given, in which case the cursor to the next page is returned as
+		# `next`
+		filters = {
+			'since': request.args.get('since'),
+			'until': request.args.get('until'),
+			'action': request.args.get('action'),
+			'source': request.args.get('source'),
+			'after': request.args.get('next'),
+		}
+		limit = int(request.args['limit']) if request.args.get('limit') else None
+		if limit is not None and limit < 1:
+			raise IDMException("`limit` must be at least 1", 400)
+		fetch = limit + 1 if limit is not None else None
+		
+		versions, nxt = audit.Audit.paginate(subj.audit_versions(mng_srv, mng_bkt, limit=fetch, **filters), limit)
+		not_modified = _not_modified(versions, '{} {}'.format(request.query_string, nxt))
+		if not_modified is not None:
+			return not_modified
+		rslt, nxt = audit.Audit.paginate(subj.all_audits(mng_srv, mng_bkt, limit=fetch, **filters), limit)
+		return _conditional(lambda: _json_list(rslt, {'next': nxt}), rslt or [], '{} {}'.format(request.query_string, nxt))
+	except Exception as e:
+		return _exc(e)
+
+
+# MARK: - Export
+
+@app.route('/export/<kind>', methods=['GET'])
+@jwt_required()
+def export_kind(kind):
+	""" Streams all subjects, links or audits as NDJSON or CSV.
+	"""
+	try:
+		fmt = request.args.get('format') or 'ndjson'
+		chunks = export.export(kind, mng_srv, mng_bkt, fmt=fmt,
+			since=request.args.get('since'),
+			until=request.args.get('until'),
+			batch_size=int(request.args.get('batch') or 500))
+		headers = {'Content-Disposition': 'attachment; filename="{}.{}"'.format(kind, fmt)}
+		return Response(stream_with_context(chunks), mimetype=export.FORMATS[fmt], headers=headers)
 	except Exception as e:
 		return _exc(e)
 
@@ -339,6 +597,57 @@ def user_uid(uid):
 		return _exc(e)
 
 
+# MARK: - Commands
+
+@app.cli.command('ensure-indexes')
+def ensure_indexes_cmd():
+	""" Creates missing Mongo indexes and lists the ones it created.
+	"""
+	created = _ensure_indexes()
+	print("Created indexes: {}".format(', '.join(created)) if len(created) > 0 else "All indexes already exist")
+
+@app.cli.command('backfill-link-dates')
+def backfill_link_dates_cmd():
+	""" Computes enrollment and withdrawal dates of all subjects from their
+	links.
+	"""
+	count = subject.Subject.backfill_link_dates(mng_srv, mng_bkt)
+	print("Updated link dates of {} subjects".format(count))
+
+@app.cli.command('reindex-subjects')
+def reindex_subjects_cmd():
+	""" Recomputes the search n-grams of all subjects.
+	"""
+	count = subject.Subject.reindex_search(mng_srv, mng_bkt)
+	print("Reindexed {} subjects".format(count))
+
+@app.cli.command('migrate-audits')
+def migrate_audits_cmd():
+	""" Moves audits from the shared bucket into the monthly audit
+	collections.
+	"""
+	count = auditstore.migrate(mng_srv, mng_bkt)
+	print("Moved {} audits".format(count))
+
+@app.cli.command('backfill-audit-actors')
+def backfill_audit_actors_cmd():
+	""" Stores the actor's username on audits written before audits
+	recorded it.
+	"""
+	count = audit.Audit.backfill_actors(mng_srv, mng_bkt)
+	print("Added the actor to {} audits".format(count))
+
+@app.cli.command('archive-audits')
+def archive_audits_cmd():
+	""" Archives the monthly audit collections older than the configured
+	retention to gzipped files.
+	"""
+	months = int(audit_settings.get('archive_after_months', 24))
+	before = arrow.utcnow().floor('month').shift(months=-months)
+	archived = auditstore.archive(mng_srv, mng_bkt, audit_settings.get('archive_dir', 'audit-archive'), before)
+	print("Archived {}".format(', '.join(archived)) if len(archived) > 0 else "No audits older than {} to archive".format(before.format('YYYY-MM')))
+
+
 # start the app
 if '__main__' == __name__:
 	logging.basicConfig(level=logging.INFO)
@@ -0,0 +1,139 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+
+import arrow
+import unittest
+from unittest.mock import patch
+from bson import ObjectId
+from py import audit
+from py import auditstore
+from py.idmexception import IDMException
+from auditstore_tests import FakeServer
+
+
+def _oid(when):
+	return ObjectId.from_datetime(arrow.get(when).datetime)
+
+SUBJ = _oid('2016-12-01T00:00:00+00:00')
+LINK = _oid('2016-12-02T00:00:00+00:00')
+OTHER = _oid('2016-12-03T00:00:00+00:00')
+
+
+class AuditTests(unittest.TestCase):
+	
+	def setUp(self):
+		self.srv = FakeServer([])
+		self.records = []
+		for doc, when, action in [
+				(SUBJ, '2017-01-05T10:00:00+00:00', 'create'),
+				(LINK, '2017-01-05T10:00:00+00:00', 'create'),      # same datetime, tie broken by _id
+				(OTHER, '2017-01-06T10:00:00+00:00', 'create'),
+				(SUBJ, '2017-02-01T00:00:00+00:00', 'update'),
+				(LINK, '2017-02-14T08:30:00.250000+00:00', 'linked'),
+				(SUBJ, '2017-03-31T23:59:59+00:00', 'update'),
+				(LINK, '2017-04-01T00:00:00+00:00', 'withdrawn')]:
+			self.records.append({'_id': ObjectId(), 'type': 'audit', 'document': doc, 'datetime': when, 'action': action})
+		auditstore.insert_many(self.srv, None, self.records)
+		self.mine = sorted([r for r in self.records if r['document'] in [SUBJ, LINK]], key=lambda r: (r['datetime'], r['_id']))
+	
+	def testQueryForDocIds(self):
+		query, start = audit.Audit._query_for_doc_ids([SUBJ, str(LINK)], '2017-02-01', '2017-03-01T00:00:00+01:00', 'update', None)
+		self.assertEqual({
+			'document': {'$in': [SUBJ, LINK]},
+			'datetime': {'$gte': '2017-02-01T00:00:00+00:00', '$lt': '2017-02-28T23:00:00+00:00'},
+			'action': 'update',
+		}, query)
+		self.assertEqual(arrow.get('2017-02-01T00:00:00+00:00'), start)
+		
+		query, start = audit.Audit._query_for_doc_ids([SUBJ], None, None, None, None)
+		self.assertEqual({'document': {'$in': [SUBJ]}}, query)
+		self.assertEqual(arrow.get(SUBJ.generation_time), start)
+		self.assertEqual((None, None), audit.Audit._query_for_doc_ids([], None, None, None, None))
+		
+		with self.assertRaises(IDMException) as cm:
+			audit.Audit._query_for_doc_ids([SUBJ], 'yesterday', None, None, None)
+		self.assertEqual(400, cm.exception.status_code)
+	
+	def testPaginate(self):
+		self.assertEqual((None, None), audit.Audit.paginate(None, 2))
+		self.assertEqual((self.mine, None), audit.Audit.paginate(self.mine, None))
+		self.assertEqual((self.mine[:2], None), audit.Audit.paginate(self.mine[:2], 2))
+		page, nxt = audit.Audit.paginate(self.mine[:3], 2)
+		self.assertEqual(self.mine[:2], page)
+		self.assertIsNotNone(nxt)
+	
+	def testPageWalk(self):
+		for size in [1, 2, 3, 5, 6]:
+			seen = []
+			versions = []
+			after = None
+			while True:
+				rslt, after = audit.Audit.paginate(audit.Audit.find_for_doc_ids_on([SUBJ, LINK], self.srv, after=after, limit=size + 1), size)
+				self.assertLessEqual(len(rslt), size)
+				seen.extend([a._id for a in rslt])
+				if after is None:
+					break
+			after = None
+			while True:
+				rslt, after = audit.Audit.paginate(audit.Audit.versions_for_doc_ids_on([SUBJ, LINK], self.srv, after=after, limit=size + 1), size)
+				versions.extend([doc['_id'] for doc in rslt])
+				if after is None:
+					break
+			self.assertEqual([r['_id'] for r in self.mine], seen)
+			self.assertEqual(seen, versions)
+	
+	def testFilters(self):
+		def found(**filters):
+			rslt = audit.Audit.find_for_doc_ids_on([SUBJ, LINK], self.srv, **filters) or []
+			return [a.datetime for a in rslt]
+		
+		self.assertEqual(['2017-02-01T00:00:00+00:00', '2017-02-14T08:30:00.250000+00:00', '2017-03-31T23:59:59+00:00'],
+			found(since='2017-02-01T01:00:00+01:00', until='2017-04-01'))
+		self.assertEqual(['2017-02-01T00:00:00+00:00', '2017-03-31T23:59:59+00:00'], found(action='update'))
+		self.assertEqual(['2017-04-01T00:00:00+00:00'], found(since='2017-04-01', action='withdrawn'))
+		self.assertEqual([], found(until='2017-01-01'))
+		self.assertEqual(['2017-01-05T10:00:00+00:00'], [a.datetime for a in audit.Audit.find_for_doc_id_on(SUBJ, self.srv, until='2017-02-01')])
+	
+	def testActorRecorded(self):
+		with patch.object(audit, 'current_identity', FakeIdentity('u1', 'bruno@mars.com')):
+			adt = audit.Audit.audit_event_now(SUBJ, 'update')
+		self.assertEqual('u1', adt.actor_id)
+		self.assertEqual('bruno@mars.com', adt.actor)
+		record = adt.as_record()
+		self.assertEqual('bruno@mars.com', record['actor'])
+		self.assertEqual('u1', record['actor_id'])
+	
+	def testBackfillActors(self):
+		srv = FakeServer([])
+		records = []
+		for when, actor_id, actor in [
+				('2017-01-01T10:00:00+00:00', 'u1', None),
+				('2017-01-02T10:00:00+00:00', 'u2', None),
+				('2017-01-03T10:00:00+00:00', 'u1', 'keep@me.com'),
+				('2017-01-04T10:00:00+00:00', 'u9', None),           # deleted user
+				('2017-02-01T10:00:00+00:00', 'u2', None),
+				('2017-02-02T10:00:00+00:00', 'u1', None),
+				('2017-02-03T10:00:00+00:00', 'u2', None)]:
+			record = {'_id': ObjectId(), 'type': 'audit', 'document': SUBJ, 'datetime': when, 'action': 'update', 'actor_id': actor_id}
+			if actor:
+				record['actor'] = actor
+			records.append(record)
+		auditstore.insert_many(srv, None, records)
+		
+		users = {'u1': FakeIdentity('u1', 'bruno@mars.com'), 'u2': FakeIdentity('u2', 'lady@gaga.com')}
+		def find_on(dic, server, bucket=None, limit=50):
+			return [users[i] for i in dic['_id']['$in'] if i in users]
+		
+		with patch.object(audit.User, 'find_on', side_effect=find_on) as lookup:
+			self.assertEqual(5, audit.Audit.backfill_actors(srv, batch_size=2))
+		self.assertEqual(4, lookup.call_count)      # January: 3 audits, February: 3 audits
+		
+		actors = [doc.get('actor') for doc in auditstore.find(srv, None, {})]
+		self.assertEqual(['bruno@mars.com', 'lady@gaga.com', 'keep@me.com', None, 'lady@gaga.com', 'bruno@mars.com', 'lady@gaga.com'], actors)
+
+
+class FakeIdentity(object):
+	
+	def __init__(self, id, username):
+		self.id = id
+		self.username = username
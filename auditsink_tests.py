@@ -0,0 +1,85 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+
+import unittest
+import collections
+from py.auditsink import AuditSink
+
+
+class AuditSinkTests(unittest.TestCase):
+	
+	def setUp(self):
+		self.server = FakeServer()
+		self.sink = AuditSink(self.server, batch_size=100, flush_interval=60)
+	
+	def tearDown(self):
+		self.sink.close()
+	
+	def testBuffersUntilFlush(self):
+		self.sink.submit({'action': 'create', 'datetime': JAN})
+		self.sink.submit({'action': 'update', 'datetime': JAN})
+		self.assertEqual(0, len(self.server.db['idm_audit_201701'].inserted))
+		self.assertEqual(2, self.sink.stats()['queue_depth'])
+		
+		self.sink.flush()
+		self.assertEqual([[{'action': 'create', 'datetime': JAN}, {'action': 'update', 'datetime': JAN}]], self.server.db['idm_audit_201701'].inserted)
+		self.assertEqual(0, self.sink.stats()['queue_depth'])
+		self.assertEqual(1, self.sink.stats()['flushes'])
+		self.assertIsNotNone(self.sink.stats()['last_flush_ms'])
+	
+	def testCloseDrains(self):
+		self.sink.submit({'action': 'create', 'datetime': JAN}, 'other')
+		self.sink.close()
+		self.assertEqual(1, len(self.server.db['other_audit_201701'].inserted))
+		with self.assertRaises(Exception):
+			self.sink.submit({'action': 'update'})
+	
+	def testRequeuesOnFailure(self):
+		self.server.db['idm_audit_201701'].fail = True
+		self.sink.submit({'action': 'create', 'datetime': JAN})
+		self.sink.flush()
+		self.assertEqual(1, self.sink.stats()['queue_depth'])
+		self.assertEqual(1, self.sink.stats()['failures'])
+		
+		self.server.db['idm_audit_201701'].fail = False
+		self.sink.flush()
+		self.assertEqual(0, self.sink.stats()['queue_depth'])
+		self.assertEqual(1, len(self.server.db['idm_audit_201701'].inserted))
+	
+	def testBounded(self):
+		self.sink.max_queue = 2
+		self.sink.submit_many([{'n': 1, 'datetime': JAN}, {'n': 2, 'datetime': JAN}])
+		self.sink.submit({'n': 3, 'datetime': JAN})
+		self.assertEqual(2, self.sink.stats()['queue_depth'])
+		self.assertEqual(1, self.sink.stats()['written_directly'])
+		self.assertEqual([[{'n': 3, 'datetime': JAN}]], self.server.db['idm_audit_201701'].inserted)
+		
+		self.server.db['idm_audit_201701'].fail = True
+		with self.assertRaises(Exception):
+			self.sink.submit({'n': 4, 'datetime': JAN})
+		self.assertEqual(2, self.sink.stats()['queue_depth'])
+
+
+class FakeCollection(object):
+	
+	def __init__(self):
+		self.inserted = []
+		self.fail = False
+	
+	def create_index(self, keys, **kwargs):
+		pass
+	
+	def insert_many(self, records, ordered=True):
+		if self.fail:
+			raise Exception("connection refused")
+		self.inserted.append(list(records))
+
+
+class FakeServer(object):
+	
+	def __init__(self):
+		self.bucket = 'idm'
+		self.db = collections.defaultdict(FakeCollection)
+
+
+JAN = '2017-01-17T10:06:17+00:00'
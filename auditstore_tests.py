@@ -0,0 +1,195 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+
+import os
+import gzip
+import json
+import arrow
+import shutil
+import tempfile
+import unittest
+from bson import ObjectId
+from py import auditstore
+
+
+class AuditStoreTests(unittest.TestCase):
+	
+	def testPartitions(self):
+		self.assertEqual('idm_audit_201701', auditstore.partition_name('idm', '2017-01-31T23:30:00+00:00'))
+		self.assertEqual('idm_audit_201702', auditstore.partition_name('idm', '2017-01-31T23:30:00-01:00'))
+		self.assertEqual(arrow.Arrow(2017, 1, 1), auditstore.partition_month('idm', 'idm_audit_201701'))
+		self.assertIsNone(auditstore.partition_month('idm', 'idm'))
+		self.assertIsNone(auditstore.partition_month('idm', 'idm_audit_2017'))
+		self.assertIsNone(auditstore.partition_month('idm', 'other_audit_201701'))
+		
+		srv = FakeServer(['idm', 'idm_audit_201703', 'idm_audit_201701', 'idm_audit_201612', 'other_audit_201701'])
+		self.assertEqual(['idm_audit_201612', 'idm_audit_201701', 'idm_audit_201703'], auditstore.partitions(srv))
+		self.assertEqual(['idm_audit_201701', 'idm_audit_201703'], auditstore.partitions(srv, since='2017-01-31T00:00:00+00:00'))
+		self.assertEqual(['idm_audit_201612', 'idm_audit_201701'], auditstore.partitions(srv, until='2017-02-01T00:00:00+00:00'))
+	
+	def testInsertAndFind(self):
+		srv = FakeServer([])
+		auditstore.insert_many(srv, None, [
+			{'document': 'a', 'datetime': '2017-02-01T10:00:00+00:00'},
+			{'document': 'b', 'datetime': '2017-01-02T10:00:00+00:00'},
+			{'document': 'a', 'datetime': '2017-01-01T10:00:00+00:00'},
+		])
+		self.assertEqual(['idm_audit_201701', 'idm_audit_201702'], auditstore.partitions(srv))
+		found = list(auditstore.find(srv, None, {'document': 'a'}))
+		self.assertEqual(['2017-01-01T10:00:00+00:00', '2017-02-01T10:00:00+00:00'], [doc['datetime'] for doc in found])
+		found = list(auditstore.find(srv, None, {'document': 'a'}, since='2017-02-01T00:00:00+00:00'))
+		self.assertEqual(1, len(found))
+		found = list(auditstore.find(srv, None, {}, limit=2))
+		self.assertEqual(['a', 'b'], [doc['document'] for doc in found])
+		self.assertEqual(0, len(list(auditstore.find(srv, None, {}, limit=0))))
+	
+	def testUnmigrated(self):
+		auditstore._drained.clear()
+		srv = FakeServer([])
+		srv.db['idm'].docs.extend([
+			{'_id': 1, 'type': 'audit', 'document': 'a', 'datetime': '2017-01-15T10:00:00+00:00'},
+			{'_id': 2, 'type': 'subject', 'document': 'a', 'datetime': '2017-01-16T10:00:00+00:00'},
+		])
+		auditstore.insert_many(srv, None, [
+			{'_id': 3, 'document': 'a', 'datetime': '2017-01-01T10:00:00+00:00'},
+			{'_id': 4, 'document': 'a', 'datetime': '2017-02-01T10:00:00+00:00'},
+		])
+		self.assertTrue(auditstore.has_unmigrated(srv))
+		self.assertEqual([3, 1, 4], [doc['_id'] for doc in auditstore.find(srv, None, {'document': 'a'})])
+		self.assertEqual([3, 1], [doc['_id'] for doc in auditstore.find(srv, None, {'document': 'a'}, limit=2)])
+		
+		self.assertEqual(1, auditstore.migrate(srv))
+		self.assertFalse(auditstore.has_unmigrated(srv))
+		self.assertEqual(['idm_audit_201701', 'idm_audit_201702'], auditstore.partitions(srv))
+		self.assertEqual([3, 1, 4], [doc['_id'] for doc in auditstore.find(srv, None, {'document': 'a'})])
+	
+	def testEarliest(self):
+		old = ObjectId.from_datetime(arrow.get('2017-01-17T10:00:00+00:00').datetime)
+		new = ObjectId()
+		self.assertEqual(old.generation_time, auditstore.earliest([new, old]))
+		self.assertIsNone(auditstore.earliest([new, 'not-an-object-id']))
+		self.assertIsNone(auditstore.earliest([]))
+	
+	def testArchive(self):
+		srv = FakeServer([])
+		auditstore.insert_many(srv, None, [
+			{'_id': 1, 'document': 'a', 'datetime': '2017-01-01T10:00:00+00:00'},
+			{'_id': 2, 'document': 'a', 'datetime': '2017-02-01T10:00:00+00:00'},
+		])
+		directory = tempfile.mkdtemp()
+		try:
+			self.assertEqual(['idm_audit_201701'], auditstore.archive(srv, None, directory, '2017-02-15T00:00:00+00:00'))
+			self.assertEqual(['idm_audit_201702'], auditstore.partitions(srv))
+			with gzip.open(os.path.join(directory, 'idm_audit_201701.ndjson.gz'), 'rt') as handle:
+				self.assertEqual([{'_id': 1, 'document': 'a', 'datetime': '2017-01-01T10:00:00+00:00'}], [json.loads(line) for line in handle])
+		finally:
+			shutil.rmtree(directory)
+
+
+class FakeCursor(object):
+	
+	def __init__(self, docs):
+		self.docs = docs
+	
+	def sort(self, keys, direction=1):
+		keys = keys if isinstance(keys, list) else [(keys, direction)]
+		return FakeCursor(sorted(self.docs, key=lambda doc: [doc.get(key) for key, direction in keys]))
+	
+	def limit(self, limit):
+		return FakeCursor(self.docs[:limit])
+	
+	def batch_size(self, size):
+		return self
+	
+	def __iter__(self):
+		return iter(self.docs)
+
+
+class FakeCollection(object):
+	
+	def __init__(self, name, db):
+		self.name = name
+		self.db = db
+		self.docs = []
+	
+	def create_index(self, keys, **kwargs):
+		pass
+	
+	def insert_many(self, records, ordered=True):
+		self.db.names.add(self.name)
+		self.docs.extend([dict(record) for record in records])
+	
+	def find(self, query=None, projection=None):
+		return FakeCursor([doc for doc in self.docs if matches(doc, query or {})])
+	
+	def find_one(self, query=None, projection=None):
+		return next(iter(self.find(query, projection)), None)
+	
+	def delete_many(self, query):
+		self.docs = [doc for doc in self.docs if not matches(doc, query)]
+	
+	def bulk_write(self, requests, ordered=True):
+		for req in requests:
+			for doc in self.docs:
+				if matches(doc, req._filter):
+					doc.update(req._doc['$set'])
+	
+	def count(self):
+		return len(self.docs)
+	
+	def drop(self):
+		self.db.names.discard(self.name)
+		self.db.collections.pop(self.name, None)
+
+
+def matches(doc, query):
+	""" Evaluates the subset of Mongo's query language the audit queries
+	use.
+	"""
+	for key, cond in query.items():
+		if '$and' == key:
+			if not all(matches(doc, sub) for sub in cond):
+				return False
+		elif '$or' == key:
+			if not any(matches(doc, sub) for sub in cond):
+				return False
+		elif isinstance(cond, dict):
+			value = doc.get(key)
+			for op, arg in cond.items():
+				if '$exists' == op:
+					ok = (key in doc) == arg
+				elif '$in' == op:
+					ok = value in arg
+				elif '$ne' == op:
+					ok = value != arg
+				elif value is None:
+					ok = False
+				else:
+					ok = {'$gt': value > arg, '$gte': value >= arg, '$lt': value < arg, '$lte': value <= arg}[op]
+				if not ok:
+					return False
+		elif doc.get(key) != cond:
+			return False
+	return True
+
+
+class FakeDB(object):
+	
+	def __init__(self, names):
+		self.names = set(names)
+		self.collections = {}
+	
+	def collection_names(self):
+		return list(self.names)
+	
+	def __getitem__(self, name):
+		if name not in self.collections:
+			self.collections[name] = FakeCollection(name, self)
+		return self.collections[name]
+
+
+class FakeServer(object):
+	
+	def __init__(self, names):
+		self.bucket = 'idm'
+		self.db = FakeDB(names)
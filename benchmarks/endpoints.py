@@ -0,0 +1,323 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+#
+# Runs every endpoint of the app through Flask's test client against an
+# in-memory Mongo (mongomock, see `benchmarks/requirements.txt`) that waits
+# `--latency` milliseconds on every query, like a network round trip would.
+# Records wall time, number of queries and peak allocations per request at
+# every dataset size. Run from the repository root:
+#
+#     python -m benchmarks.endpoints --sizes 100,10000,100000 --save baseline.json
+#     python -m benchmarks.endpoints --sizes 100,10000 --baseline baseline.json
+#
+# With `--baseline` the run exits with status 1 if any endpoint sends more
+# queries than in the baseline, or got slower or allocates more than the
+# tolerances allow, so CI can fail on regressions. Query counts do not depend
+# on the machine; use `--ignore-time` when comparing against a baseline that
+# was recorded elsewhere.
+
+import sys
+import copy
+import json
+import time
+import types
+import argparse
+import functools
+import threading
+import tracemalloc
+
+import pymongo
+import mongomock
+
+
+# MARK: - Storage Stand-In
+
+class QueryCounter(object):
+	""" Wraps the query methods of mongomock's collections to count calls and
+	to sleep `latency` seconds on each. Calls mongomock makes from within
+	another wrapped call count once.
+	"""
+	METHODS = ['find', 'find_one', 'find_one_and_update', 'find_one_and_replace', 'find_one_and_delete',
+		'insert', 'insert_one', 'insert_many', 'save', 'update', 'update_one', 'update_many', 'replace_one',
+		'remove', 'delete_one', 'delete_many', 'bulk_write', 'count', 'count_documents', 'distinct', 'aggregate']
+	
+	def __init__(self, latency=0.0):
+		self.latency = latency
+		self.count = 0
+		self._lock = threading.Lock()
+		self._local = threading.local()
+	
+	def install(self, cls):
+		for name in self.METHODS:
+			original = getattr(cls, name, None)
+			if original is not None:
+				setattr(cls, name, self._wrap(original))
+	
+	def _wrap(self, original):
+		@functools.wraps(original)
+		def wrapper(*args, **kwargs):
+			depth = getattr(self._local, 'depth', 0)
+			if 0 == depth:
+				with self._lock:
+					self.count += 1
+				if self.latency > 0:
+					time.sleep(self.latency)
+			self._local.depth = depth + 1
+			try:
+				return original(*args, **kwargs)
+			finally:
+				self._local.depth = depth
+		return wrapper
+
+
+def load_app(latency):
+	""" Imports the app with benchmark settings, on top of a single shared
+	mongomock client that all Mongo connections use.
+	"""
+	import defaults
+	settings = types.ModuleType('settings')
+	settings.__dict__.update({k: copy.deepcopy(v) for k, v in vars(defaults).items() if not k.startswith('__')})
+	settings.mongo_server = dict(settings.mongo_server, db='idm_benchmark')
+	settings.mail = dict(settings.mail, server=None)
+	settings.audit = dict(settings.audit, mode='sync')          # write audits within the request that causes them
+	settings.passwords = dict(settings.passwords, rounds=4)     # time our code, not bcrypt
+	settings.rate_limit = {'enabled': False}                    # repeated logins would be rejected
+	sys.modules['settings'] = settings
+	
+	counter = QueryCounter(latency)
+	counter.install(mongomock.collection.Collection)
+	client = mongomock.MongoClient()
+	pymongo.MongoClient = lambda *args, **kwargs: client
+	
+	import app
+	return app, counter
+
+
+# MARK: - Dataset
+
+def seed(app, size):
+	""" Fills the database with `size` consented subjects, a link for every
+	tenth of them and an audit for every document, plus an admin user.
+	Returns the JWT to authenticate with.
+	"""
+	from py import storage
+	from py import subject
+	coll = storage.collection(app.mng_srv, app.mng_bkt)
+	coll.delete_many({})
+	now = '2017-01-17T10:06:17.394177+00:00'
+	
+	def batches(docs, size=5000):
+		batch = []
+		for doc in docs:
+			batch.append(doc)
+			if len(batch) >= size:
+				coll.insert_many(batch)
+				batch = []
+		if len(batch) > 0:
+			coll.insert_many(batch)
+	
+	def subjects():
+		for i in range(size):
+			sssid, name, bday = 'ZH{:06d}'.format(i), 'Bruno Mars {}'.format(i), '19{:02d}-06-20'.format(i % 100)
+			yield {'type': 'subject', 'sssid': sssid, 'name': name, 'bday': bday, 'email': 'bruno{}@example.com'.format(i),
+				'date_invited': now, 'date_consented': now, 'created': now, 'changed': now,
+				'_search': subject._search_grams([sssid, name, bday])}
+	batches(subjects())
+	
+	def links():
+		for i in range(0, size, 10):
+			yield {'type': 'link', 'sub': 'ZH{:06d}'.format(i), 'iss': app.settings.jwt['iss'], 'aud': app.settings.jwt['aud'],
+				'secret': app.settings.jwt['secret'], 'algorithm': app.settings.jwt['algorithm'], 'created': now}
+	batches(links())
+	doc_ids = [doc['_id'] for doc in coll.find({}, {'_id': 1})]
+	audits = [{'type': 'audit', 'document': doc_id, 'datetime': now, 'action': 'create'} for doc_id in doc_ids]
+	for i in range(0, len(audits), 5000):
+		app.auditstore.insert_many(app.mng_srv, app.mng_bkt, audits[i:i+5000])
+	
+	app.user.User.create('bench@example.com', 'benchmark-password', True, app.mng_srv, app.mng_bkt)
+	client = app.app.test_client()
+	res = client.post('/auth', data=json.dumps({'username': 'bench@example.com', 'password': 'benchmark-password'}), content_type='application/json')
+	return json.loads(res.get_data(as_text=True))['access_token']
+
+
+# MARK: - Scenarios
+
+class Context(object):
+	""" Hands out fresh SSSIDs, links and tokens so that requests that can
+	only succeed once succeed on every repetition.
+	"""
+	
+	def __init__(self, app, client, token, size):
+		self.app = app
+		self.client = client
+		self.headers = {'Authorization': 'JWT {}'.format(token)}
+		self.size = size
+		self.serial = 0
+	
+	def next_sssid(self):
+		self.serial += 1
+		return 'BM{:06d}'.format(self.serial)
+	
+	def subject(self):
+		return 'ZH{:06d}'.format(self.size // 2 // 10 * 10)
+	
+	def new_link(self):
+		res = self.client.post('/subject/{}/links'.format(self.subject()), headers=self.headers)
+		return json.loads(res.get_data(as_text=True))['data']['_id']
+	
+	def new_token(self):
+		jti = self.new_link()
+		return self.client.get('/link/{}/jwt'.format(jti)).get_data(as_text=True)
+	
+	def etag(self, path):
+		return self.client.get(path, headers=self.headers).headers.get('ETag')
+
+
+def _json(body):
+	return {'data': json.dumps(body), 'content_type': 'application/json'}
+
+# (name, endpoint, function returning method, path and test client keyword
+# arguments); the function's own requests are not measured
+SCENARIOS = [
+	('GET /', 'index', lambda c: ('GET', '/', {})),
+	('GET /status', 'status', lambda c: ('GET', '/status', {})),
+	('GET /status/live', 'status_live', lambda c: ('GET', '/status/live', {})),
+	('GET /metrics', 'metrics_ep', lambda c: ('GET', '/metrics', {})),
+	('POST /auth', 'jwt', lambda c: ('POST', '/auth', _json({'username': 'bench@example.com', 'password': 'benchmark-password'}))),
+	('GET /subject', 'subject_ep', lambda c: ('GET', '/subject?perpage=50', {'headers': c.headers})),
+	('GET /subject?search', 'subject_ep', lambda c: ('GET', '/subject?perpage=50&search=mars%201', {'headers': c.headers})),
+	('GET /subject?offset', 'subject_ep', lambda c: ('GET', '/subject?perpage=50&offset={}&ordercol=name'.format(c.size // 2), {'headers': c.headers})),
+	('POST /subject', 'subject_ep', lambda c: ('POST', '/subject', dict(_json({'sssid': c.next_sssid(), 'name': 'Benchmark', 'bday': '1970-01-01'}), headers=c.headers))),
+	('POST /subject/bulk', 'subject_bulk', lambda c: ('POST', '/subject/bulk', {'headers': c.headers, 'content_type': 'application/x-ndjson',
+		'data': '\n'.join(json.dumps({'sssid': c.next_sssid(), 'name': 'Benchmark', 'bday': '1970-01-01'}) for i in range(100))})),
+	('GET /subject/<sssid>', 'subject_sssid', lambda c: ('GET', '/subject/{}'.format(c.subject()), {'headers': c.headers})),
+	('GET /subject/<sssid> 304', 'subject_sssid', lambda c: ('GET', '/subject/{}'.format(c.subject()),
+		{'headers': dict(c.headers, **{'If-None-Match': c.etag('/subject/{}'.format(c.subject()))})})),
+	('PUT /subject/<sssid>', 'subject_sssid', lambda c: ('PUT', '/subject/{}'.format(c.subject()), dict(_json({'sssid': c.subject(), 'email': 'bruno@example.com'}), headers=c.headers))),
+	('POST /link/bulk', 'link_bulk', lambda c: ('POST', '/link/bulk', dict(_json({'sssids': ['ZH{:06d}'.format(i) for i in range(min(50, c.size))], 'jwt': True}), headers=c.headers))),
+	('GET /link/<jti>/jwt', 'link_jti_jwt', lambda c: ('GET', '/link/{}/jwt'.format(c.new_link()), {})),
+	('POST /establish', 'establish_ep', lambda c: ('POST', '/establish', dict(_json({'resourceType': 'Patient', 'identifier': [{'system': 'org.c3-pro', 'value': c.next_sssid()}]}),
+		headers={'Authorization': 'Bearer {}'.format(c.new_token())}))),
+	('GET /link/<jti>', 'link_jti', lambda c: ('GET', '/link/{}'.format(c.new_link()), {'headers': c.headers})),
+	('GET /subject/<sssid>/links', 'subject_sssid_link', lambda c: ('GET', '/subject/{}/links'.format(c.subject()), {'headers': c.headers})),
+	('POST /subject/<sssid>/links', 'subject_sssid_link', lambda c: ('POST', '/subject/{}/links'.format(c.subject()), {'headers': c.headers})),
+	('GET /subject/<sssid>/audits', 'subject_sssid_audits', lambda c: ('GET', '/subject/{}/audits'.format(c.subject()), {'headers': c.headers})),
+	('GET /export/links', 'export_kind', lambda c: ('GET', '/export/links', {'headers': c.headers})),
+	('GET /iforgot', 'iforgot_ep', lambda c: ('GET', '/iforgot', {})),
+	('GET /reset', 'reset_ep', lambda c: ('GET', '/reset?k=benchmark', {})),
+	('GET /init', 'init_ep', lambda c: ('GET', '/init', {})),
+	('POST /user', 'user_ep', lambda c: ('POST', '/user', dict(_json({'username': '{}@example.com'.format(c.next_sssid()), 'password': 'benchmark-password'}), headers=c.headers))),
+	('GET /user/<uid>', 'user_uid', lambda c: ('GET', '/user/bench@example.com', {'headers': c.headers})),
+]
+
+
+def measure(ctx, counter, scenario, repeat):
+	""" Runs the scenario once to warm up, `repeat` times to time it and
+	count queries, and once more with tracemalloc to find the peak of
+	memory allocated while handling the request.
+	"""
+	name, endpoint, prepare = scenario
+	
+	def run():
+		method, path, kwargs = prepare(ctx)
+		before = counter.count
+		start = time.perf_counter()
+		res = ctx.client.open(path, method=method, **kwargs)
+		res.get_data()
+		elapsed = time.perf_counter() - start
+		if res.status_code >= 400:
+			raise Exception("{} failed with status {}: {}".format(name, res.status_code, res.get_data(as_text=True)[:200]))
+		if 'application/x-ndjson' == res.mimetype:
+			for line in res.get_data(as_text=True).splitlines():
+				if line.strip() and json.loads(line).get('status', 0) >= 400:
+					raise Exception("{} failed for a row: {}".format(name, line[:200]))
+		return elapsed, counter.count - before
+	
+	run()
+	timings = []
+	queries = 0
+	for i in range(repeat):
+		elapsed, count = run()
+		timings.append(elapsed)
+		queries = max(queries, count)
+	timings.sort()
+	
+	method, path, kwargs = prepare(ctx)
+	tracemalloc.start()
+	ctx.client.open(path, method=method, **kwargs).get_data()
+	current, peak = tracemalloc.get_traced_memory()
+	tracemalloc.stop()
+	
+	return {
+		'ms': round(timings[len(timings) // 2] * 1000, 3),
+		'queries': queries,
+		'alloc_kb': round(peak / 1024, 1),
+	}
+
+
+# MARK: - Baseline
+
+def compare(results, baseline, time_tolerance, alloc_tolerance, ignore_time=False):
+	""" Returns a list of regressions against the baseline; sizes and
+	scenarios missing from either side are skipped.
+	"""
+	regressions = []
+	for size, scenarios in results.items():
+		for name, now in scenarios.items():
+			then = baseline.get('results', {}).get(size, {}).get(name)
+			if then is None:
+				continue
+			if now['queries'] > then['queries']:
+				regressions.append("{} @ {}: {} queries, was {}".format(name, size, now['queries'], then['queries']))
+			if not ignore_time and now['ms'] > then['ms'] * (1 + time_tolerance) + 1:
+				regressions.append("{} @ {}: {} ms, was {} ms".format(name, size, now['ms'], then['ms']))
+			if now['alloc_kb'] > then['alloc_kb'] * (1 + alloc_tolerance) + 64:
+				regressions.append("{} @ {}: {} KiB allocated, was {} KiB".format(name, size, now['alloc_kb'], then['alloc_kb']))
+	return regressions
+
+
+if '__main__' == __name__:
+	parser = argparse.ArgumentParser(description="Benchmark all endpoints against an in-memory Mongo with simulated latency")
+	parser.add_argument('--sizes', default='100,10000,100000', help="comma-separated numbers of subjects")
+	parser.add_argument('--latency', type=float, default=1.0, help="milliseconds to wait on every query")
+	parser.add_argument('--repeat', type=int, default=5)
+	parser.add_argument('--only', help="run only scenarios whose name contains this")
+	parser.add_argument('--save', help="write the results to this baseline file")
+	parser.add_argument('--baseline', help="compare against this baseline file, exit with 1 on regressions")
+	parser.add_argument('--time-tolerance', type=float, default=0.5, help="allowed relative slowdown")
+	parser.add_argument('--alloc-tolerance', type=float, default=0.25, help="allowed relative growth of allocations")
+	parser.add_argument('--ignore-time', action='store_true', help="do not compare wall times")
+	args = parser.parse_args()
+	
+	app, counter = load_app(args.latency / 1000)
+	scenarios = [s for s in SCENARIOS if not args.only or args.only in s[0]]
+	covered = set([s[1] for s in SCENARIOS])
+	for rule in app.app.url_map.iter_rules():
+		if rule.endpoint not in covered and 'static' != rule.endpoint:
+			print("no scenario for endpoint “{}” ({})".format(rule.endpoint, rule.rule), file=sys.stderr)
+	
+	results = {}
+	for size in [int(s) for s in args.sizes.split(',')]:
+		print("seeding {} subjects".format(size), file=sys.stderr)
+		ctx = Context(app, app.app.test_client(), seed(app, size), size)
+		results[str(size)] = {}
+		print("{:>8} {:<32} {:>10} {:>8} {:>10}".format('subjects', 'request', 'ms', 'queries', 'alloc KiB'))
+		for scenario in scenarios:
+			result = measure(ctx, counter, scenario, args.repeat)
+			results[str(size)][scenario[0]] = result
+			print("{:>8} {:<32} {:>10.3f} {:>8} {:>10.1f}".format(size, scenario[0], result['ms'], result['queries'], result['alloc_kb']))
+	
+	if args.save:
+		with open(args.save, 'w') as handle:
+			json.dump({'latency_ms': args.latency, 'results': results}, handle, indent=2, sort_keys=True)
+	
+	if args.baseline:
+		with open(args.baseline) as handle:
+			baseline = json.load(handle)
+		if baseline.get('latency_ms') != args.latency:
+			print("baseline was recorded with {} ms latency, not comparing wall times".format(baseline.get('latency_ms')), file=sys.stderr)
+		regressions = compare(results, baseline, args.time_tolerance, args.alloc_tolerance,
+			ignore_time=args.ignore_time or baseline.get('latency_ms') != args.latency)
+		for regression in regressions:
+			print("REGRESSION {}".format(regression))
+		sys.exit(1 if len(regressions) > 0 else 0)
@@ -0,0 +1,64 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+#
+# Measures password verification latency and throughput, i.e. the bcrypt
+# work behind every `/auth` request, at increasing numbers of concurrent
+# clients. Run from the repository root:
+#
+#     python -m benchmarks.passwords --rounds 12 --requests 40
+
+import time
+import argparse
+import threading
+
+from py.passwords import PasswordHasher
+from py.idmexception import IDMException
+
+
+def run(hasher, hashed, clients, requests):
+	latencies = []
+	rejected = [0]
+	lock = threading.Lock()
+	
+	def client(count):
+		for i in range(count):
+			start = time.monotonic()
+			try:
+				hasher.verify('correct horse battery', hashed)
+				with lock:
+					latencies.append(time.monotonic() - start)
+			except IDMException:
+				with lock:
+					rejected[0] += 1
+	
+	per_client = max(1, requests // clients)
+	threads = [threading.Thread(target=client, args=(per_client,)) for i in range(clients)]
+	start = time.monotonic()
+	[t.start() for t in threads]
+	[t.join() for t in threads]
+	elapsed = time.monotonic() - start
+	
+	latencies.sort()
+	p50 = latencies[len(latencies) // 2] * 1000 if latencies else None
+	p95 = latencies[int(len(latencies) * 0.95) - 1] * 1000 if latencies else None
+	return len(latencies) / elapsed, p50, p95, rejected[0]
+
+
+if '__main__' == __name__:
+	parser = argparse.ArgumentParser(description="Benchmark bcrypt password verification")
+	parser.add_argument('--rounds', type=int, default=12)
+	parser.add_argument('--workers', type=int, default=2)
+	parser.add_argument('--pending', type=int, default=4)
+	parser.add_argument('--wait', type=float, default=0.5)
+	parser.add_argument('--requests', type=int, default=40)
+	args = parser.parse_args()
+	
+	hasher = PasswordHasher(rounds=args.rounds, max_workers=args.workers, max_pending=args.pending, wait=args.wait)
+	hashed = hasher.hash('correct horse battery')
+	print("{:>8} {:>10} {:>10} {:>10} {:>9}".format('clients', 'logins/s', 'p50 ms', 'p95 ms', 'rejected'))
+	for clients in [1, 2, 4, 8, 16]:
+		rate, p50, p95, rejected = run(hasher, hashed, clients, args.requests)
+		print("{:>8} {:>10.1f} {:>10} {:>10} {:>9}".format(clients, rate,
+			'{:.1f}'.format(p50) if p50 is not None else '-',
+			'{:.1f}'.format(p95) if p95 is not None else '-',
+			rejected))
@@ -0,0 +1,71 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+#
+# Compares serializing subject pages and audit lists the way we used to,
+# copying every document with `for_api()` and handing the list to `jsonify()`
+# (pretty-printed, sorted keys, pure-Python `BSONEncoder`), with the
+# `serializer` module's streamed lists on each installed backend. Run from
+# the repository root:
+#
+#     python -m benchmarks.serializer --subjects 50 --audits 2000
+
+import json
+import time
+import argparse
+from bson import ObjectId
+
+from py import serializer
+
+
+class BSONEncoder(json.JSONEncoder):
+	def default(self, o):
+		if isinstance(o, ObjectId):
+			return str(o)
+		return json.JSONEncoder.default(self, o)
+
+def subject(i):
+	return {'_id': ObjectId(), 'type': 'subject', 'sssid': 'ZH{:05d}'.format(i), 'name': 'Bruno Mars {}'.format(i),
+		'bday': '1953-06-20', 'email': 'bruno{}@example.com'.format(i), 'date_invited': '2017-01-17T10:06:17.394177+00:00',
+		'date_consented': '2017-01-18T10:06:17.394177+00:00', 'created': '2017-01-17T10:06:17.394177+00:00',
+		'changed': '2017-01-18T10:06:17.394177+00:00', '_search': ['b', 'br', 'bru', 'r', 'ru', 'run', 'u', 'un', 'uno']}
+
+def audit(i):
+	return {'_id': ObjectId(), 'type': 'audit', 'document': ObjectId(), 'datetime': '2017-01-17T10:06:17.394177+00:00',
+		'action': 'update', 'actor_id': ObjectId(), 'actor': 'admin@example.com'}
+
+def for_api(doc, omit):
+	return {k: v for k, v in doc.items() if k not in omit}
+
+def old_path(docs, omit):
+	return json.dumps({'data': [for_api(doc, omit) for doc in docs]}, cls=BSONEncoder, indent=2, separators=(', ', ': '), sort_keys=True)
+
+def new_path(docs, omit):
+	return ''.join(serializer.stream_list(docs, lambda doc: for_api(doc, omit)))
+
+def measure(func, docs, omit, repeat):
+	start = time.perf_counter()
+	for i in range(repeat):
+		size = len(func(docs, omit))
+	return (time.perf_counter() - start) / repeat * 1000, size
+
+
+if '__main__' == __name__:
+	parser = argparse.ArgumentParser(description="Benchmark JSON serialization of API responses")
+	parser.add_argument('--subjects', type=int, default=50)
+	parser.add_argument('--audits', type=int, default=2000)
+	parser.add_argument('--repeat', type=int, default=200)
+	args = parser.parse_args()
+	
+	cases = [
+		('subjects', [subject(i) for i in range(args.subjects)], ['_id', 'type', '_search']),
+		('audits', [audit(i) for i in range(args.audits)], ['type']),
+	]
+	backends = [b for b in serializer.BACKENDS if 'orjson' != b or serializer.orjson is not None]
+	print("{:>10} {:>18} {:>10} {:>10}".format('response', 'path', 'ms', 'bytes'))
+	for name, docs, omit in cases:
+		ms, size = measure(old_path, docs, omit, args.repeat)
+		print("{:>10} {:>18} {:>10.3f} {:>10}".format(name, 'jsonify', ms, size))
+		for backend in backends:
+			serializer.use(backend)
+			ms, size = measure(new_path, docs, omit, args.repeat)
+			print("{:>10} {:>18} {:>10.3f} {:>10}".format(name, 'stream ' + backend, ms, size))
@@ -0,0 +1,34 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+
+import unittest
+from bson import ObjectId
+from py import cursor
+from py.idmexception import IDMException
+
+
+class CursorTests(unittest.TestCase):
+	
+	def testRoundTrip(self):
+		oid = ObjectId()
+		cur = cursor.encode('name', True, 'Bruno Mars', oid)
+		self.assertEqual(('Bruno Mars', oid), cursor.decode(cur, 'name', True))
+	
+	def testInvalid(self):
+		with self.assertRaises(IDMException) as cm:
+			cursor.decode('not-a-cursor', 'name', False)
+		self.assertEqual(cm.exception.status_code, 400)
+		
+		cur = cursor.encode('name', False, 'Bruno Mars', ObjectId())
+		with self.assertRaises(IDMException):
+			cursor.decode(cur, 'sssid', False)
+		with self.assertRaises(IDMException):
+			cursor.decode(cur, 'name', True)
+	
+	def testKeysetQuery(self):
+		oid = ObjectId()
+		self.assertEqual({'_id': {'$gt': oid}}, cursor.keyset_query('_id', False, oid, oid))
+		self.assertEqual({'$or': [{'name': {'$gt': 'A'}}, {'name': 'A', '_id': {'$gt': oid}}]}, cursor.keyset_query('name', False, 'A', oid))
+		self.assertEqual({'$or': [{'name': {'$lt': 'A'}}, {'name': 'A', '_id': {'$lt': oid}}, {'name': None}]}, cursor.keyset_query('name', True, 'A', oid))
+		self.assertEqual({'$or': [{'name': None, '_id': {'$gt': oid}}, {'name': {'$ne': None}}]}, cursor.keyset_query('name', False, None, oid))
+		self.assertEqual({'name': None, '_id': {'$lt': oid}}, cursor.keyset_query('name', True, None, oid))
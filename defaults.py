@@ -6,7 +6,15 @@
 # Admin's email address - also used on password reset emails
 admin_email = 'webmaster@c3-pro-idm.org'
 
-# Mongo Server; leave host/port/db at None for default localhost connection
+# Mongo Server; leave host/port/db at None for default localhost connection.
+# With `ensure_indexes` the app creates missing indexes on the first request
+# of every worker; you can also run `FLASK_APP=app.py flask ensure-indexes`.
+# Every worker process has its own connection pool of up to `max_pool_size`
+# connections, hence Mongo sees up to workers x `max_pool_size` connections.
+# Requests waiting longer than `wait_queue_timeout_ms` for a connection, or
+# `server_selection_timeout_ms` for a reachable server, get a 503. Pooled
+# connections idle for `max_idle_time_ms` are closed. Set any of these to
+# None to use the driver's default.
 mongo_server = {
 	'host': None,
 	'port': None,
@@ -14,8 +22,20 @@ mongo_server = {
 	'user': None,
 	'password': None,
 	'bucket': 'c3pro_idm',
+	'ensure_indexes': True,
+	'max_pool_size': 10,
+	'min_pool_size': 0,
+	'wait_queue_timeout_ms': 2000,
+	'server_selection_timeout_ms': 5000,
+	'connect_timeout_ms': 5000,
+	'socket_timeout_ms': 30000,
+	'max_idle_time_ms': 60000,
 }
 
+# The JSON encoder for API responses: "auto" uses orjson if it is installed and
+# the standard library's encoder otherwise; "json" forces the latter.
+json_backend = 'auto'
+
 # Settings for the JWT to be issued to the app
 jwt = {
 	'iss': 'https://idm.c3-pro.io/',
@@ -25,11 +45,79 @@ jwt = {
 	'algorithm': 'HS256',
 }
 
-# Mailer settings; set server to "None" to not support
+# Per-process cache of the users making JWT-authenticated requests. Writes to
+# a user invalidate the entry in the same worker, other workers pick up a
+# deleted user or revoked admin flag after at most `ttl_seconds`. Set
+# `max_size` to 0 to disable.
+identity_cache = {
+	'max_size': 1000,
+	'ttl_seconds': 60,
+}
+
+# Audit writing. Mode "sync" writes every audit together with the document it
+# belongs to. With mode "buffered" audits are queued in memory and written
+# with bulk inserts every `batch_size` audits or `flush_seconds`, whichever
+# comes first, and appear with that delay; audits still queued are lost if a
+# worker is killed. Once `max_queue` audits are waiting, requests write their
+# audits directly again.
+# Audits are stored in one collection per month. `FLASK_APP=app.py flask
+# archive-audits` moves the months older than `archive_after_months` into
+# gzipped NDJSON files in `archive_dir`; run it e.g. monthly from cron.
+audit = {
+	'mode': 'sync',
+	'batch_size': 100,
+	'flush_seconds': 1.0,
+	'max_queue': 10000,
+	'archive_after_months': 24,
+	'archive_dir': 'audit-archive',
+}
+
+# Health probes of the mail server and database reported on /status run in
+# the background every `interval_seconds`
+health = {
+	'interval_seconds': 30,
+	'timeout_seconds': 5,
+}
+
+# Password hashing with bcrypt. Hashes with a different cost factor than
+# `rounds` are rehashed on the user's next successful login. Requests that
+# have to wait longer than `wait_seconds` because `max_pending` hashing
+# operations are underway are rejected with a 503. `max_pending` counts
+# across all workers on the host, which share lock files in `slot_dir`, by
+# default in the temporary directory.
+passwords = {
+	'rounds': 12,
+	'max_workers': 2,
+	'max_pending': 4,
+	'wait_seconds': 0.5,
+	'slot_dir': None,
+}
+
+# Rate limiting of the endpoints that can be called without a JWT: POST to
+# /auth, /iforgot and /establish. Every client IP and every username gets a
+# bucket of `burst` requests per endpoint that refills at `rate` requests
+# per second; requests finding it empty get a 429. The buckets are shared by
+# all workers through the SQLite file at `database`, by default in the
+# temporary directory. The client IP is taken from nginx's `X-Real-IP` only
+# for requests coming from one of the `trusted_proxies`, by default the local
+# nginx of `nginx-site.c3-pro-idm`.
+rate_limit = {
+	'enabled': True,
+	'database': None,
+	'trusted_proxies': ['127.0.0.1', '::1'],
+	'ip_rate': 1.0,
+	'ip_burst': 20,
+	'username_rate': 0.1,
+	'username_burst': 5,
+}
+
+# Mailer settings; set server to "None" to not support. Set `starttls` to
+# False (and username/password to None) to use a local debugging server.
 mail = {
 	'server': 'smtp.gmail.com',
 	'port': 587,
 	'username': 'hello@gmail.com',
 	'password': 'o6k8b7ip-a',
+	'starttls': True,
 }
 
@@ -0,0 +1,31 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+
+import unittest
+from bson import ObjectId
+from py import etag
+
+
+class ETagTests(unittest.TestCase):
+	
+	def testValidators(self):
+		oid = ObjectId()
+		doc = {'_id': oid, 'sssid': 'ZH001', 'created': '2017-01-17T10:00:00+00:00', 'changed': '2017-01-18T10:00:00+00:00'}
+		tag, modified = etag.validators([doc])
+		self.assertEqual('2017-01-18T10:00:00+00:00', modified.isoformat())
+		
+		# projections give the same tag as full documents
+		self.assertEqual(tag, etag.validators([{'_id': oid, 'changed': doc['changed'], 'created': doc['created']}])[0])
+		
+		# new version, other order or other query give a new tag
+		self.assertNotEqual(tag, etag.validators([dict(doc, changed='2017-01-19T10:00:00+00:00')])[0])
+		other = {'_id': ObjectId(), 'created': 1484646794}
+		self.assertNotEqual(etag.validators([doc, other])[0], etag.validators([other, doc])[0])
+		self.assertNotEqual(tag, etag.validators([doc], b'perpage=10')[0])
+	
+	def testVersions(self):
+		self.assertEqual('B', etag.version_of({'created': 'A', 'changed': 'B'}))
+		self.assertEqual('A', etag.version_of({'created': 'A'}))
+		self.assertEqual('C', etag.version_of({'datetime': 'C'}))
+		self.assertIsNone(etag.version_of({}))
+		self.assertIsNone(etag.validators([{'_id': 'x'}])[1])
@@ -0,0 +1,43 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+
+import json
+import unittest
+from bson import ObjectId
+from py import export
+from py.idmexception import IDMException
+
+
+class ExportTests(unittest.TestCase):
+	
+	def testNDJSON(self):
+		oid = ObjectId()
+		docs = [{'_id': oid, 'sub': 'ZH001', 'secret': 'xyz'}, {'_id': oid, 'sub': 'ZH002'}, {'_id': oid, 'sub': 'ZH003'}]
+		chunks = list(export._ndjson_chunks(iter(docs), ['secret'], 2))
+		self.assertEqual(2, len(chunks))
+		lines = ''.join(chunks).splitlines()
+		self.assertEqual({'_id': str(oid), 'sub': 'ZH001'}, json.loads(lines[0]))
+		self.assertEqual(3, len(lines))
+	
+	def testCSV(self):
+		docs = [{'sssid': 'ZH001', 'name': 'Bruno Mars'}, {'sssid': 'ZH002', 'name': 'Mars, Bruno'}]
+		chunks = list(export._csv_chunks(iter(docs), ['sssid', 'name', 'bday'], 1))
+		self.assertEqual(['sssid,name,bday', 'ZH001,Bruno Mars,', 'ZH002,"Mars, Bruno",'], ''.join(chunks).splitlines())
+	
+	def testTimeQuery(self):
+		self.assertEqual({}, export._time_query(['changed'], None, None))
+		self.assertEqual({'changed': {'$gte': 'a'}}, export._time_query(['changed'], 'a', None))
+		self.assertEqual({'$or': [
+				{'changed': {'$lt': 'b'}},
+				{'changed': {'$exists': False}, 'created': {'$lt': 'b'}},
+			]}, export._time_query(['changed', 'created'], None, 'b'))
+		self.assertEqual('2017-01-17T09:00:00+00:00', export._timestamp('2017-01-17T10:00:00+01:00', 'since'))
+		with self.assertRaises(IDMException):
+			export._timestamp('yesterday', 'since')
+	
+	def testInvalidArguments(self):
+		with self.assertRaises(IDMException) as cm:
+			export.export('users', None)
+		self.assertEqual(404, cm.exception.status_code)
+		with self.assertRaises(IDMException):
+			export.export('subjects', None, fmt='xml')
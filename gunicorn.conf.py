@@ -0,0 +1,26 @@
+# -*- coding: utf-8 -*-
+#
+# gunicorn configuration that aggregates the Prometheus metrics served on
+# `/metrics` over all workers. Run with:
+#
+#     prometheus_multiproc_dir=/tmp/idm-metrics gunicorn -c gunicorn.conf.py app:app
+#
+# The directory is emptied when gunicorn starts.
+
+import os
+import glob
+
+bind = '0.0.0.0:9096'
+workers = 5
+
+
+def on_starting(server):
+	path = os.environ.get('prometheus_multiproc_dir')
+	if path:
+		os.makedirs(path, exist_ok=True)
+		for stale in glob.glob(os.path.join(path, '*.db')):
+			os.remove(stale)
+
+def child_exit(server, worker):
+	from py import metrics
+	metrics.mark_process_dead(worker.pid)
@@ -0,0 +1,38 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+
+import time
+import unittest
+import threading
+from py.health import HealthMonitor
+
+
+class HealthTests(unittest.TestCase):
+	
+	def testPending(self):
+		monitor = HealthMonitor({'db': lambda: None})
+		self.assertEqual('pending', monitor.report()['db']['status'])
+	
+	def testResults(self):
+		def failing():
+			raise Exception("connection refused")
+		monitor = HealthMonitor({'db': lambda: None, 'mail': failing})
+		monitor.run_once()
+		report = monitor.report()
+		self.assertEqual('ok', report['db']['status'])
+		self.assertIsNotNone(report['db']['latency_ms'])
+		self.assertIsNotNone(report['db']['age_seconds'])
+		self.assertEqual('connection refused', report['mail']['status'])
+	
+	def testTimeout(self):
+		release = threading.Event()
+		monitor = HealthMonitor({'mail': lambda: release.wait(5)}, timeout=0.05)
+		start = time.monotonic()
+		monitor.run_once()
+		self.assertLess(time.monotonic() - start, 1)
+		self.assertTrue(monitor.report()['mail']['status'].startswith('timed out'))
+		
+		# the hung probe is not started a second time
+		monitor.run_once()
+		self.assertTrue(monitor.report()['mail']['status'].startswith('probe still running'))
+		release.set()
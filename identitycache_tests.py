@@ -0,0 +1,46 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+
+import unittest
+from py.identitycache import IdentityCache
+
+
+class IdentityCacheTests(unittest.TestCase):
+	
+	def setUp(self):
+		self.now = 1000.0
+		self.cache = IdentityCache(max_size=2, ttl=60, clock=lambda: self.now)
+	
+	def testHitsAndMisses(self):
+		self.assertIsNone(self.cache.get('a'))
+		self.cache.put('a', 'user-a')
+		self.assertEqual('user-a', self.cache.get('a'))
+		self.assertEqual(1, self.cache.stats()['hits'])
+		self.assertEqual(1, self.cache.stats()['misses'])
+	
+	def testExpiry(self):
+		self.cache.put('a', 'user-a')
+		self.now += 59
+		self.assertEqual('user-a', self.cache.get('a'))
+		self.now += 2
+		self.assertIsNone(self.cache.get('a'))
+		self.assertEqual(0, self.cache.stats()['size'])
+	
+	def testBounded(self):
+		self.cache.put('a', 'user-a')
+		self.cache.put('b', 'user-b')
+		self.cache.get('a')
+		self.cache.put('c', 'user-c')
+		self.assertEqual('user-a', self.cache.get('a'))
+		self.assertIsNone(self.cache.get('b'))
+		self.assertEqual('user-c', self.cache.get('c'))
+	
+	def testInvalidate(self):
+		self.cache.put('a', 'user-a')
+		self.cache.invalidate('a')
+		self.assertIsNone(self.cache.get('a'))
+	
+	def testDisabled(self):
+		cache = IdentityCache(max_size=0)
+		cache.put('a', 'user-a')
+		self.assertIsNone(cache.get('a'))
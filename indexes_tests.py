@@ -0,0 +1,97 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+
+import unittest
+from pymongo.errors import OperationFailure
+from py import indexes
+from py import auditstore
+
+
+class IndexesTests(unittest.TestCase):
+	
+	def testCreatesMissing(self):
+		srv = FakeServer({'_id_': {}, 'subject_sssid': {'unique': True}})
+		created = indexes.ensure_indexes(srv)
+		self.assertEqual([spec['name'] for spec in indexes.INDEXES if 'subject_sssid' != spec['name']], created)
+		self.assertEqual(created, [options['name'] for keys, options in srv.coll.created])
+		
+		options = dict(srv.coll.created[created.index('user_username')][1])
+		self.assertTrue(options['unique'])
+		self.assertEqual({'type': 'user'}, options['partialFilterExpression'])
+	
+	def testContinuesAfterFailure(self):
+		srv = FakeServer({'_id_': {}}, failing=['subject_sssid'])
+		created = indexes.ensure_indexes(srv)
+		self.assertNotIn('subject_sssid', created)
+		self.assertEqual(len(indexes.INDEXES) - 1, len(created))
+	
+	def testDropsObsolete(self):
+		existing = {'_id_': {}}
+		existing.update({spec['name']: {} for spec in indexes.INDEXES})
+		existing.update({name: {} for name in indexes.OBSOLETE_INDEXES})
+		srv = FakeServer(existing)
+		self.assertEqual([], indexes.ensure_indexes(srv))
+		self.assertEqual(indexes.OBSOLETE_INDEXES, srv.coll.dropped)
+	
+	def testKeepsAuditIndexUntilMigrated(self):
+		auditstore._drained.clear()
+		existing = {'_id_': {}}
+		existing.update({name: {} for name in indexes.OBSOLETE_INDEXES})
+		srv = FakeServer(existing)
+		srv.coll.docs.append({'type': 'audit'})
+		indexes.ensure_indexes(srv)
+		self.assertEqual(['link_jwt'], srv.coll.dropped)
+		
+		srv.coll.docs = []
+		indexes.ensure_indexes(srv)
+		self.assertEqual(['link_jwt', 'audit_document_datetime'], srv.coll.dropped)
+	
+	def testWithoutCollection(self):
+		self.assertEqual([], indexes.ensure_indexes(object()))
+		self.assertFalse(indexes.has_unique_index(object(), None, 'subject_sssid'))
+	
+	def testHasUniqueIndex(self):
+		indexes._unique.clear()
+		srv = FakeServer({'_id_': {}, 'subject_sssid': {'unique': True}, 'subject_search': {}})
+		self.assertTrue(indexes.has_unique_index(srv, None, 'subject_sssid'))
+		self.assertFalse(indexes.has_unique_index(srv, None, 'subject_search'))
+		self.assertFalse(indexes.has_unique_index(srv, None, 'user_username'))
+		
+		indexes.ensure_indexes(srv)
+		self.assertTrue(srv.coll.existing['user_username']['unique'])
+		self.assertTrue(indexes.has_unique_index(srv, None, 'user_username'))
+
+
+class FakeCollection(object):
+	
+	def __init__(self, existing, failing):
+		self.name = 'idm'
+		self.existing = existing
+		self.failing = failing
+		self.created = []
+		self.dropped = []
+		self.docs = []
+	
+	def index_information(self):
+		return dict(self.existing)
+	
+	def create_index(self, keys, **options):
+		if options['name'] in self.failing:
+			raise OperationFailure("E11000 duplicate key error")
+		self.created.append((keys, options))
+		self.existing[options['name']] = options
+	
+	def find_one(self, query, projection=None):
+		return next((doc for doc in self.docs if all(doc.get(k) == v for k, v in query.items())), None)
+	
+	def drop_index(self, name):
+		self.dropped.append(name)
+		del self.existing[name]
+
+
+class FakeServer(object):
+	
+	def __init__(self, existing, failing=None):
+		self.bucket = 'idm'
+		self.coll = FakeCollection(existing, failing or [])
+		self.db = {'idm': self.coll}
@@ -0,0 +1,79 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+
+import smtplib
+import unittest
+from py import mailer
+
+
+class MailerTests(unittest.TestCase):
+	
+	def setUp(self):
+		FakeSMTP.instances = []
+		self.mailer = mailer.Mailer('idm@c3-pro.io', 'secret', 'localhost', 1025, retry_delay=0)
+		self.mailer.smtp_class = FakeSMTP
+	
+	def testReusesConnection(self):
+		self.mailer.send_mail('a@c3-pro.io', "Hi", "Hello")
+		self.mailer.send_mail('b@c3-pro.io', "Hi", "Hello")
+		self.assertEqual(1, len(FakeSMTP.instances))
+		smtp = FakeSMTP.instances[0]
+		self.assertTrue(smtp.tls)
+		self.assertEqual(('idm@c3-pro.io', 'secret'), smtp.credentials)
+		self.assertEqual(['a@c3-pro.io', 'b@c3-pro.io'], [to for to, msg in smtp.sent])
+	
+	def testReconnects(self):
+		self.mailer.send_mail('a@c3-pro.io', "Hi", "Hello")
+		FakeSMTP.instances[0].connected = False
+		self.mailer.send_mail('b@c3-pro.io', "Hi", "Hello")
+		self.assertEqual(2, len(FakeSMTP.instances))
+		self.assertEqual(['b@c3-pro.io'], [to for to, msg in FakeSMTP.instances[1].sent])
+	
+	def testQueueRetries(self):
+		FakeSMTP.refuse = 2
+		self.mailer.queue_mail('a@c3-pro.io', "Hi", "Hello")
+		self.mailer.close()
+		sent = [to for smtp in FakeSMTP.instances for to, msg in smtp.sent]
+		self.assertEqual(['a@c3-pro.io'], sent)
+	
+	def testNotConfigured(self):
+		self.mailer.server = None
+		with self.assertRaises(Exception):
+			self.mailer.queue_mail('a@c3-pro.io', "Hi", "Hello")
+
+
+class FakeSMTP(object):
+	instances = []
+	refuse = 0
+	
+	def __init__(self, host, port, timeout=None):
+		if FakeSMTP.refuse > 0:
+			FakeSMTP.refuse -= 1
+			raise ConnectionRefusedError("refused")
+		self.connected = True
+		self.tls = False
+		self.credentials = None
+		self.sent = []
+		FakeSMTP.instances.append(self)
+	
+	def ehlo(self):
+		pass
+	
+	def starttls(self):
+		self.tls = True
+	
+	def login(self, user, password):
+		self.credentials = (user, password)
+	
+	def noop(self):
+		if not self.connected:
+			raise smtplib.SMTPServerDisconnected()
+		return (250, b'OK')
+	
+	def sendmail(self, sender, to, msg):
+		if not self.connected:
+			raise smtplib.SMTPServerDisconnected()
+		self.sent.append((to, msg))
+	
+	def quit(self):
+		self.connected = False
@@ -0,0 +1,30 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+
+import threading
+import unittest
+from unittest import mock
+from py import metrics
+
+
+class MetricsTests(unittest.TestCase):
+	
+	def testDBCallsPerThread(self):
+		listener = metrics.DBCallListener()
+		listener.begin()
+		listener.succeeded(mock.Mock(command_name='find', duration_micros=1500))
+		listener.failed(mock.Mock(command_name='insert', duration_micros=500))
+		
+		# commands of other threads, e.g. the audit sink's, are not counted
+		other = threading.Thread(target=listener.succeeded, args=(mock.Mock(command_name='insert', duration_micros=9000),))
+		other.start()
+		other.join()
+		
+		self.assertEqual((2, 0.002), listener.end())
+		self.assertEqual((0, 0.0), listener.end())
+	
+	def testRender(self):
+		metrics.DB_COMMAND_SECONDS.labels('find').observe(0.01)
+		body, content_type = metrics.render()
+		self.assertTrue(content_type.startswith('text/plain'))
+		self.assertIn(b'idm_db_command_duration_seconds_count{command="find"}', body)
@@ -0,0 +1,48 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+
+import unittest
+from unittest import mock
+from pymongo import uri_parser
+from py import mongopool
+
+
+class MongoPoolTests(unittest.TestCase):
+	
+	def testURI(self):
+		settings = {'max_pool_size': 10, 'wait_queue_timeout_ms': 2000, 'max_idle_time_ms': None}
+		uri = mongopool.mongo_uri(None, None, settings)
+		self.assertEqual('mongodb://localhost:27017/?maxPoolSize=10&waitQueueTimeoutMS=2000&connect=false', uri)
+		self.assertEqual([('localhost', 27017)], uri_parser.parse_uri(uri)['nodelist'])
+		self.assertEqual('mongodb://db.example.com:27018/?connect=false', mongopool.mongo_uri('db.example.com', 27018, {}))
+		self.assertEqual('mongodb://a,b/?replicaSet=rs&maxPoolSize=10&waitQueueTimeoutMS=2000&connect=false', mongopool.mongo_uri('mongodb://a,b/?replicaSet=rs', None, settings))
+		self.assertEqual('mongodb://a/?connect=false', mongopool.mongo_uri('mongodb://a', None, {}))
+	
+	def testLazyPerProcess(self):
+		servers = []
+		def factory():
+			servers.append(mock.Mock(db='db{}'.format(len(servers))))
+			return servers[-1]
+		pool = mongopool.MongoPool(factory)
+		self.assertEqual(0, len(servers))
+		self.assertFalse(pool.stats()['connected'])
+		
+		# created on first use, then reused
+		self.assertEqual('db0', pool.db)
+		self.assertEqual('db0', pool.db)
+		self.assertEqual(1, len(servers))
+		self.assertTrue(pool.stats()['connected'])
+		
+		# a forked process creates its own
+		with mock.patch('py.mongopool.os.getpid', return_value=-1):
+			self.assertEqual('db1', pool.db)
+		self.assertEqual(2, len(servers))
+	
+	def testCommandStats(self):
+		stats = mongopool.CommandStats()
+		stats.started(None)
+		stats.started(None)
+		stats.succeeded(mock.Mock(duration_micros=1000))
+		self.assertEqual({'commands': 2, 'failed': 0, 'in_flight': 1, 'max_in_flight': 2, 'avg_command_ms': 1.0}, stats.stats())
+		stats.failed(mock.Mock(duration_micros=3000))
+		self.assertEqual({'commands': 2, 'failed': 1, 'in_flight': 0, 'max_in_flight': 2, 'avg_command_ms': 2.0}, stats.stats())
@@ -0,0 +1,65 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+
+import os
+import time
+import shutil
+import tempfile
+import unittest
+import multiprocessing
+from py import passwords
+from py.idmexception import IDMException
+
+
+class PasswordsTests(unittest.TestCase):
+	
+	def testHashAndVerify(self):
+		hasher = passwords.PasswordHasher(rounds=4)
+		hashed = hasher.hash('correct horse')
+		self.assertEqual(4, passwords.rounds_of(hashed))
+		self.assertTrue(hasher.verify('correct horse', hashed))
+		self.assertFalse(hasher.verify('battery staple', hashed))
+		self.assertFalse(hasher.verify('', hashed))
+	
+	def testNeedsRehash(self):
+		hashed = passwords.PasswordHasher(rounds=4).hash('correct horse')
+		self.assertFalse(passwords.PasswordHasher(rounds=4).needs_rehash(hashed))
+		self.assertTrue(passwords.PasswordHasher(rounds=5).needs_rehash(hashed))
+		self.assertFalse(passwords.PasswordHasher(rounds=5).needs_rehash(b'garbage'))
+	
+	def testRejectsWhenSaturated(self):
+		hasher = passwords.PasswordHasher(rounds=4, max_pending=1, wait=0.01)
+		slot = hasher._slots.acquire(0)
+		with self.assertRaises(IDMException) as cm:
+			hasher.hash('correct horse')
+		self.assertEqual(503, cm.exception.status_code)
+		self.assertEqual(1, hasher.stats()['rejected'])
+		
+		hasher._slots.release(slot)
+		self.assertIsNotNone(hasher.hash('correct horse'))
+	
+	def testSlotsSharedAcrossProcesses(self):
+		directory = tempfile.mkdtemp()
+		try:
+			hasher = passwords.PasswordHasher(rounds=4, max_pending=1, wait=0.01, slot_dir=directory)
+			child = multiprocessing.get_context('fork').Process(target=_hold_slot, args=(directory,))
+			ready = os.path.join(directory, 'ready')
+			child.start()
+			deadline = time.monotonic() + 5
+			while not os.path.exists(ready) and time.monotonic() < deadline:
+				time.sleep(0.01)
+			with self.assertRaises(IDMException) as cm:
+				hasher.hash('correct horse')
+			self.assertEqual(503, cm.exception.status_code)
+			
+			child.terminate()       # the dead process' slot is released
+			child.join()
+			self.assertIsNotNone(hasher.hash('correct horse'))
+		finally:
+			shutil.rmtree(directory)
+
+
+def _hold_slot(directory):
+	passwords.HostSlots(directory, 1).acquire(1)
+	open(os.path.join(directory, 'ready'), 'w').close()
+	time.sleep(30)
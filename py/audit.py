@@ -3,10 +3,19 @@
 import arrow
 from flask_jwt import current_identity
 from bson.objectid import ObjectId
+from pymongo import ASCENDING, UpdateMany
 
+from . import etag
+from . import cursor
+from . import storage
+from . import auditstore
 from .jsondocument import jsondocument
 from .idmexception import IDMException
 
+# the AuditSink to hand audits to instead of storing them one by one; audits
+# are written synchronously if None
+sink = None
+
 
 class Audit(jsondocument.JSONDocument):
 	
@@ -19,6 +28,44 @@ class Audit(jsondocument.JSONDocument):
 	def for_api(self):
 		return super().for_api(omit=['_id', 'type', 'actor_id', 'document'])
 	
+	def as_record(self):
+		""" The audit as the dictionary to insert into Mongo.
+		"""
+		record = {'type': 'audit', 'datetime': self.datetime, 'document': self.document, 'action': self.action}
+		if self.actor_id:
+			record['actor_id'] = self.actor_id
+		if self.actor:
+			record['actor'] = self.actor
+		return record
+	
+	def store_to(self, server, bucket=None):
+		""" Hands the audit to `sink` if one is set and it can write to the
+		server, stores it to its monthly partition (see `auditstore`) right
+		away otherwise.
+		"""
+		if sink is not None and sink.server is server:
+			sink.submit(self.as_record(), bucket)
+		elif storage.collection(server, bucket) is not None:
+			auditstore.insert_many(server, bucket, [self.as_record()])
+		else:
+			super().store_to(server, bucket=bucket)
+	
+	@classmethod
+	def store_all(cls, audits, server, bucket=None):
+		""" Stores all given audits, with one bulk insert per partition if
+		the server allows.
+		"""
+		if 0 == len(audits):
+			return
+		coll = storage.collection(server, bucket)
+		if sink is not None and sink.server is server:
+			sink.submit_many([audit.as_record() for audit in audits], bucket)
+		elif coll is not None:
+			auditstore.insert_many(server, bucket, [audit.as_record() for audit in audits])
+		else:
+			for audit in audits:
+				audit.store_to(server, bucket=bucket)
+	
 	
 	# MARK: - Auditing
 	
@@ -30,6 +77,7 @@ class Audit(jsondocument.JSONDocument):
 		audit.document = document_id
 		if current_identity:
 			audit.actor_id = current_identity.id
+			audit.actor = getattr(current_identity, 'username', None)
 		audit.action = action
 		return audit
 	
@@ -47,19 +95,165 @@ class Audit(jsondocument.JSONDocument):
 			except Exception as e:
 				pass
 	
+	@classmethod
+	def lookup_actors(cls, audits, server, bucket=None):
+		""" Like `lookup_actor()`, but resolves the actors of all given audits
+		with one user query.
+		"""
+		actor_ids = {}
+		for audit in audits:
+			if not audit.actor and audit.actor_id:
+				actor_id = audit.actor_id
+				if ObjectId.is_valid(actor_id):
+					actor_id = ObjectId(actor_id)
+				actor_ids[str(actor_id)] = actor_id
+		if 0 == len(actor_ids):
+			return
+		
+		usrs = User.find_on({'type': 'user', '_id': {'$in': list(actor_ids.values())}}, server, bucket, limit=0)
+		names = {str(usr.id): usr.username for usr in usrs} if usrs is not None else {}
+		for audit in audits:
+			if not audit.actor and audit.actor_id:
+				audit.actor = names.get(str(audit.actor_id))
+	
+	@classmethod
+	def backfill_actors(cls, server, bucket=None, batch_size=1000):
+		""" Stores the username as `actor` on all audits in the partitions that
+		only have an `actor_id`, in batches of `batch_size` audits with one
+		user query and one bulk update per batch. Usernames cannot change, so
+		this only needs to run once after upgrading.
+		
+		:returns: The number of audits that were updated
+		"""
+		if storage.collection(server, bucket) is None:
+			return 0
+		count = 0
+		for name in auditstore.partitions(server, bucket):
+			coll = server.db[name]
+			last_id = None
+			while True:
+				query = {'actor': {'$exists': False}, 'actor_id': {'$exists': True}}
+				if last_id is not None:
+					query['_id'] = {'$gt': last_id}
+				docs = list(coll.find(query, {'actor_id': 1}).sort('_id', ASCENDING).limit(batch_size))
+				if 0 == len(docs):
+					break
+				
+				audits = [cls(None, json={'actor_id': doc['actor_id']}) for doc in docs]
+				cls.lookup_actors(audits, server, bucket=bucket)
+				by_actor = {}
+				for doc, audit in zip(docs, audits):
+					if audit.actor:
+						by_actor.setdefault(audit.actor, []).append(doc['_id'])
+				if len(by_actor) > 0:
+					coll.bulk_write([UpdateMany({'_id': {'$in': ids}}, {'$set': {'actor': actor}}) for actor, ids in by_actor.items()], ordered=False)
+					count += sum([len(ids) for ids in by_actor.values()])
+				last_id = docs[-1]['_id']
+		return count
+	
 	
 	# MARK: - Search
 	
 	@classmethod
-	def find_for_doc_id_on(cls, doc_id, server, bucket=None):
-		""" Find all "audit" documents for the given document.
+	def find_for_doc_id_on(cls, doc_id, server, bucket=None, **filters):
+		""" Find all "audit" documents for the given document, see
+		`find_for_doc_ids_on()` for the filters.
 		"""
 		if not doc_id:
 			return None
-		if ObjectId.is_valid(doc_id):
-			doc_id = ObjectId(doc_id)
-		rslt = cls.find_on({'type': 'audit', 'document': doc_id}, server, bucket=bucket)
+		return cls.find_for_doc_ids_on([doc_id], server, bucket=bucket, **filters)
+	
+	@classmethod
+	def find_for_doc_ids_on(cls, doc_ids, server, bucket=None, since=None, until=None, action=None, after=None, limit=None):
+		""" Find all "audit" documents for any of the given documents, sorted
+		by `datetime` and `_id`. Only queries the partitions from the month the
+		oldest of the documents was created in, or from `since` or the cursor
+		on, whichever is later.
+		
+		:parameter since: Only audits made at or after this date
+		:parameter until: Only audits made before this date
+		:parameter action: Only audits of this action, like "create"
+		:parameter after: A cursor returned by `paginate()`, to continue after
+		:parameter limit: The maximum number of audits to return
+		"""
+		query, start = cls._query_for_doc_ids(doc_ids, since, until, action, after)
+		if query is None:
+			return None
+		if storage.collection(server, bucket) is None:
+			query['type'] = 'audit'
+			rslt = cls.find_on(query, server, bucket=bucket, limit=limit or 0, sort='datetime')
+		else:
+			found = auditstore.find(server, bucket, query, since=start, until=until, limit=limit)
+			rslt = [cls(None, json=doc) for doc in found]
 		return rslt if rslt and len(rslt) > 0 else None
+	
+	@classmethod
+	def versions_for_doc_ids_on(cls, doc_ids, server, bucket=None, since=None, until=None, action=None, after=None, limit=None):
+		""" Like `find_for_doc_ids_on()` but only fetches the audits' ids and
+		versions, see `etag.versions_on()`.
+		"""
+		query, start = cls._query_for_doc_ids(doc_ids, since, until, action, after)
+		if query is None:
+			return []
+		if storage.collection(server, bucket) is None:
+			return None
+		projection = {field: 1 for field in etag.VERSION_FIELDS}
+		return list(auditstore.find(server, bucket, query, projection, since=start, until=until, limit=limit))
+	
+	@classmethod
+	def _query_for_doc_ids(cls, doc_ids, since, until, action, after):
+		""" Builds the query for audits of the given documents.
+		
+		:returns: A tuple with the query, None if there are no documents, and
+		          the time from which on partitions need to be searched
+		"""
+		ids = [ObjectId(doc_id) if ObjectId.is_valid(doc_id) else doc_id for doc_id in doc_ids if doc_id]
+		if 0 == len(ids):
+			return None, None
+		query = {'document': {'$in': ids}}
+		starts = [auditstore.earliest(ids)]
+		interval = {}
+		if since:
+			interval['$gte'] = _utc_iso(since, 'since')
+			starts.append(interval['$gte'])
+		if until:
+			interval['$lt'] = _utc_iso(until, 'until')
+		if len(interval) > 0:
+			query['datetime'] = interval
+		if action:
+			query['action'] = action
+		if after:
+			value, doc_id = cursor.decode(after, 'datetime', False)
+			query = {'$and': [query, cursor.keyset_query('datetime', False, value, doc_id)]}
+			starts.append(value)
+		starts = [arrow.get(start) for start in starts if start is not None]
+		return query, max(starts) if len(starts) > 0 else None
+	
+	@classmethod
+	def paginate(cls, audits, limit):
+		""" Cuts a list of audits or audit versions, fetched with a limit one
+		higher than `limit`, down to one page.
+		
+		:returns: A tuple with the page and the cursor for the next page, which
+		          is None on the last page
+		"""
+		if limit is None or audits is None or len(audits) <= limit:
+			return audits, None
+		audits = audits[:limit]
+		last = audits[-1]
+		if isinstance(last, dict):
+			return audits, cursor.encode('datetime', False, last.get('datetime'), last.get('_id'))
+		return audits, cursor.encode('datetime', False, last.datetime, last._id)
+
+
+def _utc_iso(value, name):
+	""" Audits store their `datetime` as UTC ISO string, so that comparing
+	strings compares dates.
+	"""
+	try:
+		return arrow.get(value).to('UTC').isoformat()
+	except Exception as e:
+		raise IDMException("`{}` must be an ISO 8601 date".format(name), 400)
 
 from .user import User
 
@@ -0,0 +1,154 @@
+# -*- coding: utf-8 -*-
+
+import os
+import time
+import logging
+import threading
+from collections import deque
+from pymongo.errors import BulkWriteError
+
+from . import auditstore
+
+
+class AuditSink(object):
+	""" Collects audit records in memory and writes them to their partitions
+	(see `auditstore`) with bulk inserts from a background thread, whenever
+	`batch_size` records are queued or `flush_interval` seconds have passed.
+	
+	Audits thus appear up to `flush_interval` seconds after the write they
+	belong to. Records still queued when the process exits are lost unless
+	`close()` is called, which the app registers with `atexit`. When
+	`max_queue` records are waiting, new records are written right away by
+	the submitting thread instead of being queued.
+	"""
+	
+	def __init__(self, server, batch_size=100, flush_interval=1.0, max_queue=10000):
+		self.server = server
+		self.batch_size = batch_size
+		self.flush_interval = flush_interval
+		self.max_queue = max_queue
+		self.flushes = 0
+		self.flushed = 0
+		self.failures = 0
+		self.written_directly = 0
+		self.last_flush_ms = None
+		self.max_flush_ms = None
+		self._flush_ms_total = 0.0
+		self._queue = deque()
+		self._lock = threading.Lock()
+		self._flush_lock = threading.Lock()
+		self._wakeup = threading.Event()
+		self._closed = False
+		self._thread = None
+		self._pid = None
+	
+	def submit(self, record, bucket=None):
+		""" Queues an audit record, a dictionary ready to be inserted.
+		"""
+		self.submit_many([record], bucket)
+	
+	def submit_many(self, records, bucket=None):
+		if self._closed:
+			raise Exception("the audit sink has been closed")
+		self._ensure_thread()
+		with self._lock:
+			full = len(self._queue) + len(records) > self.max_queue
+			if not full:
+				self._queue.extend([(bucket, record) for record in records])
+			depth = len(self._queue)
+		if full:
+			# back pressure: write synchronously, failing like "sync" mode would
+			logging.warning("audit queue is full, writing {} audit records directly".format(len(records)))
+			auditstore.insert_many(self.server, bucket, list(records))
+			self.written_directly += len(records)
+		elif depth >= self.batch_size:
+			self._wakeup.set()
+	
+	def flush(self):
+		""" Writes all queued records, one bulk insert per partition. If the
+		insert fails for other reasons than errors with individual records,
+		the records are put back into the queue to be retried.
+		"""
+		with self._flush_lock:
+			with self._lock:
+				pending = list(self._queue)
+				self._queue.clear()
+			if 0 == len(pending):
+				return
+			
+			by_bucket = {}
+			for bucket, record in pending:
+				by_bucket.setdefault(bucket, []).append(record)
+			
+			start = time.monotonic()
+			for bucket, records in by_bucket.items():
+				try:
+					auditstore.insert_many(self.server, bucket, records)
+					self.flushed += len(records)
+				except BulkWriteError as e:
+					self.failures += 1
+					self.flushed += e.details.get('nInserted', 0)
+					logging.error("failed to write some audit records: {}".format(e.details.get('writeErrors')))
+				except Exception as e:
+					self.failures += 1
+					logging.error("failed to write {} audit records: {}".format(len(records), e))
+					with self._lock:
+						self._queue.extendleft([(bucket, r) for r in reversed(records)])
+			
+			duration = (time.monotonic() - start) * 1000
+			self.flushes += 1
+			self.last_flush_ms = duration
+			self.max_flush_ms = max(self.max_flush_ms or 0, duration)
+			self._flush_ms_total += duration
+	
+	def close(self):
+		""" Stops the background thread and writes what is still queued.
+		"""
+		self._closed = True
+		self._wakeup.set()
+		if self._thread is not None and self._pid == os.getpid():
+			self._thread.join(timeout=max(5, 2 * self.flush_interval))
+		self.flush()
+	
+	def stats(self):
+		return {
+			'mode': 'buffered',
+			'queue_depth': len(self._queue),
+			'flushes': self.flushes,
+			'flushed': self.flushed,
+			'failures': self.failures,
+			'written_directly': self.written_directly,
+			'last_flush_ms': self.last_flush_ms,
+			'avg_flush_ms': self._flush_ms_total / self.flushes if self.flushes > 0 else None,
+			'max_flush_ms': self.max_flush_ms,
+		}
+	
+	
+	# MARK: - Background Thread
+	
+	def _ensure_thread(self):
+		""" Starts the flush thread on first use in every process; threads do
+		not survive a fork, and records queued before the fork belong to the
+		parent.
+		"""
+		pid = os.getpid()
+		if self._pid == pid and self._thread is not None:
+			return
+		with self._lock:
+			if self._pid == pid and self._thread is not None:
+				return
+			if self._pid is not None:
+				self._queue.clear()
+			self._pid = pid
+			self._thread = threading.Thread(target=self._run, name='audit-sink')
+			self._thread.daemon = True
+			self._thread.start()
+	
+	def _run(self):
+		while not self._closed:
+			self._wakeup.wait(self.flush_interval)
+			self._wakeup.clear()
+			try:
+				self.flush()
+			except Exception as e:
+				logging.error("audit sink flush failed: {}".format(e))
@@ -0,0 +1,265 @@
+# -*- coding: utf-8 -*-
+
+import os
+import gzip
+import heapq
+import arrow
+import logging
+import threading
+from bson.objectid import ObjectId
+from pymongo import ASCENDING
+from pymongo.errors import BulkWriteError
+
+from . import storage
+from . import serializer
+
+
+# Audits are not stored in the shared bucket but in one collection per month,
+# named after the bucket and the month, like "c3pro_idm_audit_201701"
+PARTITION_FORMAT = '{}_audit_{}'
+
+# The indexes of every partition
+INDEXES = [
+	{
+		'name': 'audit_document_datetime',
+		'keys': [('document', ASCENDING), ('datetime', ASCENDING)],
+	},
+]
+
+_indexed = set()
+_lock = threading.Lock()
+
+# Buckets found to hold no more audits; nothing writes audits to the shared
+# bucket anymore, so once `migrate()` has emptied it, it stays empty
+_drained = set()
+
+
+# MARK: - Partitions
+
+def partition_name(bucket, when):
+	""" The name of the partition of the bucket that holds audits made at
+	`when`, an ISO date string, Arrow or datetime instance.
+	"""
+	return PARTITION_FORMAT.format(bucket, arrow.get(when).to('UTC').format('YYYYMM'))
+
+def partition_month(bucket, name):
+	""" The start of the month the named partition holds, or None if the
+	collection is not an audit partition of the bucket.
+	"""
+	prefix = PARTITION_FORMAT.format(bucket, '')
+	month = name[len(prefix):] if name.startswith(prefix) else ''
+	if 6 != len(month) or not month.isdigit():
+		return None
+	return arrow.Arrow(int(month[:4]), int(month[4:]), 1)
+
+def partitions(server, bucket=None, since=None, until=None):
+	""" The names of the existing partitions of the bucket, oldest first.
+	
+	:parameter since: Only partitions that can hold audits made at or after
+	                  this time
+	:parameter until: Only partitions that can hold audits made before this
+	                  time
+	"""
+	db = getattr(server, 'db', None)
+	bucket = bucket or getattr(server, 'bucket', None)
+	if db is None or not bucket:
+		return []
+	names = db.list_collection_names() if hasattr(db, 'list_collection_names') else db.collection_names()
+	since = arrow.get(since) if since is not None else None
+	until = arrow.get(until) if until is not None else None
+	found = []
+	for name in names:
+		month = partition_month(bucket, name)
+		if month is None:
+			continue
+		if since is not None and month.shift(months=1) <= since:
+			continue
+		if until is not None and month >= until:
+			continue
+		found.append((month, name))
+	return [name for month, name in sorted(found)]
+
+def _partition(server, name):
+	""" The partition's collection; creates its indexes on first use in this
+	process.
+	"""
+	coll = server.db[name]
+	if name not in _indexed:
+		with _lock:
+			if name not in _indexed:
+				for spec in INDEXES:
+					coll.create_index(spec['keys'], name=spec['name'])
+				_indexed.add(name)
+	return coll
+
+
+# MARK: - Reading and Writing
+
+def insert_many(server, bucket, records):
+	""" Inserts audit records into the partitions their `datetime` belongs
+	to, with one unordered bulk insert per partition.
+	
+	:raises: BulkWriteError with the combined details of all partitions if
+	         individual records failed
+	:returns: The number of records inserted
+	"""
+	bucket = bucket or server.bucket
+	by_partition = {}
+	for record in records:
+		name = partition_name(bucket, record.get('datetime') or arrow.utcnow())
+		by_partition.setdefault(name, []).append(record)
+	
+	inserted = 0
+	errors = []
+	for name, part in by_partition.items():
+		try:
+			_partition(server, name).insert_many(part, ordered=False)
+			inserted += len(part)
+		except BulkWriteError as e:
+			inserted += e.details.get('nInserted', 0)
+			errors.extend(e.details.get('writeErrors', []))
+	if len(errors) > 0:
+		raise BulkWriteError({'nInserted': inserted, 'writeErrors': errors})
+	return inserted
+
+def find(server, bucket, query, projection=None, since=None, until=None, batch_size=None, limit=None):
+	""" Finds the audits matching the query in all partitions that can hold
+	audits between `since` and `until`, sorted by `datetime` and `_id`.
+	Partitions are queried one after the other, and not at all once `limit`
+	audits have been found.
+	
+	Until `migrate()` has run, audits made before upgrading are still in the
+	shared bucket; as long as there are any, they are found as well.
+	
+	:returns: A generator of dictionaries
+	"""
+	if limit is not None and limit < 1:
+		return
+	found = _find_in_partitions(server, bucket, query, projection, since, until, batch_size, limit)
+	if has_unmigrated(server, bucket):
+		coll = storage.collection(server, bucket)
+		unmigrated = dict(query)
+		unmigrated['type'] = 'audit'
+		found = heapq.merge(found, _sorted(coll.find(unmigrated, projection), batch_size, limit), key=_sort_key)
+	remaining = limit
+	for doc in found:
+		yield doc
+		if remaining is not None:
+			remaining -= 1
+			if remaining < 1:
+				return
+
+def _find_in_partitions(server, bucket, query, projection, since, until, batch_size, limit):
+	remaining = limit
+	for name in partitions(server, bucket, since, until):
+		if remaining is not None and remaining < 1:
+			return
+		found = _sorted(server.db[name].find(query, projection), batch_size, remaining)
+		for doc in found:
+			if remaining is not None:
+				remaining -= 1
+			yield doc
+
+def _sorted(cursor, batch_size, limit):
+	cursor = cursor.sort([('datetime', ASCENDING), ('_id', ASCENDING)])
+	if batch_size is not None:
+		cursor = cursor.batch_size(batch_size)
+	if limit is not None:
+		cursor = cursor.limit(limit)
+	return cursor
+
+def _sort_key(doc):
+	return (doc.get('datetime') or '', str(doc.get('_id')))
+
+def has_unmigrated(server, bucket=None):
+	""" Whether the shared bucket still holds audits that `migrate()` has
+	yet to move into their partitions.
+	"""
+	coll = storage.collection(server, bucket)
+	if coll is None:
+		return False
+	key = bucket or server.bucket
+	if key in _drained:
+		return False
+	if coll.find_one({'type': 'audit'}, {'_id': 1}) is not None:
+		return True
+	_drained.add(key)
+	return False
+
+def earliest(doc_ids):
+	""" When the earliest of the given documents was created, as far as their
+	ObjectIds tell; there are no audits of a document before then.
+	
+	:returns: A datetime or None if any of the ids is not an ObjectId
+	"""
+	times = [doc_id.generation_time for doc_id in doc_ids if isinstance(doc_id, ObjectId)]
+	if 0 == len(times) or len(times) < len(doc_ids):
+		return None
+	return min(times)
+
+
+# MARK: - Maintenance
+
+def archive(server, bucket, directory, before):
+	""" Writes every partition that only holds audits made before `before`
+	to a gzipped NDJSON file named after the partition in `directory`, then
+	drops the partition.
+	
+	:returns: A list of the names of the archived partitions
+	"""
+	os.makedirs(directory, exist_ok=True)
+	bucket = bucket or server.bucket
+	before = arrow.get(before)
+	archived = []
+	for name in partitions(server, bucket, until=before):
+		if partition_month(bucket, name).shift(months=1) > before:
+			continue
+		path = os.path.join(directory, '{}.ndjson.gz'.format(name))
+		if os.path.exists(path):
+			path = os.path.join(directory, '{}-{}.ndjson.gz'.format(name, arrow.utcnow().format('YYYYMMDDHHmmss')))
+		
+		coll = server.db[name]
+		written = 0
+		with gzip.open(path + '.tmp', 'wt', encoding='utf-8') as handle:
+			for doc in coll.find().sort('_id', ASCENDING).batch_size(1000):
+				handle.write(serializer.dumps(doc) + '\n')
+				written += 1
+		if written != coll.count():
+			os.remove(path + '.tmp')
+			logging.error("not archiving audit partition “{}”, it changed while being written".format(name))
+			continue
+		os.rename(path + '.tmp', path)
+		coll.drop()
+		_indexed.discard(name)
+		archived.append(name)
+	return archived
+
+def migrate(server, bucket=None, batch_size=1000):
+	""" Moves the audits stored in the shared bucket into their partitions,
+	keeping their ids. Audits are removed from the bucket once copied, so an
+	interrupted migration can simply be run again.
+	
+	:returns: The number of audits moved
+	"""
+	coll = storage.collection(server, bucket)
+	if coll is None:
+		return 0
+	moved = 0
+	last_id = None
+	while True:
+		query = {'type': 'audit'}
+		if last_id is not None:
+			query['_id'] = {'$gt': last_id}
+		batch = list(coll.find(query).sort('_id', ASCENDING).limit(batch_size))
+		if 0 == len(batch):
+			break
+		try:
+			insert_many(server, bucket, batch)
+		except BulkWriteError as e:
+			others = [err for err in e.details.get('writeErrors', []) if 11000 != err.get('code')]
+			if len(others) > 0:     # duplicates were copied by an earlier run
+				raise
+		coll.delete_many({'_id': {'$in': [doc['_id'] for doc in batch]}})
+		moved += len(batch)
+		last_id = batch[-1]['_id']
+	return moved
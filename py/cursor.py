@@ -0,0 +1,59 @@
+# -*- coding: utf-8 -*-
+
+import base64
+from bson import json_util
+
+from .idmexception import IDMException
+
+
+def encode(sort, descending, value, doc_id):
+	""" Encodes the position after the given document into an opaque cursor
+	string.
+	
+	:parameter sort: The name of the column the results are sorted by
+	:parameter descending: Whether results are sorted descending
+	:parameter value: The value of `sort` of the last returned document
+	:parameter doc_id: The `_id` of the last returned document
+	"""
+	js = json_util.dumps([sort, bool(descending), value, doc_id])
+	return base64.urlsafe_b64encode(js.encode('utf-8')).decode('ascii').rstrip('=')
+
+def decode(cursor, sort, descending):
+	""" Decodes a cursor created by `encode()`. Raises if the cursor is
+	invalid or was created for a different ordering.
+	
+	:returns: A tuple with the sort value and document id of the document
+	          after which to continue
+	"""
+	try:
+		padded = cursor + '=' * (-len(cursor) % 4)
+		js = json_util.loads(base64.urlsafe_b64decode(padded.encode('ascii')).decode('utf-8'))
+		cur_sort, cur_desc, value, doc_id = js
+	except Exception as e:
+		raise IDMException("invalid cursor", 400)
+	if cur_sort != sort or cur_desc != bool(descending):
+		raise IDMException("the cursor does not match the requested ordering", 400)
+	return value, doc_id
+
+def keyset_query(sort, descending, value, doc_id):
+	""" Returns the query matching all documents after the given position in
+	a result set ordered by `sort` and then by `_id`, both in the same
+	direction.
+	
+	Missing values sort as null, which Mongo places before all other values,
+	and `$gt`/`$lt` do not compare across types, hence null is handled
+	explicitly.
+	"""
+	op = '$lt' if descending else '$gt'
+	if '_id' == sort:
+		return {'_id': {op: doc_id}}
+	
+	tie = {sort: value, '_id': {op: doc_id}}
+	if value is None:
+		if descending:
+			return tie
+		return {'$or': [tie, {sort: {'$ne': None}}]}
+	after = {sort: {op: value}}
+	if descending:
+		return {'$or': [after, tie, {sort: None}]}
+	return {'$or': [after, tie]}
@@ -0,0 +1,71 @@
+# -*- coding: utf-8 -*-
+
+import hashlib
+import arrow
+
+from . import storage
+
+
+# The fields that tell a document's version, the first one present wins:
+# `changed` is set on every update, `created` on insert and audits, which
+# never change, only have `datetime`.
+VERSION_FIELDS = ['changed', 'created', 'datetime']
+
+
+def validators(docs, extra=None):
+	""" Computes the validators for a response containing the given
+	documents, in the given order.
+	
+	:parameter docs: Documents, either as dictionaries or as JSONDocument
+	                 instances
+	:parameter extra: Anything else the response body depends on, such as
+	                  the request's query string
+	:returns: A tuple of the (opaque) entity tag, to be sent as weak ETag,
+	          and the latest version as Arrow instance or None
+	"""
+	digest = hashlib.sha1()
+	if extra:
+		digest.update(extra if isinstance(extra, bytes) else str(extra).encode('utf-8'))
+	latest = None
+	for doc in docs:
+		version = version_of(doc)
+		digest.update('{}@{};'.format(_get(doc, '_id'), version).encode('utf-8'))
+		modified = _arrow(version)
+		if modified is not None and (latest is None or modified > latest):
+			latest = modified
+	return digest.hexdigest(), latest
+
+def version_of(doc):
+	for field in VERSION_FIELDS:
+		value = _get(doc, field)
+		if value is not None:
+			return value
+	return None
+
+def versions_on(server, bucket, query, sort=None):
+	""" Fetches only the ids and version fields of all documents matching
+	the query, which is enough to compute their validators.
+	
+	:returns: A list of dictionaries or None if there is no Mongo collection
+	"""
+	coll = storage.collection(server, bucket)
+	if coll is None:
+		return None
+	found = coll.find(query, {field: 1 for field in VERSION_FIELDS})
+	if sort is not None:
+		found = found.sort(sort)
+	return list(found)
+
+
+def _get(doc, key):
+	if isinstance(doc, dict):
+		return doc.get(key)
+	return getattr(doc, key, None)
+
+def _arrow(value):
+	if value is None:
+		return None
+	try:
+		return arrow.get(value)
+	except Exception:
+		return None
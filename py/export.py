@@ -0,0 +1,154 @@
+# -*- coding: utf-8 -*-
+
+import io
+import csv
+import arrow
+from bson import ObjectId
+
+from . import storage
+from . import auditstore
+from . import serializer
+from .idmexception import IDMException
+
+
+# What can be exported: the document type, the columns written to CSV, the
+# fields never to be exported, the fields the time range applies to (the
+# first one present on a document) and whether the documents live in the
+# audit partitions instead of the shared bucket
+EXPORTS = {
+	'subjects': {
+		'type': 'subject',
+		'columns': ['_id', 'sssid', 'name', 'bday', 'date_invited', 'date_consented', 'date_enrolled', 'date_withdrawn', 'created', 'changed'],
+		'omit': ['_search'],
+		'time_fields': ['changed'],
+	},
+	'links': {
+		'type': 'link',
+		'columns': ['_id', 'sub', 'iss', 'aud', 'exp', 'linked_to', 'linked_system', 'linked_on', 'withdrawn_on', 'created', 'changed'],
+		'omit': ['secret', '_jwt'],
+		'time_fields': ['changed', 'created'],
+	},
+	'audits': {
+		'type': 'audit',
+		'columns': ['_id', 'document', 'datetime', 'action', 'actor', 'actor_id'],
+		'omit': [],
+		'time_fields': ['datetime'],
+		'partitioned': True,
+	},
+}
+
+FORMATS = {
+	'ndjson': 'application/x-ndjson',
+	'csv': 'text/csv',
+}
+
+
+def export(kind, server, bucket=None, fmt='ndjson', since=None, until=None, batch_size=500):
+	""" Exports all documents of one kind, streaming them from a Mongo
+	cursor so that memory use does not depend on the number of documents.
+	Arguments are validated right away, so that errors surface before the
+	first chunk is sent.
+	
+	:parameter kind: One of the keys of `EXPORTS`
+	:parameter fmt: One of the keys of `FORMATS`
+	:parameter since: Only export documents changed at or after this time
+	:parameter until: Only export documents changed before this time
+	:parameter batch_size: The cursor's batch size and the number of
+	                       documents per chunk
+	:returns: A generator of string chunks
+	"""
+	spec = EXPORTS.get(kind)
+	if spec is None:
+		raise IDMException("cannot export “{}”, must be one of: {}".format(kind, ', '.join(sorted(EXPORTS.keys()))), 404)
+	if fmt not in FORMATS:
+		raise IDMException("unsupported format “{}”, must be one of: {}".format(fmt, ', '.join(sorted(FORMATS.keys()))))
+	if batch_size < 1:
+		raise IDMException("the batch size must be at least 1")
+	coll = storage.collection(server, bucket)
+	if coll is None:
+		raise IDMException("exporting requires a Mongo server", 500)
+	
+	since = _timestamp(since, 'since')
+	until = _timestamp(until, 'until')
+	query = {'type': spec['type']}
+	query.update(_time_query(spec['time_fields'], since, until))
+	projection = {field: 0 for field in spec['omit']} if len(spec['omit']) > 0 else None
+	if spec.get('partitioned'):
+		found = auditstore.find(server, bucket, query, projection, since=since, until=until, batch_size=batch_size)
+	else:
+		found = coll.find(query, projection).batch_size(batch_size)
+	
+	if 'csv' == fmt:
+		return _csv_chunks(found, spec['columns'], batch_size)
+	return _ndjson_chunks(found, spec['omit'], batch_size)
+
+
+# MARK: - Formats
+
+def _ndjson_chunks(found, omit, batch_size):
+	chunk = []
+	for doc in found:
+		for key in omit:
+			doc.pop(key, None)
+		chunk.append(serializer.dumps(doc))
+		if len(chunk) >= batch_size:
+			yield '\n'.join(chunk) + '\n'
+			chunk = []
+	if len(chunk) > 0:
+		yield '\n'.join(chunk) + '\n'
+
+def _csv_chunks(found, columns, batch_size):
+	buf = io.StringIO()
+	writer = csv.writer(buf)
+	writer.writerow(columns)
+	count = 0
+	for doc in found:
+		writer.writerow([_csv_value(doc.get(col)) for col in columns])
+		count += 1
+		if count >= batch_size:
+			yield buf.getvalue()
+			buf.seek(0)
+			buf.truncate()
+			count = 0
+	if buf.tell() > 0:
+		yield buf.getvalue()
+
+def _csv_value(value):
+	if value is None:
+		return ''
+	if isinstance(value, (dict, list)):
+		return serializer.dumps(value)
+	return serializer.default(value) if isinstance(value, (ObjectId, bytes)) else value
+
+
+# MARK: - Time Range
+
+def _timestamp(value, name):
+	""" Parses a timestamp parameter into the ISO format our documents use.
+	"""
+	if not value:
+		return None
+	try:
+		return arrow.get(value).to('UTC').isoformat()
+	except Exception as e:
+		raise IDMException("the date for `{}` “{}” is not properly formatted".format(name, value))
+
+def _time_query(fields, since, until):
+	""" Matches documents whose first present field of `fields` lies in
+	the range.
+	"""
+	if since is None and until is None:
+		return {}
+	rng = {}
+	if since is not None:
+		rng['$gte'] = since
+	if until is not None:
+		rng['$lt'] = until
+	
+	clauses = []
+	for idx, field in enumerate(fields):
+		clause = {field: rng}
+		for earlier in fields[:idx]:
+			clause[earlier] = {'$exists': False}
+		clauses.append(clause)
+	return clauses[0] if 1 == len(clauses) else {'$or': clauses}
@@ -0,0 +1,114 @@
+# -*- coding: utf-8 -*-
+
+import os
+import time
+import logging
+import threading
+
+
+class HealthMonitor(object):
+	""" Runs health probes in a background thread every `interval` seconds
+	and keeps the latest result of each, so that reporting the service's
+	health never waits for an external service.
+	
+	A probe is a callable that raises if the service it checks is unhealthy.
+	Probes taking longer than `timeout` seconds are reported as timed out;
+	a hung probe is not started again until it has returned.
+	"""
+	
+	def __init__(self, probes, interval=30, timeout=5, clock=None):
+		self.probes = probes
+		self.interval = interval
+		self.timeout = timeout
+		self.clock = clock or time.time
+		self._results = {}
+		self._running = {}
+		self._lock = threading.Lock()
+		self._thread = None
+		self._pid = None
+	
+	def ensure_started(self):
+		""" Starts the probe thread unless it is already running in this
+		process; call from within request handlers so that the thread is
+		started in the worker, not before forking.
+		"""
+		pid = os.getpid()
+		with self._lock:
+			if self._thread is not None and self._pid == pid:
+				return
+			self._pid = pid
+			self._running = {}
+			self._thread = threading.Thread(target=self._run, name='health-monitor')
+			self._thread.daemon = True
+			self._thread.start()
+	
+	def run_once(self):
+		""" Runs all probes in parallel and waits at most `timeout` seconds
+		for them to finish.
+		"""
+		started = []
+		for name, probe in self.probes.items():
+			running = self._running.get(name)
+			if running is not None and running.is_alive():
+				self._store(name, 'probe still running after {} seconds'.format(self.timeout), None)
+				continue
+			thread = threading.Thread(target=self._probe, args=(name, probe), name='health-probe-{}'.format(name))
+			thread.daemon = True
+			self._running[name] = thread
+			thread.start()
+			started.append((name, thread))
+		
+		deadline = time.monotonic() + self.timeout
+		for name, thread in started:
+			thread.join(max(0, deadline - time.monotonic()))
+			if thread.is_alive():
+				self._store(name, 'timed out after {} seconds'.format(self.timeout), self.timeout * 1000)
+	
+	def report(self):
+		""" Returns the latest result of every probe with its age in seconds,
+		or a "pending" status for probes that have not yet completed.
+		"""
+		now = self.clock()
+		report = {}
+		with self._lock:
+			for name in self.probes.keys():
+				result = self._results.get(name)
+				if result is None:
+					report[name] = {'status': 'pending', 'latency_ms': None, 'age_seconds': None}
+				else:
+					report[name] = {
+						'status': result['status'],
+						'latency_ms': result['latency_ms'],
+						'age_seconds': round(now - result['checked'], 3),
+					}
+		return report
+	
+	
+	# MARK: - Private
+	
+	def _probe(self, name, probe):
+		start = time.monotonic()
+		try:
+			probe()
+			status = 'ok'
+		except Exception as e:
+			status = str(e) or e.__class__.__name__
+		latency = (time.monotonic() - start) * 1000
+		if latency <= self.timeout * 1000:
+			self._store(name, status, latency)
+	
+	def _store(self, name, status, latency):
+		with self._lock:
+			self._results[name] = {
+				'status': status,
+				'latency_ms': round(latency, 3) if latency is not None else None,
+				'checked': self.clock(),
+			}
+	
+	def _run(self):
+		while True:
+			try:
+				self.run_once()
+			except Exception as e:
+				logging.error("health probes failed: {}".format(e))
+			time.sleep(self.interval)
@@ -0,0 +1,71 @@
+# -*- coding: utf-8 -*-
+
+import time
+import threading
+from collections import OrderedDict
+
+
+class IdentityCache(object):
+	""" A bounded, per-process cache with time-to-live, used to hold user
+	identities keyed by their id. The least recently used entry is evicted
+	when the cache is full.
+	
+	Invalidation only affects the current process, so `ttl` is the upper
+	bound for how long other worker processes may serve a stale entry.
+	"""
+	
+	def __init__(self, max_size=1000, ttl=60, clock=None):
+		self.max_size = max_size
+		self.ttl = ttl
+		self.clock = clock or time.monotonic
+		self.hits = 0
+		self.misses = 0
+		self._entries = OrderedDict()
+		self._lock = threading.Lock()
+	
+	def get(self, key):
+		""" Returns the cached value for the given key or None if there is
+		none or it has expired.
+		"""
+		key = str(key)
+		with self._lock:
+			entry = self._entries.get(key)
+			if entry is not None:
+				value, expires = entry
+				if expires > self.clock():
+					self._entries.move_to_end(key)
+					self.hits += 1
+					return value
+				del self._entries[key]
+			self.misses += 1
+			return None
+	
+	def put(self, key, value):
+		if self.max_size < 1 or self.ttl <= 0:
+			return
+		key = str(key)
+		with self._lock:
+			self._entries[key] = (value, self.clock() + self.ttl)
+			self._entries.move_to_end(key)
+			while len(self._entries) > self.max_size:
+				self._entries.popitem(last=False)
+	
+	def invalidate(self, key):
+		if key is None:
+			return
+		with self._lock:
+			self._entries.pop(str(key), None)
+	
+	def clear(self):
+		with self._lock:
+			self._entries.clear()
+	
+	def stats(self):
+		with self._lock:
+			return {
+				'size': len(self._entries),
+				'max_size': self.max_size,
+				'ttl': self.ttl,
+				'hits': self.hits,
+				'misses': self.misses,
+			}
@@ -0,0 +1,111 @@
+# -*- coding: utf-8 -*-
+
+import logging
+from pymongo import ASCENDING
+from pymongo.errors import OperationFailure
+
+from . import storage
+from . import auditstore
+
+
+# All document types share one bucket, hence most indexes are partial
+# indexes restricted to the type they serve.
+INDEXES = [
+	{
+		'name': 'subject_sssid',
+		'keys': [('sssid', ASCENDING)],
+		'unique': True,
+		'partialFilterExpression': {'type': 'subject'},
+	},
+	{
+		'name': 'subject_search',
+		'keys': [('_search', ASCENDING)],
+		'partialFilterExpression': {'type': 'subject'},
+	},
+	{
+		'name': 'link_sub',
+		'keys': [('sub', ASCENDING)],
+		'partialFilterExpression': {'type': 'link'},
+	},
+	{
+		'name': 'user_username',
+		'keys': [('username', ASCENDING)],
+		'unique': True,
+		'partialFilterExpression': {'type': 'user'},
+	},
+	{
+		'name': 'user_temporary_hash',
+		'keys': [('temporary.hash', ASCENDING)],
+		'partialFilterExpression': {'type': 'user'},
+	},
+]
+
+# Indexes we used to create but no longer query by; dropped if present. Audits
+# have their own collections with their own indexes, see `auditstore`, but the
+# old audit index is kept until `migrate-audits` has emptied the bucket.
+OBSOLETE_INDEXES = ['link_jwt', 'audit_document_datetime']
+
+# Whether a unique index exists, per bucket and index name, as found by
+# `has_unique_index()` in this process
+_unique = {}
+
+
+def ensure_indexes(server, bucket=None, indexes=None):
+	""" Creates those of our indexes that do not yet exist and drops the
+	obsolete ones. Failure to create one index (e.g. a unique index over
+	data that already has duplicates) is logged and does not prevent
+	creating the others.
+	
+	:parameter server: The Mongo server to use
+	:parameter bucket: The bucket to use (optional)
+	:parameter indexes: The index specifications, defaults to `INDEXES`
+	:returns: A list with the names of the indexes that were created
+	"""
+	coll = storage.collection(server, bucket)
+	if coll is None:
+		return []
+	
+	existing = coll.index_information()
+	created = []
+	for spec in indexes or INDEXES:
+		name = spec['name']
+		if name in existing:
+			continue
+		options = {k: v for k, v in spec.items() if 'keys' != k}
+		try:
+			coll.create_index(spec['keys'], **options)
+			created.append(name)
+			_unique.pop((coll.name, name), None)
+		except OperationFailure as e:
+			logging.error("failed to create index “{}”: {}".format(name, e))
+	
+	for name in OBSOLETE_INDEXES:
+		if name not in existing:
+			continue
+		if 'audit_document_datetime' == name and auditstore.has_unmigrated(server, bucket):
+			continue
+		try:
+			coll.drop_index(name)
+		except OperationFailure as e:
+			logging.error("failed to drop index “{}”: {}".format(name, e))
+	return created
+
+def has_unique_index(server, bucket, name):
+	""" Whether the bucket has a unique index of the given name, in which
+	case inserts can rely on it to reject duplicates. Asks Mongo once per
+	process, unless `ensure_indexes()` creates the index in the meantime.
+	
+	:returns: False if the index is missing or not unique, or the server
+	          does not expose a Mongo collection
+	"""
+	coll = storage.collection(server, bucket)
+	if coll is None:
+		return False
+	key = (coll.name, name)
+	if key not in _unique:
+		try:
+			_unique[key] = bool(coll.index_information().get(name, {}).get('unique'))
+		except OperationFailure as e:
+			logging.error("failed to look up index “{}”: {}".format(name, e))
+			return False
+	return _unique[key]
@@ -1,6 +1,7 @@
 # -*- coding: utf-8 -*-
 
 from . import user as user
+from .idmexception import IDMException
 
 
 def authenticate(username, password):
@@ -8,9 +9,25 @@ def authenticate(username, password):
 	"""
 	try:
 		return user.User.with_pass(username, password, user.server, user.bucket)
+	except IDMException as e:
+		if 503 == e.status_code:
+			raise
+		return None
 	except Exception as e:
 		return None
 
 def identity(payload):
+	""" This function is called on every `@jwt_required()` request to turn
+	the JWT payload into the user; uses `user.identity_cache` if set.
+	"""
 	user_id = payload.get('identity')
-	return user.User.with_id(user_id, user.server, user.bucket)
+	cache = user.identity_cache
+	if cache is not None:
+		usr = cache.get(user_id)
+		if usr is not None:
+			return usr
+	
+	usr = user.User.with_id(user_id, user.server, user.bucket)
+	if cache is not None:
+		cache.put(user_id, usr)
+	return usr
@@ -1,12 +1,26 @@
 # -*- coding: utf-8 -*-
 
 import jwt
+import hmac
 import arrow
+import logging
 from bson.objectid import ObjectId
 
+from . import storage
 from .jsondocument import jsondocument
 from .idmexception import IDMException
 
+# the maximum number of links to create with one `create_for_sssids()` call
+BULK_MAX = 1000
+
+# longer tokens are rejected without being decoded
+JWT_MAX_LENGTH = 4096
+
+# how often the subject's link dates could not be updated after one of its
+# links changed, reported on /status; run `flask backfill-link-dates` to
+# repair the dates
+link_date_failures = 0
+
 
 class Link(jsondocument.JSONDocument):
 	
@@ -89,8 +103,26 @@ class Link(jsondocument.JSONDocument):
 		elif 'linked_system' in js:
 			raise IDMException("cannot set `linked_system` without `linked_to`")
 		
+		if 'withdrawn_on' in js:
+			if self.withdrawn_on is not None:
+				raise IDMException("this link has already been withdrawn", 409)
+			try:
+				js['withdrawn_on'] = arrow.get(js['withdrawn_on']).isoformat()
+			except Exception as e:
+				raise IDMException("The date for withdrawn_on \"{}\" is not properly formatted".format(js['withdrawn_on']))
+			statuschange = '; '.join([statuschange, 'withdraw']) if statuschange else 'withdraw'
+		
 		self.update_with(js)
 		self.store_to(server, bucket, statuschange)
+		
+		# keep the subject's enrollment and withdrawal dates up to date
+		if 'linked_on' in js or 'withdrawn_on' in js:
+			try:
+				Subject.update_link_dates(self.sub, server, bucket)
+			except Exception as e:
+				global link_date_failures
+				link_date_failures += 1
+				logging.error("failed to update link dates of subject {}: {}".format(self.sub, e))
 	
 	
 	# MARK: - JWT
@@ -107,18 +139,115 @@ class Link(jsondocument.JSONDocument):
 			raise IDMException("the subject to this link does not exist", 404)
 		
 		# generate and store JWT
+		self._issue_jwt(res[0])
+		self.store_to(server, bucket, 'create JWT')
+		return self._jwt
+	
+	def _issue_jwt(self, subject):
+		""" Generates the JWT for the given subject, valid for 24 hours, and
+		assigns it to `_jwt`. Does not store.
+		"""
 		self.exp = arrow.utcnow().shift(hours=24).timestamp
 		payload = {
-			'jti': self._id,
+			'jti': str(self._id),
 			'iss': self.iss,
 			'aud': self.aud,
 			'exp': self.exp,
-			'sub': res[0].name,       # pull name and bday from SSSID and use on `sub` and `birthdate`
-			'birthdate': res[0].bday,
+			'sub': subject.name,       # pull name and bday from SSSID and use on `sub` and `birthdate`
+			'birthdate': subject.bday,
 		}
 		self._jwt = jwt.encode(payload, self.secret, algorithm=self.algorithm)
-		self.store_to(server, bucket, 'create JWT')
-		return self._jwt
+	
+	
+	# MARK: - Bulk Creation
+	
+	@classmethod
+	def create_for_sssids(cls, sssids, settings, server, bucket=None, with_jwt=False):
+		""" Creates one link for each of the given subjects, like
+		`Subject.create_new_link()` does for one subject. Looks up all
+		subjects with one query and stores the links and their audits with
+		one bulk insert each. Optionally issues the links' JWTs right away.
+		
+		:parameter sssids: A list of SSSIDs
+		:parameter with_jwt: Whether to also issue the JWTs
+		:returns: A list with one result dictionary per SSSID, containing the
+		          SSSID, an HTTP-like status and the link (and its JWT) or an
+		          error
+		"""
+		if not isinstance(sssids, list) or 0 == len(sssids):
+			raise IDMException("must provide a list of SSSIDs")
+		if len(sssids) > BULK_MAX:
+			raise IDMException("can create links for at most {} subjects at a time".format(BULK_MAX))
+		
+		unique = []
+		for sssid in sssids:
+			if not isinstance(sssid, str) or not sssid:
+				raise IDMException("SSSIDs must be non-empty strings")
+			if sssid not in unique:
+				unique.append(sssid)
+		found = Subject.find_on({'type': 'subject', 'sssid': {'$in': unique}}, server, bucket, limit=0) or []
+		subjects = {}
+		for subj in found:
+			subjects.setdefault(subj.sssid, subj)
+		
+		results = []
+		links = []
+		now = arrow.utcnow().isoformat()
+		for sssid in unique:
+			subj = subjects.get(sssid)
+			if subj is None:
+				results.append({'sssid': sssid, 'status': 404, 'error': "Not Found"})
+				continue
+			if not subj.date_consented:
+				results.append({'sssid': sssid, 'status': 412, 'error': "Subject has not yet been consented"})
+				continue
+			lnk = cls(None, json={
+				'sub': sssid,
+				'iss': settings.jwt['iss'],
+				'aud': settings.jwt['aud'],
+				'secret': settings.jwt['secret'],
+				'algorithm': settings.jwt['algorithm']})
+			links.append((lnk, subj))
+			results.append({'sssid': sssid, 'status': 201, 'link': lnk})
+		
+		coll = storage.collection(server, bucket)
+		if coll is None:
+			for lnk, subj in links:
+				del lnk._id
+				lnk.store_to(server, bucket)
+				if with_jwt:
+					lnk.jwt(server, bucket)
+		elif len(links) > 0:
+			docs = []
+			audits = []
+			for lnk, subj in links:
+				lnk._id = ObjectId()
+				lnk.created = now
+				if with_jwt:
+					lnk._issue_jwt(subj)
+				docs.append(lnk._as_document())
+				audits.append(Audit.audit_event_now(lnk._id, 'create'))
+				if with_jwt:
+					audits.append(Audit.audit_event_now(lnk._id, 'create JWT'))
+			coll.insert_many(docs)
+			Audit.store_all(audits, server, bucket)
+		
+		for result in results:
+			if 'link' in result:
+				lnk = result.pop('link')
+				result['data'] = lnk.for_api()
+				if with_jwt:
+					result['jwt'] = lnk._jwt.decode('utf-8') if isinstance(lnk._jwt, bytes) else lnk._jwt
+		return results
+	
+	def _as_document(self):
+		""" The link as the dictionary to insert into Mongo.
+		"""
+		doc = {'_id': self._id, 'type': 'link', 'created': self.created}
+		for key in ['sub', 'iss', 'aud', 'secret', 'algorithm', 'exp', '_jwt']:
+			if getattr(self, key) is not None:
+				doc[key] = getattr(self, key)
+		return doc
 	
 	
 	# MARK: - CRUD
@@ -155,11 +284,39 @@ class Link(jsondocument.JSONDocument):
 		return rslt[0] if len(rslt) > 0 else None
 	
 	@classmethod
-	def find_jwt_on(cls, jwt, server, bucket=None):
-		if not jwt:
+	def find_jwt_on(cls, in_jwt, server, bucket=None):
+		""" Finds the link the given JWT was issued for. Reads the link id
+		from the token's `jti` claim, fetches the link by id, then verifies
+		the token's signature with the link's secret and compares it to the
+		token stored on the link. Tokens that cannot be decoded are rejected
+		without querying the database.
+		
+		Expiry is not checked here; `link_to_fhir_patient()` does that.
+		
+		:returns: The Link or None if the token does not belong to a link
+		"""
+		if not in_jwt or len(in_jwt) > JWT_MAX_LENGTH:
 			return None
-		rslt = cls.find_on({'type': 'link', '_jwt': bytes(jwt, encoding='utf-8')}, server, bucket)
-		return rslt[0] if len(rslt) > 0 else None
+		try:
+			claims = jwt.decode(in_jwt, options={'verify_signature': False, 'verify_exp': False, 'verify_aud': False})
+		except jwt.InvalidTokenError:
+			return None
+		jti = claims.get('jti') if isinstance(claims, dict) else None
+		if not jti or not isinstance(jti, str):
+			return None
+		
+		lnk = cls.find_jti_on(jti, server, bucket)
+		if lnk is None or 'link' != lnk.type or not lnk._jwt or not lnk.secret:
+			return None
+		try:
+			jwt.decode(in_jwt, lnk.secret, algorithms=[lnk.algorithm], audience=lnk.aud, issuer=lnk.iss, options={'verify_exp': False})
+		except jwt.InvalidTokenError:
+			return None
+		
+		stored = lnk._jwt if isinstance(lnk._jwt, bytes) else lnk._jwt.encode('utf-8')
+		if not hmac.compare_digest(stored, in_jwt.encode('utf-8')):
+			return None
+		return lnk
 	
 	@classmethod
 	def find_for_sssid_on(cls, sssid, server, bucket=None):
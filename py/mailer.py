@@ -1,37 +1,166 @@
 # -*- coding: utf-8 -*-
 
+import os
+import time
+import queue
+import logging
 import smtplib
+import threading
 from email.mime.text import MIMEText
 
 
 class Mailer(object):
 	""" Simple implementation of a mailing facility using smtplib.
+	
+	Keeps one authenticated SMTP connection open and reuses it for all mails,
+	reconnecting when the server has dropped it. Mails handed to
+	`queue_mail()` are sent from a background thread, with retries.
 	"""
+	smtp_class = smtplib.SMTP
 	
-	def __init__(self, username, password, server, port, reply_to=None):
+	def __init__(self, username, password, server, port, reply_to=None, starttls=True, timeout=10, retries=3, retry_delay=5):
 		self.s = None
 		self.server = server
 		self.port = port
 		self.username = username
 		self.password = password
 		self.reply_to = reply_to if reply_to is not None else username
+		self.starttls = starttls
+		self.timeout = timeout
+		self.retries = retries
+		self.retry_delay = retry_delay
+		self._lock = threading.RLock()
+		self._queue = queue.Queue()
+		self._thread = None
+		self._pid = None
 	
 	def connect(self):
-		s = smtplib.SMTP(self.server, self.port)
-		s.ehlo()
-		s.starttls()
-		s.ehlo()
-		s.login(self.username, self.password)
-		self.s = s
+		""" Opens a new connection, replacing the current one.
+		"""
+		with self._lock:
+			self.disconnect()
+			s = self.smtp_class(self.server, self.port, timeout=self.timeout)
+			s.ehlo()
+			if self.starttls:
+				s.starttls()
+				s.ehlo()
+			if self.username and self.password:
+				s.login(self.username, self.password)
+			self.s = s
+	
+	def check(self, timeout=None):
+		""" Verifies that the mail server accepts our credentials, using a
+		separate connection that is closed again right away.
+		"""
+		if not self.server:
+			raise Exception("sending mail is not configured on this server")
+		s = self.smtp_class(self.server, self.port, timeout=timeout or self.timeout)
+		try:
+			s.ehlo()
+			if self.starttls:
+				s.starttls()
+				s.ehlo()
+			if self.username and self.password:
+				s.login(self.username, self.password)
+		finally:
+			try:
+				s.quit()
+			except Exception:
+				pass
+	
+	def disconnect(self):
+		with self._lock:
+			if self.s is not None:
+				try:
+					self.s.quit()
+				except Exception:
+					pass
+				self.s = None
 	
 	def send_mail(self, to, subject, body):
-		self.connect()
+		""" Sends the mail right away over the shared connection. Reconnects
+		and tries once more if the connection turns out to be gone.
+		"""
 		msg = MIMEText(body)
 		msg['Subject'] = subject
 		msg['From'] = self.username
 		msg['Reply-To'] = self.reply_to
 		msg['To'] = to
 		
-		self.s.sendmail(self.username, to, msg.as_string())
-		self.s.close()
-
+		with self._lock:
+			try:
+				self._connection().sendmail(self.username, to, msg.as_string())
+			except (smtplib.SMTPServerDisconnected, ConnectionError) as e:
+				self.connect()
+				self.s.sendmail(self.username, to, msg.as_string())
+	
+	def _connection(self):
+		if self.s is not None:
+			try:
+				if 250 == self.s.noop()[0]:
+					return self.s
+			except (smtplib.SMTPException, OSError) as e:
+				pass
+		self.connect()
+		return self.s
+	
+	
+	# MARK: - Queue
+	
+	def queue_mail(self, to, subject, body):
+		""" Puts the mail on the send queue and returns immediately. Failed
+		sends are retried `retries` times, waiting `retry_delay` seconds
+		longer after every attempt.
+		"""
+		if not self.server:
+			raise Exception("sending mail is not configured on this server")
+		self._ensure_thread()
+		self._queue.put((to, subject, body, 1))
+	
+	def close(self, timeout=10):
+		""" Waits up to `timeout` seconds for queued mails to be sent, then
+		closes the connection.
+		"""
+		if self._thread is not None and self._pid == os.getpid():
+			deadline = time.monotonic() + timeout
+			with self._queue.all_tasks_done:
+				while self._queue.unfinished_tasks > 0:
+					remaining = deadline - time.monotonic()
+					if remaining <= 0:
+						break
+					self._queue.all_tasks_done.wait(remaining)
+			self._queue.put(None)
+			self._thread.join(timeout=max(0, deadline - time.monotonic()))
+			self._thread = None
+		self.disconnect()
+	
+	def _ensure_thread(self):
+		pid = os.getpid()
+		with self._lock:
+			if self._thread is not None and self._pid == pid:
+				return
+			self.s = None      # a connection inherited from before a fork is not ours
+			self._pid = pid
+			self._thread = threading.Thread(target=self._run, name='mailer')
+			self._thread.daemon = True
+			self._thread.start()
+	
+	def _run(self):
+		while True:
+			item = self._queue.get()
+			if item is None:
+				self._queue.task_done()
+				break
+			to, subject, body, attempt = item
+			try:
+				self.send_mail(to, subject, body)
+			except Exception as e:
+				if attempt < self.retries:
+					logging.warning("failed to send mail to {} (attempt {}), retrying: {}".format(to, attempt, e))
+					self.disconnect()
+					time.sleep(self.retry_delay * attempt)
+					self._queue.put((to, subject, body, attempt + 1))
+				else:
+					logging.error("failed to send mail to {}, giving up: {}".format(to, e))
+			finally:
+				self._queue.task_done()
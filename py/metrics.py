@@ -0,0 +1,115 @@
+# -*- coding: utf-8 -*-
+#
+# Request and database metrics in Prometheus format. When run by gunicorn
+# with several workers, set the `prometheus_multiproc_dir` environment
+# variable to an empty directory before starting, so that `/metrics` reports
+# the sum over all workers; see `gunicorn.conf.py`.
+
+import os
+import time
+import threading
+from pymongo import monitoring
+from prometheus_client import Counter, Histogram, CollectorRegistry, REGISTRY, CONTENT_TYPE_LATEST, generate_latest
+
+
+REQUEST_SECONDS = Histogram('idm_request_duration_seconds',
+	"Time spent handling requests, until the response (or its first chunk when streamed) is ready",
+	['endpoint', 'method'])
+REQUESTS = Counter('idm_requests_total',
+	"Requests handled, by response status",
+	['endpoint', 'method', 'status'])
+REQUEST_DB_CALLS = Histogram('idm_request_db_calls',
+	"Database commands issued per request",
+	['endpoint'], buckets=(0, 1, 2, 3, 5, 10, 20, 50, 100, 200, float('inf')))
+REQUEST_DB_SECONDS = Histogram('idm_request_db_seconds',
+	"Time spent in database commands per request",
+	['endpoint'])
+DB_COMMAND_SECONDS = Histogram('idm_db_command_duration_seconds',
+	"Duration of database commands, like `find` for `find_on()` or `insert` and `update` for `store_to()`",
+	['command'])
+
+# endpoints not to instrument
+EXCLUDED = ['metrics', 'static']
+
+
+class DBCallListener(monitoring.CommandListener):
+	""" Records the duration of every database command, and adds it up for
+	the request the current thread is handling.
+	"""
+	
+	def __init__(self):
+		self._local = threading.local()
+	
+	def begin(self):
+		self._local.calls = 0
+		self._local.seconds = 0.0
+	
+	def end(self):
+		""" Returns the number of and time spent in commands since `begin()`.
+		"""
+		calls = getattr(self._local, 'calls', 0)
+		seconds = getattr(self._local, 'seconds', 0.0)
+		self.begin()
+		return calls, seconds
+	
+	def started(self, event):
+		pass
+	
+	def succeeded(self, event):
+		self._record(event)
+	
+	def failed(self, event):
+		self._record(event)
+	
+	def _record(self, event):
+		seconds = event.duration_micros / 1000000
+		DB_COMMAND_SECONDS.labels(event.command_name).observe(seconds)
+		self._local.calls = getattr(self._local, 'calls', 0) + 1
+		self._local.seconds = getattr(self._local, 'seconds', 0.0) + seconds
+
+db_calls = DBCallListener()
+
+
+def instrument(app):
+	""" Records latency, status and database calls of every request the app
+	handles. Must be called before the first Mongo client is created.
+	"""
+	from flask import g, request
+	monitoring.register(db_calls)
+	
+	@app.before_request
+	def _start_timer():
+		g.metrics_start = time.monotonic()
+		db_calls.begin()
+	
+	@app.after_request
+	def _record_request(response):
+		start = getattr(g, 'metrics_start', None)
+		endpoint = request.endpoint or 'unknown'
+		if start is None or endpoint in EXCLUDED:
+			return response
+		calls, seconds = db_calls.end()
+		REQUEST_SECONDS.labels(endpoint, request.method).observe(time.monotonic() - start)
+		REQUESTS.labels(endpoint, request.method, str(response.status_code)).inc()
+		REQUEST_DB_CALLS.labels(endpoint).observe(calls)
+		REQUEST_DB_SECONDS.labels(endpoint).observe(seconds)
+		return response
+
+def render():
+	""" Returns the body and content type of the metrics page, aggregated
+	over all worker processes in multiprocess mode.
+	"""
+	if os.environ.get('prometheus_multiproc_dir'):
+		from prometheus_client import multiprocess
+		registry = CollectorRegistry()
+		multiprocess.MultiProcessCollector(registry)
+	else:
+		registry = REGISTRY
+	return generate_latest(registry), CONTENT_TYPE_LATEST
+
+def mark_process_dead(pid):
+	""" Call from gunicorn's `child_exit` hook in multiprocess mode.
+	"""
+	if os.environ.get('prometheus_multiproc_dir'):
+		from prometheus_client import multiprocess
+		multiprocess.mark_process_dead(pid)
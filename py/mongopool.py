@@ -0,0 +1,131 @@
+# -*- coding: utf-8 -*-
+
+import os
+import threading
+from urllib.parse import urlencode
+from pymongo import monitoring
+
+
+# The connection pool settings of `settings.mongo_server` and the MongoClient
+# URI options they are passed as
+POOL_OPTIONS = [
+	('max_pool_size', 'maxPoolSize'),
+	('min_pool_size', 'minPoolSize'),
+	('wait_queue_timeout_ms', 'waitQueueTimeoutMS'),
+	('server_selection_timeout_ms', 'serverSelectionTimeoutMS'),
+	('connect_timeout_ms', 'connectTimeoutMS'),
+	('socket_timeout_ms', 'socketTimeoutMS'),
+	('max_idle_time_ms', 'maxIdleTimeMS'),
+]
+
+
+def mongo_uri(host, port, settings):
+	""" Returns a "mongodb://" URI for the given host and port, or for the
+	host if it already is such a URI, that carries the pool options found in
+	`settings`. The client is told not to connect before its first operation.
+	
+	:parameter host: The host name or a "mongodb://" URI; None for localhost
+	:parameter port: The port; None for the default port
+	:parameter settings: A dictionary with any of the keys of `POOL_OPTIONS`
+	:returns: The URI to hand to MongoClient
+	"""
+	options = [(uri_name, settings[name]) for name, uri_name in POOL_OPTIONS if settings.get(name) is not None]
+	options.append(('connect', 'false'))
+	if host and host.startswith('mongodb://'):
+		uri = host
+		if '?' not in uri and '/' not in uri[len('mongodb://'):]:
+			uri += '/'
+	else:
+		uri = 'mongodb://{}:{}/'.format(host or 'localhost', port or 27017)
+	return uri + ('&' if '?' in uri else '?') + urlencode(options)
+
+
+class MongoPool(object):
+	""" Stands in for the MongoServer, creating the actual server - and with
+	it the MongoClient and its connection pool - on first use in every
+	process. A client must not be used across a fork; if gunicorn forks its
+	workers after the app has been loaded, each worker thus opens its own
+	connections instead of sharing the master's sockets.
+	
+	Attribute access is forwarded to the server of the current process.
+	"""
+	
+	def __init__(self, factory, options=None):
+		self.factory = factory
+		self.options = options or {}
+		self.commands = CommandStats()
+		self._server = None
+		self._pid = None
+		self._lock = threading.Lock()
+		monitoring.register(self.commands)
+	
+	def server(self):
+		""" The MongoServer of the current process, created if needed.
+		"""
+		pid = os.getpid()
+		if self._server is not None and self._pid == pid:
+			return self._server
+		with self._lock:
+			if self._server is None or self._pid != pid:
+				self._server = self.factory()
+				self._pid = pid
+				self.commands.reset()
+			return self._server
+	
+	def __getattr__(self, name):
+		return getattr(self.server(), name)
+	
+	def stats(self):
+		stats = self.commands.stats()
+		stats.update({
+			'pid': os.getpid(),
+			'connected': self._server is not None and self._pid == os.getpid(),
+			'options': self.options,
+		})
+		return stats
+
+
+class CommandStats(monitoring.CommandListener):
+	""" Counts the commands sent by the clients of this process.
+	"""
+	
+	def __init__(self):
+		self._lock = threading.Lock()
+		self.reset()
+	
+	def reset(self):
+		with self._lock:
+			self.started_count = 0
+			self.succeeded_count = 0
+			self.failed_count = 0
+			self.duration_micros = 0
+			self.max_in_flight = 0
+	
+	def started(self, event):
+		with self._lock:
+			self.started_count += 1
+			self.max_in_flight = max(self.max_in_flight, self._in_flight())
+	
+	def succeeded(self, event):
+		with self._lock:
+			self.succeeded_count += 1
+			self.duration_micros += event.duration_micros
+	
+	def failed(self, event):
+		with self._lock:
+			self.failed_count += 1
+			self.duration_micros += event.duration_micros
+	
+	def stats(self):
+		with self._lock:
+			done = self.succeeded_count + self.failed_count
+			return {
+				'commands': self.started_count,
+				'failed': self.failed_count,
+				'in_flight': self._in_flight(),
+				'max_in_flight': self.max_in_flight,
+				'avg_command_ms': round(self.duration_micros / done / 1000, 3) if done > 0 else None,
+			}
+	
+	def _in_flight(self):
+		return max(0, self.started_count - self.succeeded_count - self.failed_count)
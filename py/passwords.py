@@ -0,0 +1,148 @@
+# -*- coding: utf-8 -*-
+
+import os
+import time
+import fcntl
+import bcrypt
+import threading
+from concurrent.futures import ThreadPoolExecutor
+
+from .idmexception import IDMException
+
+
+class PasswordHasher(object):
+	""" Hashes and verifies passwords with bcrypt on a small thread pool.
+	
+	At most `max_pending` hashing operations may be running or waiting at
+	any time; a caller that cannot get a slot within `wait` seconds is
+	rejected with a 503 instead of tying up its worker behind the queue.
+	With `slot_dir` the slots are lock files in that directory, shared by
+	all worker processes on the host, otherwise they only count within this
+	process - which with sync workers handling one request each means never.
+	bcrypt releases the GIL, so with threaded workers the pool also keeps
+	bcrypt off the request threads.
+	
+	New hashes use `rounds` as cost factor; `needs_rehash()` tells whether an
+	existing hash was created with a different one.
+	"""
+	
+	def __init__(self, rounds=12, max_workers=2, max_pending=4, wait=0.5, slot_dir=None):
+		self.rounds = rounds
+		self.max_workers = max_workers
+		self.max_pending = max_pending
+		self.wait = wait
+		self.rejected = 0
+		self._slots = HostSlots(slot_dir, max_pending) if slot_dir else ProcessSlots(max_pending)
+		self._lock = threading.Lock()
+		self._executor = None
+		self._pid = None
+	
+	def hash(self, password):
+		""" Returns the bcrypt hash, as bytes, of the given password.
+		"""
+		return self._run(bcrypt.hashpw, password.encode('utf-8'), bcrypt.gensalt(self.rounds))
+	
+	def verify(self, password, hashed):
+		""" Returns whether the password matches the given bcrypt hash.
+		"""
+		if not password or not hashed:
+			return False
+		if isinstance(hashed, str):
+			hashed = hashed.encode('utf-8')
+		return self._run(bcrypt.checkpw, password.encode('utf-8'), hashed)
+	
+	def needs_rehash(self, hashed):
+		""" Returns whether the hash's cost factor differs from `rounds`.
+		"""
+		rounds = rounds_of(hashed)
+		return rounds is not None and rounds != self.rounds
+	
+	def stats(self):
+		return {
+			'rounds': self.rounds,
+			'max_workers': self.max_workers,
+			'max_pending': self.max_pending,
+			'rejected': self.rejected,
+		}
+	
+	def _run(self, func, *args):
+		slot = self._slots.acquire(self.wait)
+		if slot is None:
+			self.rejected += 1
+			raise IDMException("the server is busy, please try again in a moment", 503)
+		try:
+			return self._pool().submit(func, *args).result()
+		finally:
+			self._slots.release(slot)
+	
+	def _pool(self):
+		""" The executor of the current process; threads do not survive a
+		fork, hence a forked worker creates its own.
+		"""
+		pid = os.getpid()
+		with self._lock:
+			if self._executor is None or self._pid != pid:
+				self._executor = ThreadPoolExecutor(max_workers=self.max_workers)
+				self._pid = pid
+			return self._executor
+
+
+class ProcessSlots(object):
+	""" Slots counted within the current process.
+	"""
+	
+	def __init__(self, count):
+		self._semaphore = threading.BoundedSemaphore(count)
+	
+	def acquire(self, timeout):
+		""" Returns a slot, or None if none became free within `timeout`
+		seconds.
+		"""
+		return True if self._semaphore.acquire(timeout=timeout) else None
+	
+	def release(self, slot):
+		self._semaphore.release()
+
+
+class HostSlots(object):
+	""" Slots shared by all processes on the host, as `count` lock files in
+	`directory`. The OS releases the lock of a process that dies, so slots
+	cannot leak.
+	"""
+	
+	def __init__(self, directory, count, poll=0.01):
+		self.paths = [os.path.join(directory, 'slot-{}.lock'.format(i)) for i in range(count)]
+		self.poll = poll
+		os.makedirs(directory, exist_ok=True)
+	
+	def acquire(self, timeout):
+		""" Returns a slot, or None if none became free within `timeout`
+		seconds.
+		"""
+		deadline = time.monotonic() + timeout
+		while True:
+			for path in self.paths:
+				fd = os.open(path, os.O_RDWR | os.O_CREAT, 0o600)
+				try:
+					fcntl.flock(fd, fcntl.LOCK_EX | fcntl.LOCK_NB)
+					return fd
+				except OSError:
+					os.close(fd)
+			if time.monotonic() >= deadline:
+				return None
+			time.sleep(self.poll)
+	
+	def release(self, slot):
+		fcntl.flock(slot, fcntl.LOCK_UN)
+		os.close(slot)
+
+
+def rounds_of(hashed):
+	""" Returns the cost factor of a bcrypt hash like "$2b$12$...".
+	"""
+	if isinstance(hashed, str):
+		hashed = hashed.encode('utf-8')
+	try:
+		return int(hashed.split(b'$')[2])
+	except Exception:
+		return None
@@ -0,0 +1,90 @@
+# -*- coding: utf-8 -*-
+
+import os
+import time
+import logging
+import sqlite3
+import threading
+
+
+def client_ip(remote_addr, real_ip, trusted_proxies):
+	""" The address to rate limit a request by: the `X-Real-IP` header if
+	the request came from one of the trusted proxies, otherwise the address
+	it came from.
+	"""
+	if real_ip and remote_addr in (trusted_proxies or []):
+		return real_ip
+	return remote_addr
+
+
+class RateLimiter(object):
+	""" Token buckets kept in a SQLite database, so that all worker processes
+	on a host draw from the same buckets. Every bucket holds up to `burst`
+	tokens and refills at `rate` tokens per second; a request takes one token
+	from each of its buckets.
+	
+	Every process and thread opens its own connection. Should the database be
+	busy for longer than `timeout` seconds, requests are let through rather
+	than held up.
+	"""
+	
+	def __init__(self, path, timeout=0.05, expire=3600, clock=None):
+		self.path = path
+		self.timeout = timeout
+		self.expire = expire
+		self.clock = clock or time.time
+		self._local = threading.local()
+		self._pruned = 0
+	
+	def hit(self, buckets):
+		""" Takes a token from each of the given buckets, but only if all of
+		them have one left.
+		
+		:parameter buckets: A list of (key, rate, burst) tuples
+		:returns: 0 if the request may proceed, else the number of seconds
+		          until it may be retried
+		"""
+		if 0 == len(buckets):
+			return 0
+		now = self.clock()
+		try:
+			conn = self._connection()
+			conn.execute('BEGIN IMMEDIATE')
+			try:
+				wait = 0
+				updated = []
+				for key, rate, burst in buckets:
+					row = conn.execute('SELECT tokens, updated FROM buckets WHERE key = ?', (key,)).fetchone()
+					tokens = burst if row is None else min(burst, row[0] + max(0, now - row[1]) * rate)
+					if tokens < 1:
+						wait = max(wait, (1 - tokens) / rate)
+					updated.append((key, tokens - 1, now))
+				if 0 == wait:
+					conn.executemany('INSERT OR REPLACE INTO buckets (key, tokens, updated) VALUES (?, ?, ?)', updated)
+				if now - self._pruned > 60:
+					conn.execute('DELETE FROM buckets WHERE updated < ?', (now - self.expire,))
+					self._pruned = now
+				conn.execute('COMMIT')
+			except Exception:
+				conn.execute('ROLLBACK')
+				raise
+		except sqlite3.Error as e:
+			logging.warning("rate limiter unavailable, letting request through: {}".format(e))
+			return 0
+		return wait
+	
+	def _connection(self):
+		""" The connection of the current thread, which must not be used
+		across a fork.
+		"""
+		pid = os.getpid()
+		conn = getattr(self._local, 'conn', None)
+		if conn is not None and self._local.pid == pid:
+			return conn
+		conn = sqlite3.connect(self.path, timeout=self.timeout, isolation_level=None)
+		conn.execute('PRAGMA journal_mode=WAL')
+		conn.execute('PRAGMA synchronous=OFF')
+		conn.execute('CREATE TABLE IF NOT EXISTS buckets (key TEXT PRIMARY KEY, tokens REAL, updated REAL)')
+		self._local.conn = conn
+		self._local.pid = pid
+		return conn
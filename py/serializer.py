@@ -0,0 +1,79 @@
+# -*- coding: utf-8 -*-
+
+import json
+from bson import ObjectId
+
+try:
+	import orjson
+except ImportError:
+	orjson = None
+
+
+# The JSON encoders we can use, fastest first. "orjson" is optional; "json"
+# is the standard library's, which uses its C encoder as long as output is
+# not indented.
+BACKENDS = ['orjson', 'json']
+
+backend = 'orjson' if orjson is not None else 'json'
+
+
+def use(name='auto'):
+	""" Selects the backend `dumps()` uses; "auto" picks the fastest one that
+	is installed.
+	
+	:parameter name: "auto" or one of `BACKENDS`
+	:returns: The name of the backend now in use
+	"""
+	global backend
+	if 'auto' == name:
+		name = BACKENDS[0] if orjson is not None else BACKENDS[1]
+	if name not in BACKENDS:
+		raise Exception("unknown JSON backend “{}”, must be one of: auto, {}".format(name, ', '.join(BACKENDS)))
+	if 'orjson' == name and orjson is None:
+		raise Exception("the JSON backend “orjson” is not installed")
+	backend = name
+	return backend
+
+def default(o):
+	""" Serializes what JSON does not know: ObjectIds as their hex string,
+	bytes (like stored JWTs) as UTF-8 and dates in ISO format.
+	"""
+	if isinstance(o, ObjectId):
+		return str(o)
+	if isinstance(o, bytes):
+		return o.decode('utf-8', 'replace')
+	if hasattr(o, 'isoformat'):
+		return o.isoformat()
+	raise TypeError("{} is not JSON serializable".format(repr(o)))
+
+_encoder = json.JSONEncoder(default=default, ensure_ascii=False, check_circular=False, separators=(',', ':'))
+
+def dumps(obj):
+	""" Returns `obj` as compact JSON string.
+	"""
+	if 'orjson' == backend:
+		try:
+			return orjson.dumps(obj, default=default).decode('utf-8')
+		except TypeError:
+			pass        # e.g. non-string keys or integers beyond 64 bit
+	return _encoder.encode(obj)
+
+def stream_list(items, to_api, key='data', extra=None, batch_size=50):
+	""" Serializes a JSON object holding the items, converted with `to_api`,
+	as list under `key`, plus the members in `extra`. Yields a string chunk
+	for every `batch_size` items, converting items only as they are
+	serialized.
+	"""
+	yield '{' + dumps(key) + ':['
+	chunk = []
+	first = True
+	for item in items:
+		chunk.append(dumps(to_api(item)))
+		if len(chunk) >= batch_size:
+			yield ('' if first else ',') + ','.join(chunk)
+			first = False
+			chunk = []
+	tail = ('' if first or 0 == len(chunk) else ',') + ','.join(chunk) + ']'
+	for name, value in (extra or {}).items():
+		tail += ',' + dumps(name) + ':' + dumps(value)
+	yield tail + '}'
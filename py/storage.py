@@ -0,0 +1,20 @@
+# -*- coding: utf-8 -*-
+
+
+def collection(server, bucket=None):
+	""" Returns the pymongo collection backing the given bucket, for the
+	operations `JSONDocument` does not offer (indexes, bulk writes,
+	projections).
+	
+	:parameter server: The Mongo server to use
+	:parameter bucket: The bucket to use (optional)
+	:returns: A pymongo Collection or None if the server does not expose a
+	          Mongo database, as is the case with the MockServer in tests
+	"""
+	db = getattr(server, 'db', None)
+	if db is None:
+		return None
+	bucket = bucket or getattr(server, 'bucket', None)
+	if not bucket:
+		return None
+	return db[bucket]
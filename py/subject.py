@@ -1,7 +1,15 @@
 # -*- coding: utf-8 -*-
 
+import re
+import json
 import arrow
+from pymongo import ASCENDING, DESCENDING, UpdateOne
+from pymongo.errors import BulkWriteError, DuplicateKeyError
 
+from . import cursor
+from . import etag
+from . import indexes
+from . import storage
 from .jsondocument import jsondocument
 from .idmexception import IDMException
 
@@ -51,27 +59,131 @@ class Subject(jsondocument.JSONDocument):
 	# MARK: - CRUD
 	
 	def populate_with_links(self, server, bucket):
-		links = Link.find_on({'type': 'link', 'sub': self.sssid}, server, bucket)
+		links = Link.find_on({'type': 'link', 'sub': self.sssid}, server, bucket, limit=0)
+		if links is not None:
+			self.apply_links(links)
+	
+	@classmethod
+	def update_link_dates(cls, sssid, server, bucket=None):
+		""" Recomputes `date_enrolled` and `date_withdrawn` of the subject
+		with the given SSSID from its links and stores them if they changed.
+		Called whenever a link is established or withdrawn, so that reading
+		subjects does not involve their links.
+		
+		Like all subject dates, a date once stored is kept; a subject that was
+		enrolled through a link that is later withdrawn stays enrolled.
+		"""
+		res = cls.find_sssid_on(sssid, server, bucket)
+		if not res or 0 == len(res):
+			return
+		subj = res[0]
+		before = (subj.date_enrolled, subj.date_withdrawn)
+		subj.populate_with_links(server, bucket)
+		if (subj.date_enrolled, subj.date_withdrawn) != before:
+			subj._store_link_dates(server, bucket)
+	
+	@classmethod
+	def backfill_link_dates(cls, server, bucket=None, batch_size=200):
+		""" Computes and stores `date_enrolled` and `date_withdrawn` of all
+		subjects from their links, in batches of `batch_size` subjects with
+		one link query per batch. Use once after upgrading and to repair
+		subjects whose dates are missing.
+		
+		:returns: The number of subjects that were updated
+		"""
+		count = 0
+		last_id = None
+		while True:
+			dic = {'type': 'subject'}
+			if last_id is not None:
+				dic['_id'] = {'$gt': last_id}
+			subjs = cls.find_on(dic, server, bucket, limit=batch_size, sort='_id')
+			if not subjs or 0 == len(subjs):
+				break
+			
+			before = [(subj.date_enrolled, subj.date_withdrawn) for subj in subjs]
+			cls.populate_all_with_links(subjs, server, bucket)
+			for subj, dates in zip(subjs, before):
+				if (subj.date_enrolled, subj.date_withdrawn) != dates:
+					subj._store_link_dates(server, bucket)
+					count += 1
+			if len(subjs) < batch_size:
+				break
+			last_id = subjs[-1]._id
+		return count
+	
+	def _store_link_dates(self, server, bucket=None):
+		""" Stores the link dates without auditing; the link change that led
+		to them has its own audit.
+		"""
+		self.changed = arrow.utcnow().isoformat()
+		coll = storage.collection(server, bucket)
+		if coll is None:
+			jsondocument.JSONDocument.store_to(self, server, bucket=bucket)
+			return
+		
+		dates = {'changed': self.changed}
+		if self.date_enrolled is not None:
+			dates['date_enrolled'] = self.date_enrolled
+		if self.date_withdrawn is not None:
+			dates['date_withdrawn'] = self.date_withdrawn
+		coll.update_one({'_id': self._id}, {'$set': dates})
+	
+	def apply_links(self, links):
+		""" Updates `date_enrolled` and `date_withdrawn` from the given links
+		in a single pass. Withdrawn links determine `date_withdrawn` (latest
+		wins), links that are linked but not withdrawn determine
+		`date_enrolled` (earliest wins).
+		
+		:parameter links: An iterable of Link instances belonging to this
+		                  subject
+		"""
+		withdrawn = None
+		rolled = None
+		for lnk in links:
+			
+			# link was cancelled: subject has withdrawn (use latest)
+			if lnk.withdrawn_on:
+				lnk_withdrawn = arrow.get(lnk.withdrawn_on)
+				if withdrawn is None or lnk_withdrawn > withdrawn:
+					withdrawn = lnk_withdrawn
+			
+			# not withdrawn, but linked: subject is enrolled (use earliest)
+			elif lnk.linked_on:
+				lnk_rolled = arrow.get(lnk.linked_on)
+				if rolled is None or lnk_rolled < rolled:
+					rolled = lnk_rolled
+		
+		if withdrawn is not None:
+			if self.date_withdrawn is None or withdrawn > arrow.get(self.date_withdrawn):
+				self.date_withdrawn = withdrawn.isoformat()
+		if rolled is not None:
+			if self.date_enrolled is None or rolled < arrow.get(self.date_enrolled):
+				self.date_enrolled = rolled.isoformat()
+	
+	@classmethod
+	def populate_all_with_links(cls, subjects, server, bucket=None):
+		""" Populates all given subjects with their links, fetching links for
+		all subjects with one query instead of one query per subject.
+		"""
+		by_sssid = {}
+		for subj in subjects:
+			if subj.sssid:
+				by_sssid.setdefault(subj.sssid, []).append(subj)
+		if 0 == len(by_sssid):
+			return
+		
+		grouped = {}
+		links = Link.find_on({'type': 'link', 'sub': {'$in': list(by_sssid.keys())}}, server, bucket, limit=0)
 		if links is not None:
 			for lnk in links:
-				
-				# link was cancelled: subject has withdrawn (use latest)
-				if lnk.withdrawn_on:
-					withdrawn = arrow.get(lnk.withdrawn_on)
-					if self.date_withdrawn is not None:
-						my_withdrawn = arrow.get(self.date_withdrawn)
-						self.date_withdrawn = withdrawn.isoformat() if withdrawn > my_withdrawn else self.date_withdrawn
-					else:
-						self.date_withdrawn = withdrawn.isoformat()
-				
-				# not withdrawn, but linked: subject is enrolled (use earliest)
-				elif lnk.linked_on:
-					rolled = arrow.get(lnk.linked_on)
-					if self.date_enrolled is not None:
-						my_rolled = arrow.get(self.date_enrolled)
-						self.date_enrolled = rolled.isoformat() if rolled < my_rolled else self.date_enrolled
-					else:
-						self.date_enrolled = rolled.isoformat()
+				grouped.setdefault(lnk.sub, []).append(lnk)
+		
+		for sssid, subjs in by_sssid.items():
+			lnks = grouped.get(sssid)
+			if lnks is not None:
+				for subj in subjs:
+					subj.apply_links(lnks)
 	
 	def safe_update_and_store_to(self, js, server, bucket):
 		""" Takes data sent via the web and updates the receiver. Will check
@@ -114,17 +226,187 @@ class Subject(jsondocument.JSONDocument):
 		else:
 			action = action or 'update'
 		self.changed = now
+		self._search = self.search_grams()
 		super().store_to(server, bucket=bucket)
 		
 		audit = Audit.audit_event_now(self.id, action)
 		audit.store_to(server, bucket=bucket)
 	
+	@classmethod
+	def create(cls, js, server, bucket=None):
+		""" Creates and stores a new subject from the given JSON, see
+		`_insert_new_to()`.
+		
+		:raises: IDMException with status 409 if the SSSID is already taken
+		:returns: The new subject
+		"""
+		subj = cls(js.get('sssid'), js)
+		subj._insert_new_to(server, bucket)
+		return subj
+	
+	def _insert_new_to(self, server, bucket=None):
+		""" Stores the subject as a new document. Inserts right away and
+		relies on the unique SSSID index to reject taken SSSIDs; without that
+		index, e.g. on servers without a Mongo collection, the SSSID is
+		looked up first.
+		"""
+		if not indexes.has_unique_index(server, bucket, 'subject_sssid') and self.__class__.find_sssid_on(self.sssid, server, bucket):
+			raise IDMException('this SSSID is already taken', 409)
+		del self._id   # auto-creates UUID; we rely on Mongo
+		try:
+			self.store_to(server, bucket)
+		except DuplicateKeyError:
+			raise IDMException('this SSSID is already taken', 409)
+	
 	def for_api(self):
-		return super().for_api(omit=['_id', 'type'])
+		return super().for_api(omit=['_id', 'type', '_search'])
+	
+	
+	# MARK: - Bulk Import
+	
+	@classmethod
+	def import_ndjson(cls, lines, server, bucket=None, chunk_size=500):
+		""" Creates subjects from newline-delimited JSON, one subject per
+		line, processing `chunk_size` lines at a time: validates every line,
+		checks the chunk's SSSIDs for duplicates with one query and inserts
+		the new subjects and their audits with one bulk insert each.
+		
+		:parameter lines: An iterable of lines (bytes or str), e.g. a stream
+		:returns: A generator yielding one result dictionary per non-empty
+		          line, with the line number, SSSID and an HTTP-like status;
+		          lines that are not UTF-8 or not a JSON object get a 400
+		"""
+		chunk = []
+		for num, line in enumerate(lines, 1):
+			if not line.strip():
+				continue
+			chunk.append((num, line))
+			if len(chunk) >= chunk_size:
+				for result in cls._import_chunk(chunk, server, bucket):
+					yield result
+				chunk = []
+		if len(chunk) > 0:
+			for result in cls._import_chunk(chunk, server, bucket):
+				yield result
+	
+	@classmethod
+	def _import_chunk(cls, chunk, server, bucket):
+		results = []
+		valid = []          # (result, subject, json) tuples
+		seen = set()
+		for num, line in chunk:
+			result = {'line': num, 'sssid': None}
+			results.append(result)
+			try:
+				if isinstance(line, bytes):
+					line = line.decode('utf-8')
+				js = json.loads(line)
+				if not isinstance(js, dict):
+					raise IDMException("each line must contain a JSON object")
+				for key in ['_id', 'type', '_search']:
+					js.pop(key, None)
+				result['sssid'] = js.get('sssid')
+				subj = cls(None, js)
+			except Exception as e:
+				result.update({'status': 400, 'error': str(e)})
+				continue
+			if subj.sssid in seen:
+				result.update({'status': 409, 'error': 'this SSSID is already taken'})
+				continue
+			seen.add(subj.sssid)
+			valid.append((result, subj, js))
+		
+		coll = storage.collection(server, bucket)
+		if coll is None:
+			cls._import_one_by_one(valid, server, bucket)
+			return results
+		
+		# check for existing SSSIDs with one query
+		taken = set()
+		if len(valid) > 0:
+			found = coll.find({'type': 'subject', 'sssid': {'$in': [subj.sssid for r, subj, js in valid]}}, {'sssid': 1})
+			taken = set([doc.get('sssid') for doc in found])
+		
+		docs = []
+		pending = []
+		now = arrow.utcnow().isoformat()
+		for result, subj, js in valid:
+			if subj.sssid in taken:
+				result.update({'status': 409, 'error': 'this SSSID is already taken'})
+				continue
+			doc = dict(js)
+			doc.update({'type': 'subject', 'created': now, 'changed': now, '_search': subj.search_grams()})
+			docs.append(doc)
+			pending.append(result)
+		if 0 == len(docs):
+			return results
+		
+		# insert; SSSIDs taken in the meantime fail on the unique index
+		failed = {}
+		try:
+			coll.insert_many(docs, ordered=False)
+		except BulkWriteError as e:
+			for err in e.details.get('writeErrors', []):
+				failed[err['index']] = err
+		
+		audits = []
+		for idx, (result, doc) in enumerate(zip(pending, docs)):
+			err = failed.get(idx)
+			if err is None:
+				result['status'] = 201
+				audits.append(Audit.audit_event_now(doc['_id'], 'create'))
+			elif 11000 == err.get('code'):
+				result.update({'status': 409, 'error': 'this SSSID is already taken'})
+			else:
+				result.update({'status': 500, 'error': err.get('errmsg')})
+		Audit.store_all(audits, server, bucket)
+		return results
+	
+	@classmethod
+	def _import_one_by_one(cls, valid, server, bucket):
+		""" Import path for servers that don't expose a Mongo collection.
+		"""
+		for result, subj, js in valid:
+			try:
+				subj._insert_new_to(server, bucket)
+				result['status'] = 201
+			except Exception as e:
+				result.update({'status': getattr(e, 'status_code', 500), 'error': str(e)})
 	
 	
 	# MARK: - Search
 	
+	def search_grams(self):
+		""" Returns the lowercased 1-, 2- and 3-grams of the subject's SSSID,
+		name and birthday, which are stored as `_search` so that searching
+		for substrings can use an index.
+		"""
+		return _search_grams([self.sssid, self.name, self.bday])
+	
+	@classmethod
+	def reindex_search(cls, server, bucket=None, batch_size=500):
+		""" Recomputes `_search` on all subjects, needed once for subjects
+		stored before `_search` was introduced.
+		
+		:returns: The number of subjects that were updated
+		"""
+		coll = storage.collection(server, bucket)
+		if coll is None:
+			raise IDMException("reindexing requires a Mongo server", 500)
+		
+		count = 0
+		batch = []
+		for doc in coll.find({'type': 'subject'}, {'sssid': 1, 'name': 1, 'bday': 1, '_search': 1}):
+			grams = _search_grams([doc.get('sssid'), doc.get('name'), doc.get('bday')])
+			if grams != doc.get('_search'):
+				batch.append(UpdateOne({'_id': doc['_id']}, {'$set': {'_search': grams}}))
+			if len(batch) >= batch_size:
+				count += coll.bulk_write(batch, ordered=False).modified_count
+				batch = []
+		if len(batch) > 0:
+			count += coll.bulk_write(batch, ordered=False).modified_count
+		return count
+	
 	@classmethod
 	def find_sssid_on(cls, sssid, server, bucket=None):
 		if not sssid:
@@ -133,21 +415,70 @@ class Subject(jsondocument.JSONDocument):
 	
 	@classmethod
 	def search(cls, searchstring, server, bucket=None, skip=0, limit=50, sort=None, descending=False):
+		dic = cls._search_query(searchstring)
+		return cls.find_on(dic, server, bucket=bucket, skip=skip, limit=limit, sort=sort, descending=descending)
+	
+	@classmethod
+	def search_page(cls, searchstring, server, bucket=None, limit=50, sort=None, descending=False, after=None):
+		""" Like `search()` but paginates with a cursor instead of an offset,
+		so that deep pages cost the same as the first one. Results are ordered
+		by `sort` and then by `_id`.
+		
+		:parameter after: The cursor returned with the previous page, if any
+		:returns: A tuple with the list of subjects and the cursor for the
+		          next page, which is None on the last page
+		"""
+		if limit < 1:
+			raise IDMException("must return at least one subject per page")
+		sort = sort or '_id'
+		dic = cls._search_query(searchstring)
+		if after:
+			value, doc_id = cursor.decode(after, sort, descending)
+			keyset = cursor.keyset_query(sort, descending, value, doc_id)
+			dic = {'$and': [dic, keyset]}
+		
+		res = cls._find_sorted(dic, server, bucket, sort, descending, limit + 1)
+		if len(res) <= limit:
+			return res, None
+		res = res[:limit]
+		last = res[-1]
+		value = last._id if '_id' == sort else getattr(last, sort)
+		return res, cursor.encode(sort, descending, value, last._id)
+	
+	@classmethod
+	def _search_query(cls, searchstring):
+		""" Matches subjects whose SSSID, name or birthday contain the search
+		string, ignoring case. Terms of up to three characters are looked up
+		in the `_search` n-grams directly; longer terms narrow down the
+		candidates by their trigrams, then match the fields.
+		"""
 		dic = {'type': 'subject'}
 		if searchstring:
-			dic['$or'] = [
-				{'sssid': {'$regex': '{}.*'.format(searchstring), '$options': 'i'}},
-				{'name': {'$regex': '.*{}.*'.format(searchstring), '$options': 'i'}},
-				{'bday': {'$regex': '{}.*'.format(searchstring)}},
-			]
-		return cls.find_on(dic, server, bucket=bucket, skip=skip, limit=limit, sort=sort, descending=descending)
+			term = searchstring.lower()
+			if len(term) <= 3:
+				dic['_search'] = term
+			else:
+				escaped = re.escape(searchstring)
+				dic['_search'] = {'$all': sorted(set(_grams(term, minimum=3)))}
+				dic['$or'] = [
+					{'sssid': {'$regex': escaped, '$options': 'i'}},
+					{'name': {'$regex': escaped, '$options': 'i'}},
+					{'bday': {'$regex': escaped}},
+				]
+		return dic
 	
 	@classmethod
-	def find_on(cls, dic, server, bucket=None, skip=0, limit=50, sort=None, descending=False):
-		res = super().find_on(dic, server, bucket, skip, limit, sort, descending)
-		if res is not None:
-			for subj in res:
-				subj.populate_with_links(server, bucket)
+	def _find_sorted(cls, dic, server, bucket, sort, descending, limit):
+		""" Finds subjects ordered by `sort` and `_id`; `JSONDocument` only
+		supports ordering by one column, hence this goes to the collection.
+		"""
+		coll = storage.collection(server, bucket)
+		if coll is None:
+			res = super().find_on(dic, server, bucket, 0, limit, sort, descending) or []
+		else:
+			direction = DESCENDING if descending else ASCENDING
+			found = coll.find(dic).sort([(sort, direction), ('_id', direction)]).limit(limit)
+			res = [cls(None, json=doc) for doc in found]
 		return res
 	
 	# MARK: - Links
@@ -174,30 +505,71 @@ class Subject(jsondocument.JSONDocument):
 	
 	# MARK: - Audits
 	
-	def all_audits(self, server, bucket=None):
+	def all_audits(self, server, bucket=None, source=None, **filters):
 		""" Find all "audit" documents for this subject AND for all links
-		belonging to this subject.
+		belonging to this subject, sorted by date. Uses one query for the
+		links, one for the audits and one to look up the actors.
 		
-		TODO: this should definitely be a view.
+		:parameter source: "subject" or "link" to only return audits of the
+		                   subject or of its links
+		:parameter filters: Passed on to `Audit.find_for_doc_ids_on()`
 		"""
-		audits = Audit.find_for_doc_id_on(self._id, server, bucket=bucket)
-		if audits is not None and len(audits) > 0:
-			[a.lookup_actor(server, bucket=bucket) for a in audits]
-		else:
-			audits = []
-		
-		links = Link.find_for_sssid_on(self.sssid, server, bucket=bucket)
-		if links is not None and len(links) > 0:
-			for link in links:
-				link_audits = Audit.find_for_doc_id_on(link._id, server, bucket=bucket)
-				if link_audits is not None and len(link_audits) > 0:
-					for a in link_audits:
-						a.action = "[Link] {}".format(a.action)
-						a.lookup_actor(server, bucket=bucket)
-					audits.extend(link_audits)
-		
-		audits.sort(key=lambda k: str(k.datetime) or '1970-01-01')
-		return audits if len(audits) > 0 else None
+		links = Link.find_for_sssid_on(self.sssid, server, bucket=bucket) or []
+		link_ids = set([str(link._id) for link in links])
+		
+		doc_ids = self._audit_doc_ids([link._id for link in links], source)
+		audits = Audit.find_for_doc_ids_on(doc_ids, server, bucket=bucket, **filters)
+		if audits is None:
+			return None
+		
+		for a in audits:
+			if str(a.document) in link_ids:
+				a.action = "[Link] {}".format(a.action)
+		Audit.lookup_actors(audits, server, bucket=bucket)
+		return audits
+	
+	def audit_versions(self, server, bucket=None, source=None, **filters):
+		""" The ids and versions of the audits `all_audits()` returns,
+		fetched with projection-only queries.
+		
+		:returns: A list of dictionaries or None if there is no Mongo collection
+		"""
+		links = etag.versions_on(server, bucket, {'type': 'link', 'sub': self.sssid})
+		if links is None:
+			return None
+		doc_ids = self._audit_doc_ids([doc['_id'] for doc in links], source)
+		return Audit.versions_for_doc_ids_on(doc_ids, server, bucket=bucket, **filters)
+	
+	def _audit_doc_ids(self, link_ids, source):
+		""" The ids of the documents whose audits to return: the subject's and
+		its links' unless `source` is "subject" or "link".
+		
+		:raises: IDMException with status 400 for any other `source`
+		"""
+		if source is None:
+			return [self._id] + link_ids
+		if 'subject' == source:
+			return [self._id]
+		if 'link' == source:
+			return link_ids
+		raise IDMException("`source` must be “subject” or “link”", 400)
+
+
+def _grams(text, minimum=1, maximum=3):
+	""" Returns all substrings of `text` with a length between `minimum` and
+	`maximum`.
+	"""
+	grams = []
+	for n in range(minimum, maximum + 1):
+		grams.extend([text[i:i+n] for i in range(len(text) - n + 1)])
+	return grams
+
+def _search_grams(texts):
+	grams = set()
+	for text in texts:
+		if text:
+			grams.update(_grams(str(text).lower()))
+	return sorted(grams)
 
 from .link import Link
 from .audit import Audit
@@ -2,11 +2,22 @@
 
 import uuid
 import arrow
-import bcrypt
+import logging
 from bson import ObjectId
+from pymongo.errors import DuplicateKeyError
 
+from . import indexes
 from .jsondocument import jsondocument
 from .idmexception import IDMException
+from .passwords import PasswordHasher
+
+# hashes and verifies passwords, replaced with one configured from settings
+# by the app
+hasher = PasswordHasher()
+
+# per-process cache used by `jwt_auth.identity()`; set to an IdentityCache
+# instance to enable
+identity_cache = None
 
 
 class User(jsondocument.JSONDocument):
@@ -26,8 +37,7 @@ class User(jsondocument.JSONDocument):
 	
 	def set_password(self, password):
 		assert password
-		salt = bcrypt.gensalt()
-		self.password = bcrypt.hashpw(password.encode('utf-8'), salt)   # would be nice to store the salt separately
+		self.password = hasher.hash(password)
 		self.temporary = None
 	
 	
@@ -58,7 +68,7 @@ class User(jsondocument.JSONDocument):
 	
 	def email_temporary_pass(self, mailer, link):
 		text = "Dear {},\n\nPlease click the link below to set a new password:\n{}\n\nYou can reply to this email if you keep having issues logging in.\n\nBest regards,\nyour friendly IDM machine".format(self.username, link)
-		mailer.send_mail(self.username, "C Tracker IDM Password Reset", text)
+		mailer.queue_mail(self.username, "C Tracker IDM Password Reset", text)
 	
 	@classmethod
 	def reset_password_for(cls, pass_hash, pass1, pass2, server, bucket=None):
@@ -86,6 +96,7 @@ class User(jsondocument.JSONDocument):
 		                   `action` in the audit log
 		"""
 		super().store_to(server, bucket=bucket)
+		self.__class__._invalidate_identity(self.id)
 		
 		audit = Audit.audit_event_now(self.id, action or 'update')
 		audit.store_to(server, bucket=bucket)
@@ -100,6 +111,11 @@ class User(jsondocument.JSONDocument):
 	def _clean_username(cls, username):
 		return username.lower() if username else None
 	
+	@classmethod
+	def _invalidate_identity(cls, user_id):
+		if identity_cache is not None:
+			identity_cache.invalidate(user_id)
+	
 	@classmethod
 	def get(cls, username, server, bucket=None):
 		""" Raises if the user does not exist.
@@ -134,8 +150,16 @@ class User(jsondocument.JSONDocument):
 		username = cls._clean_username(username)
 		usr = cls.get(username, server, bucket)
 		hashed = usr.password
-		if hashed != bcrypt.hashpw(password.encode('utf-8'), hashed):
+		if not hasher.verify(password, hashed):
 			raise IDMException("incorrect password")
+		
+		# upgrade (or downgrade) the hash to the configured cost factor
+		if hasher.needs_rehash(hashed):
+			try:
+				usr.password = hasher.hash(password)
+				usr.store_to(server, bucket, action='rehash password')
+			except Exception as e:
+				logging.warning("failed to rehash password of {}: {}".format(usr, e))
 		return usr
 	
 	@classmethod
@@ -146,17 +170,22 @@ class User(jsondocument.JSONDocument):
 		if not password or len(password) < 8:
 			raise IDMException("you must provide a password with at least 8 characters")
 		
-		# is the username already in use?
-		res = cls.find_on({'type': 'user', 'username': username}, server, bucket)
-		if res and len(res) > 0:
-			raise IDMException("this username has already been taken", 409)
+		# is the username already in use? Only asked first if there is no
+		# unique username index to reject the insert.
+		if not indexes.has_unique_index(server, bucket, 'user_username'):
+			res = cls.find_on({'type': 'user', 'username': username}, server, bucket)
+			if res and len(res) > 0:
+				raise IDMException("this username has already been taken", 409)
 		
 		# create user
 		usr = cls(username, password)
 		if is_admin:
 			usr.admin = True
 		del usr._id
-		usr.store_to(server, bucket, action='create')
+		try:
+			usr.store_to(server, bucket, action='create')
+		except DuplicateKeyError:
+			raise IDMException("this username has already been taken", 409)
 		return usr
 	
 	@classmethod
@@ -164,6 +193,7 @@ class User(jsondocument.JSONDocument):
 		username = cls._clean_username(username)
 		usr = cls.get(username, server, bucket)
 		usr.remove_from(server, bucket)
+		cls._invalidate_identity(usr.id)
 	
 	@classmethod
 	def has_admins(cls, server, bucket=None):
@@ -0,0 +1,55 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+
+import os
+import shutil
+import tempfile
+import unittest
+from py import ratelimit
+
+
+class RateLimitTests(unittest.TestCase):
+	
+	def setUp(self):
+		self.directory = tempfile.mkdtemp()
+		self.path = os.path.join(self.directory, 'ratelimit.sqlite')
+		self.now = 1000.0
+	
+	def tearDown(self):
+		shutil.rmtree(self.directory)
+	
+	def limiter(self):
+		return ratelimit.RateLimiter(self.path, clock=lambda: self.now)
+	
+	def testClientIP(self):
+		trusted = ['127.0.0.1', '::1']
+		self.assertEqual('203.0.113.7', ratelimit.client_ip('127.0.0.1', '203.0.113.7', trusted))
+		self.assertEqual('203.0.113.7', ratelimit.client_ip('::1', '203.0.113.7', trusted))
+		self.assertEqual('198.51.100.2', ratelimit.client_ip('198.51.100.2', '203.0.113.7', trusted))
+		self.assertEqual('127.0.0.1', ratelimit.client_ip('127.0.0.1', None, trusted))
+		self.assertEqual('127.0.0.1', ratelimit.client_ip('127.0.0.1', '203.0.113.7', []))
+	
+	def testBurstAndRefill(self):
+		limiter = self.limiter()
+		for i in range(3):
+			self.assertEqual(0, limiter.hit([('ip:1', 0.5, 3)]))
+		self.assertAlmostEqual(2.0, limiter.hit([('ip:1', 0.5, 3)]))
+		self.assertEqual(0, limiter.hit([('ip:2', 0.5, 3)]))
+		
+		self.now += 2
+		self.assertEqual(0, limiter.hit([('ip:1', 0.5, 3)]))
+		self.assertGreater(limiter.hit([('ip:1', 0.5, 3)]), 0)
+	
+	def testAllOrNothing(self):
+		limiter = self.limiter()
+		self.assertEqual(0, limiter.hit([('user:a', 1, 1)]))
+		self.assertGreater(limiter.hit([('ip:1', 1, 1), ('user:a', 1, 1)]), 0)
+		self.assertEqual(0, limiter.hit([('ip:1', 1, 1), ('user:b', 1, 1)]))
+	
+	def testSharedAcrossInstances(self):
+		self.assertEqual(0, self.limiter().hit([('ip:1', 1, 1)]))
+		self.assertGreater(self.limiter().hit([('ip:1', 1, 1)]), 0)
+	
+	def testFailsOpen(self):
+		limiter = ratelimit.RateLimiter(os.path.join(self.directory, 'missing', 'ratelimit.sqlite'))
+		self.assertEqual(0, limiter.hit([('ip:1', 1, 0)]))
@@ -1,3 +1,3 @@
 #!/bin/bash
 
-python -m unittest link_tests.py
+python -m unittest link_tests.py subject_tests.py identitycache_tests.py cursor_tests.py auditsink_tests.py mailer_tests.py health_tests.py passwords_tests.py export_tests.py etag_tests.py serializer_tests.py mongopool_tests.py metrics_tests.py auditstore_tests.py ratelimit_tests.py user_tests.py audit_tests.py indexes_tests.py
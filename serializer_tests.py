@@ -0,0 +1,36 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+
+import json
+import datetime
+import unittest
+from bson import ObjectId
+from py import serializer
+
+
+class SerializerTests(unittest.TestCase):
+	
+	def tearDown(self):
+		serializer.use('auto')
+	
+	def testBackends(self):
+		oid = ObjectId()
+		doc = {'_id': oid, 'name': 'Bruno Märs', '_jwt': b'ey.J0', 'when': datetime.datetime(2017, 1, 17, 10, 6, 17), 'n': [1, 2.5, None, True]}
+		expected = {'_id': str(oid), 'name': 'Bruno Märs', '_jwt': 'ey.J0', 'when': '2017-01-17T10:06:17', 'n': [1, 2.5, None, True]}
+		for backend in serializer.BACKENDS:
+			if 'orjson' == backend and serializer.orjson is None:
+				continue
+			self.assertEqual(backend, serializer.use(backend))
+			self.assertEqual(expected, json.loads(serializer.dumps(doc)))
+		
+		with self.assertRaises(Exception):
+			serializer.use('simplejson')
+		with self.assertRaises(TypeError):
+			serializer.dumps({'x': object()})
+	
+	def testStreamList(self):
+		items = [{'i': i} for i in range(7)]
+		for batch_size in [1, 3, 7, 50]:
+			chunks = list(serializer.stream_list(items, dict, extra={'next': 'abc'}, batch_size=batch_size))
+			self.assertEqual({'data': items, 'next': 'abc'}, json.loads(''.join(chunks)))
+		self.assertEqual({'data': []}, json.loads(''.join(serializer.stream_list([], dict))))
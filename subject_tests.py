@@ -0,0 +1,214 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+
+import unittest
+from unittest.mock import patch
+from pymongo.errors import DuplicateKeyError
+from py import link
+from py import indexes
+from py import subject
+from py.idmexception import IDMException
+from py.jsondocument import mockserver as mock
+
+
+class SubjectTests(unittest.TestCase):
+	
+	def testApplyLinks(self):
+		subj = subject.Subject('ZH001', dict(doc_subject))
+		subj.apply_links([
+			_link('ZH001', linked_on='2017-01-18T10:00:00+00:00'),
+			_link('ZH001', linked_on='2017-01-17T10:00:00+00:00'),
+			_link('ZH001', linked_on='2017-01-16T10:00:00+00:00', withdrawn_on='2017-02-01T10:00:00+00:00'),
+			_link('ZH001', linked_on='2017-01-15T10:00:00+00:00', withdrawn_on='2017-03-01T10:00:00+00:00'),
+		])
+		self.assertEqual('2017-01-17T10:00:00+00:00', subj.date_enrolled)
+		self.assertEqual('2017-03-01T10:00:00+00:00', subj.date_withdrawn)
+	
+	def testApplyLinksKeepsExisting(self):
+		js = dict(doc_subject)
+		js['date_enrolled'] = '2017-01-01T10:00:00+00:00'
+		subj = subject.Subject('ZH001', js)
+		subj.apply_links([_link('ZH001', linked_on='2017-01-17T10:00:00+00:00')])
+		self.assertEqual('2017-01-01T10:00:00+00:00', subj.date_enrolled)
+		self.assertIsNone(subj.date_withdrawn)
+	
+	def testPopulateAll(self):
+		srv = mock.MockServer()
+		srv.found_documents = [
+			doc_link('ZH001', linked_on='2017-01-17T10:00:00+00:00'),
+			doc_link('ZH002', linked_on='2017-01-18T10:00:00+00:00', withdrawn_on='2017-02-01T10:00:00+00:00'),
+		]
+		js1 = dict(doc_subject)
+		js2 = dict(doc_subject)
+		js2['sssid'] = 'ZH002'
+		subj1 = subject.Subject('ZH001', js1)
+		subj2 = subject.Subject('ZH002', js2)
+		subject.Subject.populate_all_with_links([subj1, subj2], srv)
+		
+		self.assertEqual('2017-01-17T10:00:00+00:00', subj1.date_enrolled)
+		self.assertIsNone(subj1.date_withdrawn)
+		self.assertIsNone(subj2.date_enrolled)
+		self.assertEqual('2017-02-01T10:00:00+00:00', subj2.date_withdrawn)
+	
+	def testUpdateLinkDates(self):
+		srv = mock.MockServer()
+		subj = subject.Subject('ZH001', dict(doc_subject))
+		stored = []
+		def store(subj, server, bucket=None):
+			stored.append((subj.date_enrolled, subj.date_withdrawn))
+		
+		with patch.object(subject.Subject, 'find_sssid_on', return_value=[subj]), \
+				patch.object(subject.Subject, '_store_link_dates', autospec=True, side_effect=store):
+			srv.found_documents = [doc_link('ZH001', linked_on='2017-01-17T10:00:00+00:00')]
+			subject.Subject.update_link_dates('ZH001', srv)
+			self.assertEqual([('2017-01-17T10:00:00+00:00', None)], stored)
+			
+			# nothing changed, nothing stored
+			subject.Subject.update_link_dates('ZH001', srv)
+			self.assertEqual(1, len(stored))
+			
+			# withdrawing keeps the enrollment date
+			srv.found_documents = [doc_link('ZH001', linked_on='2017-01-17T10:00:00+00:00', withdrawn_on='2017-02-01T10:00:00+00:00')]
+			subject.Subject.update_link_dates('ZH001', srv)
+			self.assertEqual(('2017-01-17T10:00:00+00:00', '2017-02-01T10:00:00+00:00'), stored[-1])
+	
+	def testBackfillLinkDates(self):
+		srv = mock.MockServer()
+		srv.found_documents = [
+			doc_link('ZH001', linked_on='2017-01-17T10:00:00+00:00'),
+			doc_link('ZH004', linked_on='2017-01-18T10:00:00+00:00', withdrawn_on='2017-02-01T10:00:00+00:00'),
+		]
+		subjs = [subject.Subject(sssid, dict(doc_subject, sssid=sssid, _id='id{}'.format(sssid))) for sssid in ['ZH001', 'ZH002', 'ZH003', 'ZH004', 'ZH005']]
+		queries = []
+		def find_on(dic, server, bucket=None, limit=50, sort=None):
+			queries.append(dic)
+			after = dic.get('_id', {}).get('$gt')
+			return [subj for subj in subjs if after is None or subj._id > after][:limit]
+		stored = []
+		def store(subj, server, bucket=None):
+			stored.append((subj.sssid, subj.date_enrolled, subj.date_withdrawn))
+		
+		with patch.object(subject.Subject, 'find_on', side_effect=find_on), \
+				patch.object(subject.Subject, '_store_link_dates', autospec=True, side_effect=store):
+			self.assertEqual(2, subject.Subject.backfill_link_dates(srv, batch_size=2))
+		self.assertEqual([None, 'idZH002', 'idZH004'], [dic.get('_id', {}).get('$gt') for dic in queries])
+		self.assertEqual([
+			('ZH001', '2017-01-17T10:00:00+00:00', None),
+			('ZH004', None, '2017-02-01T10:00:00+00:00'),
+		], stored)
+	
+	def testSearchGrams(self):
+		subj = subject.Subject('ZH1', {'sssid': 'ZH1', 'name': 'Bo', 'bday': '1953-06-20'})
+		grams = subj.search_grams()
+		for gram in ['z', 'zh', 'zh1', 'b', 'bo', '195', '-06', '20']:
+			self.assertIn(gram, grams)
+		self.assertNotIn('ZH', grams)
+		self.assertNotIn('zh1b', grams)
+	
+	def testSearchQuery(self):
+		self.assertEqual({'type': 'subject'}, subject.Subject._search_query(None))
+		self.assertEqual({'type': 'subject', '_search': 'mar'}, subject.Subject._search_query('Mar'))
+		
+		dic = subject.Subject._search_query('Mars.')
+		self.assertEqual(['ars', 'mar', 'rs.'], dic['_search']['$all'])
+		self.assertEqual({'name': {'$regex': 'Mars\\.', '$options': 'i'}}, dic['$or'][1])
+	
+	def testImportNDJSON(self):
+		srv = mock.MockServer()
+		lines = [
+			b'{"sssid": "ZH001", "name": "Bruno Mars", "bday": "1953-06-20"}\n',
+			b'\n',
+			b'{"sssid": "ZH002", "name": "Bruno Mars"}\n',
+			b'not json\n',
+			b'{"sssid": "ZH001", "name": "Bruno Mars", "bday": "1953-06-20"}\n',
+			b'{"sssid": "ZH003", "name": "Bruno M\xe4rs", "bday": "1953-06-20"}\n',
+			b'{"sssid": "ZH004", "name": "Bruno Mars", "bday": "1953-06-20"}\n',
+		]
+		results = list(subject.Subject.import_ndjson(lines, srv))
+		self.assertEqual([1, 3, 4, 5, 6, 7], [r['line'] for r in results])
+		self.assertEqual([201, 400, 400, 409, 400, 201], [r['status'] for r in results])
+		self.assertIn('utf-8', results[4]['error'])
+		self.assertEqual('ZH002', results[1]['sssid'])
+	
+	def testAuditDocIds(self):
+		subj = subject.Subject('ZH001', {'sssid': 'ZH001', 'name': 'Bruno Mars', 'bday': '1953-06-20'})
+		self.assertEqual([subj._id, 'l1', 'l2'], subj._audit_doc_ids(['l1', 'l2'], None))
+		self.assertEqual([subj._id], subj._audit_doc_ids(['l1', 'l2'], 'subject'))
+		self.assertEqual(['l1', 'l2'], subj._audit_doc_ids(['l1', 'l2'], 'link'))
+		with self.assertRaises(IDMException) as cm:
+			subj._audit_doc_ids(['l1'], 'user')
+		self.assertEqual(400, cm.exception.status_code)
+	
+	def testImportOneByOneTakenSSSID(self):
+		srv = mock.MockServer()
+		lines = [
+			b'{"sssid": "ZH001", "name": "Bruno Mars", "bday": "1953-06-20"}\n',
+			b'{"sssid": "ZH002", "name": "Bruno Mars", "bday": "1953-06-20"}\n',
+		]
+		taken = lambda sssid, server, bucket=None: [subject.Subject(sssid, dict(doc_subject))] if 'ZH001' == sssid else None
+		with patch.object(subject.Subject, 'find_sssid_on', side_effect=taken):
+			results = list(subject.Subject.import_ndjson(lines, srv))
+		self.assertEqual([409, 201], [r['status'] for r in results])
+	
+	def testCreateTakenSSSID(self):
+		srv = mock.MockServer()
+		subj = subject.Subject.create({'sssid': 'ZH001', 'name': 'Bruno Mars', 'bday': '1953-06-20'}, srv)
+		self.assertEqual('ZH001', subj.sssid)
+		srv.found_documents = [dict(doc_subject)]
+		with self.assertRaises(IDMException) as cm:
+			subject.Subject.create({'sssid': 'ZH001', 'name': 'Bruno Mars', 'bday': '1953-06-20'}, srv)
+		self.assertEqual(409, cm.exception.status_code)
+	
+	def testCreateDuplicateKey(self):
+		indexes._unique.clear()
+		srv = FakeMongoServer({'subject_sssid': {'unique': True}})
+		with patch.object(subject.Subject, 'find_sssid_on') as find:
+			with patch.object(subject.Subject, 'store_to', side_effect=DuplicateKeyError('E11000 duplicate key error')):
+				with self.assertRaises(IDMException) as cm:
+					subject.Subject.create({'sssid': 'ZH001', 'name': 'Bruno Mars', 'bday': '1953-06-20'}, srv)
+		self.assertEqual(409, cm.exception.status_code)
+		self.assertFalse(find.called)
+	
+	def testCreateWithoutUniqueIndex(self):
+		for existing in [{}, {'subject_sssid': {}}]:
+			indexes._unique.clear()
+			srv = FakeMongoServer(existing)
+			with patch.object(subject.Subject, 'find_sssid_on', return_value=[subject.Subject('ZH001', dict(doc_subject))]):
+				with patch.object(subject.Subject, 'store_to') as store:
+					with self.assertRaises(IDMException) as cm:
+						subject.Subject.create({'sssid': 'ZH001', 'name': 'Bruno Mars', 'bday': '1953-06-20'}, srv)
+			self.assertEqual(409, cm.exception.status_code)
+			self.assertFalse(store.called)
+
+
+class FakeMongoServer(object):
+	""" A server exposing a Mongo collection with the given indexes.
+	"""
+	
+	def __init__(self, existing):
+		self.bucket = 'idm'
+		self.db = {'idm': FakeCollection(existing)}
+
+
+class FakeCollection(object):
+	
+	def __init__(self, existing):
+		self.name = 'idm'
+		self.existing = existing
+	
+	def index_information(self):
+		return dict(self.existing)
+
+
+def doc_link(sssid, linked_on=None, withdrawn_on=None):
+	js = {"type": "link", "sub": sssid, "aud": "https://idm.c3-pro.io/", "iss": "https://idm.c3-pro.io/", "secret": "super-duper-secret", "algorithm": "HS256"}
+	if linked_on:
+		js['linked_on'] = linked_on
+	if withdrawn_on:
+		js['withdrawn_on'] = withdrawn_on
+	return js
+
+def _link(sssid, linked_on=None, withdrawn_on=None):
+	return link.Link(None, doc_link(sssid, linked_on, withdrawn_on))
+
+doc_subject = { "sssid": "ZH001", "name": "Bruno Mars", "bday": "1953-06-20", "date_consented": "2017-01-10T10:00:00+00:00" }
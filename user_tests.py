@@ -0,0 +1,69 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+
+import unittest
+from unittest.mock import patch
+from pymongo.errors import DuplicateKeyError
+from py import user
+from py import indexes
+from py.passwords import PasswordHasher
+from py.idmexception import IDMException
+from py.jsondocument import mockserver as mock
+
+
+class UserTests(unittest.TestCase):
+	
+	def setUp(self):
+		self.hasher = user.hasher
+		user.hasher = PasswordHasher(rounds=4)
+	
+	def tearDown(self):
+		user.hasher = self.hasher
+	
+	def testCreateTakenUsername(self):
+		srv = mock.MockServer()
+		usr = user.User.create('Bruno@Mars.com', 'uptown-funk', False, srv)
+		self.assertEqual('bruno@mars.com', usr.username)
+		srv.found_documents = [{'type': 'user', 'username': 'bruno@mars.com'}]
+		with self.assertRaises(IDMException) as cm:
+			user.User.create('bruno@mars.com', 'uptown-funk', False, srv)
+		self.assertEqual(409, cm.exception.status_code)
+	
+	def testCreateDuplicateKey(self):
+		indexes._unique.clear()
+		srv = FakeMongoServer({'user_username': {'unique': True}})
+		with patch.object(user.User, 'find_on') as find:
+			with patch.object(user.User, 'store_to', side_effect=DuplicateKeyError('E11000 duplicate key error')):
+				with self.assertRaises(IDMException) as cm:
+					user.User.create('bruno@mars.com', 'uptown-funk', False, srv)
+		self.assertEqual(409, cm.exception.status_code)
+		self.assertFalse(find.called)
+	
+	def testCreateWithoutUniqueIndex(self):
+		indexes._unique.clear()
+		srv = FakeMongoServer({})
+		with patch.object(user.User, 'find_on', return_value=[user.User('bruno@mars.com', 'uptown-funk')]):
+			with patch.object(user.User, 'store_to') as store:
+				with self.assertRaises(IDMException) as cm:
+					user.User.create('bruno@mars.com', 'uptown-funk', False, srv)
+		self.assertEqual(409, cm.exception.status_code)
+		self.assertFalse(store.called)
+
+
+class FakeMongoServer(object):
+	""" A server exposing a Mongo collection with the given indexes.
+	"""
+	
+	def __init__(self, existing):
+		self.bucket = 'idm'
+		self.db = {'idm': FakeCollection(existing)}
+
+
+class FakeCollection(object):
+	
+	def __init__(self, existing):
+		self.name = 'idm'
+		self.existing = existing
+	
+	def index_information(self):
+		return dict(self.existing)